@@ -1,5 +1,6 @@
 from datetime import datetime
 import os
+import time
 import hashlib
 from urllib.request import urlopen
 import json
@@ -8,6 +9,7 @@ import glob
 import re
 import yaml
 import db_conn
+from tpx_updater import TpxUpdater
 
 def get_root_dirs(rootDir, instr, utDate):
     """
@@ -40,6 +42,15 @@ def get_root_dirs(rootDir, instr, utDate):
 
 
 
+def get_file_md5(filepath):
+    '''Returns md5 hex digest of a file, read in chunks.'''
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def make_dir_md5_table(readDir, endswith, outfile, fileList=None, regex=None):
 
     #ensure path ends in slash since we rely on that later here
@@ -75,25 +86,30 @@ def removeFilesByWildcard(wildcardPath):
 
 
 
-def get_api_data(url, getOne=False, isJson=True):
+def get_api_data(url, getOne=False, isJson=True, timeout=None, retries=0):
     '''
     Gets data for common calls to url API requests.
+    Optional timeout (secs) per request and number of retries (after a short
+    wait) if the request fails.
 
     #todo: add some better validation checks and maybe some options (ie getOne, typeCast)
     '''
-    
-    try:
-        data = urlopen(url)
-        data = data.read().decode('utf8')
-        if isJson: data = json.loads(data)
 
-        if getOne and len(data) > 0: 
-            data = data[0]
+    for attempt in range(retries + 1):
+        if attempt > 0: time.sleep(0.5 * attempt)
+        try:
+            data = urlopen(url, timeout=timeout) if timeout else urlopen(url)
+            data = data.read().decode('utf8')
+            if isJson: data = json.loads(data)
 
-        return data
+            if getOne and len(data) > 0: 
+                data = data[0]
 
-    except Exception as e:
-        return None
+            return data
+
+        except Exception as e:
+            continue
+    return None
 
 
 
@@ -124,7 +140,8 @@ def do_fatal_error(msg, instr=None, utDate=None, failStage=None, log=None):
 
 def update_koatpx(instr, utDate, column, value, log=''):
     """
-    Sends command to update KOA data
+    Sends command to update KOA data (one column, see tpx_updater.TpxUpdater 
+    to update several at once)
 
     @param instrObj: the instrument object
     @param column: column to update in koa.koatpx
@@ -132,31 +149,9 @@ def update_koatpx(instr, utDate, column, value, log=''):
     @param value: value to update column to
     @type value: string
     """
-    db = db_conn.db_conn('config.live.ini', configKey='DATABASE')
-
-    # If entry not in database, create it
-    query = f'select count(*) as num from koatpx where instr="{instr}" and utdate="{utDate}"'
-    check = db.query('koa', query, getOne=True)
-    if check is False:
-        if log: log.error(f'update_koatpx failed for: {instr}, {utDate}, {column}, {value}')
-        return False
-    if int(check['num']) == 0:
-        query = f'insert into koatpx set instr="{instr}", utdate="{utDate}"'
-        if log: log.info(query)
-        check = db.query('koa', query)
-        if check is False or int(check) == 0:
-            if log: log.error(f'update_koatpx failed for: {instr}, {utDate}, {column}, {value}')
-            return False
-
-    # Now update it
-    query = f'update koatpx set {column}="{value}" where instr="{instr}" and utdate="{utDate}"'
-    if log: log.info(query)
-    check = db.query('koa', query)
-    if check is False:
-        if log: log.error(f'update_koatpx failed for: {instr}, {utDate}, {column}, {value}')
-        return False
-
-    return True
+    tpx = TpxUpdater(instr, utDate, log)
+    tpx.set(column, value)
+    return tpx.flush()
 
 
 def get_directory_size(dir):
@@ -180,6 +175,44 @@ def get_directory_size(dir):
     return str(total/1000000.0)
 
 
+#Program info by semid, shared by the get_prog_* functions so each program is
+#only looked up once per night (see prog_catalog.py).
+progCatalog = None
+
+
+def get_prog_catalog(log=None):
+    """
+    Returns the shared prog_catalog.ProgramCatalog (created on first use)
+    """
+    global progCatalog
+    if progCatalog is None:
+        from prog_catalog import ProgramCatalog
+        progCatalog = ProgramCatalog(log)
+    if log: progCatalog.log = log
+    return progCatalog
+
+
+def clear_prog_cache():
+    """
+    Empties the program info cache (ie when starting another night in the same process)
+    """
+    get_prog_catalog().clear()
+
+
+def get_prog_info(semid, key, default=None, log=None):
+    """
+    Returns program info value for semid ('pi', 'title' or 'inst') from the 
+    shared catalog, fetching it if it was not prefetched.  Returns default if
+    the program or value was not found.
+    """
+    catalog = get_prog_catalog(log)
+    val = catalog.get(semid, key)
+    if val is False:
+        catalog.fetch([semid])
+        val = catalog.get(semid, key)
+    return default if val is None or val is False else val
+
+
 def get_prog_inst(semid, default=None, log=None, isToO=False):
     """
     Query the proposalsAPI and get the program institution
@@ -187,16 +220,12 @@ def get_prog_inst(semid, default=None, log=None, isToO=False):
     @type semid: string
     @param semid: the program ID - consists of semester and progname (ie 2017B_U428)
     """
-
-    api = get_proposal_api()
-    url = api + 'ktn='+semid+'&cmd=getAllocInst&json=True'
-    data = get_api_data(url)
-    if not data or not data.get('success'):
-        if log: log.error('Unable to query API: ' + url)
+    val = get_prog_info(semid, 'inst', None, log)
+    if val is None:
+        if log: log.error(f'Unable to get institution for semid {semid}')
         return default
-    else:
-        val = data.get('data', {}).get('AllocInst', default)
-        return val
+    return val
+
 
 def get_prog_pi(semid, default=None, log=None):
     """
@@ -205,17 +234,11 @@ def get_prog_pi(semid, default=None, log=None):
     @type semid: string
     @param semid: the program ID - consists of semester and progname (ie 2017B_U428)
     """
-    db = db_conn.db_conn('config.live.ini', configKey='DATABASE')
-    query = ( 'select pi.pi_lastname, pi.pi_firstname '
-              ' from koa_program as p, koa_pi as pi '
-             f' where p.semid="{semid}" and p.piID=pi.piID')
-    data = db.query('koa', query, getOne=True)
-    if not data or 'pi_lastname' not in data:
+    val = get_prog_info(semid, 'pi', None, log)
+    if val is None:
         if log: log.error(f'Unable to get PI name for semid {semid}')
         return default
-    else:
-        val = data['pi_lastname'].replace(' ','')
-        return val
+    return val
 
 
 def get_prog_title(semid, default=None, log=None):
@@ -225,15 +248,11 @@ def get_prog_title(semid, default=None, log=None):
     @type semid: string
     @param semid: the program ID - consists of semester and progname (ie 2017B_U428)
     """
-    db = db_conn.db_conn('config.live.ini', configKey='DATABASE')
-    query = f'select progtitl from koa_program where semid="{semid}"'
-    data = db.query('koa', query, getOne=True)
-
-    if not data or 'progtitl' not in data:
+    val = get_prog_info(semid, 'title', None, log)
+    if val is None:
         if log: log.error(f'Unable to get title for semid {semid}')
         return default
-    else:
-        return data['progtitl']
+    return val
 
 
 def is_progid_valid(progid):
@@ -1,7 +1,7 @@
 from astropy.io import fits
 from urllib.request import urlopen
-from dep_obtain import get_obtain_data
 from common import *
+from header_cache import HeaderCache
 
 
 def create_prog(instrObj):
@@ -40,11 +40,13 @@ def create_prog(instrObj):
     if log: log.info('create_prog: Getting FITS file information')
 
 
-    # Get OA from dep_obtain file
-    obFile = stageDir + '/dep_obtain' + instr + '.txt'
-    obData = get_obtain_data(obFile)
-    oa = ''
-    if len(obData) >= 1: oa = obData[0]['OA']
+    # New night, start with empty program info cache (shared with getProgInfo)
+    clear_prog_cache()
+
+
+    # Get OA from dep_obtain schedule
+    oa = instrObj.get_obtain_schedule().oa
+    if oa is None: oa = ''
 
 
     # Get all files
@@ -55,7 +57,14 @@ def create_prog(instrObj):
             fileList.append(item.strip())
 
 
-    # loop through files and add data to createprog.txt
+    # Headers validated in dep_locate (avoids opening each file again)
+    headerCache = HeaderCache.load(stageDir, instr, log)
+
+
+    # loop through files and gather data for createprog.txt
+    # (program info for all semids is then fetched at once, see prog_catalog.py)
+    rows = []
+    semids = []
     outfile = stageDir + '/createprog.txt'
     with open(outfile, 'w') as ofile:
         for filename in fileList:
@@ -71,7 +80,7 @@ def create_prog(instrObj):
 
             #load fits into instrObj
             #todo: Move all keyword fixes as standard steps done upfront?
-            instrObj.set_fits_file(filename)
+            instrObj.set_fits_file(filename, header=headerCache.get(filename))
 
             # Temp fix for bad file times (NIRSPEC legacy)
             instrObj.fix_datetime(filename)
@@ -111,15 +120,9 @@ def create_prog(instrObj):
             sem = instrObj.get_keyword('SEMESTER')
             sem = sem.strip()
 
-            #write out vars to file, one line each var
+            #save vars to write to file, one line each var
             newFile = newFile.replace('//','/')
-            ofile.write(newFile+'\n')
-            ofile.write(dateObs+'\n')
-            ofile.write(utc+'\n')
-            ofile.write(outdir+'\n')
-            ofile.write(observer+'\n')
-            ofile.write(str(fileno)+'\n')
-            ofile.write(imagetyp+'\n')
+            row = [newFile, dateObs, utc, outdir, observer, str(fileno), imagetyp]
 
             #if PROGNAME exists (either assigned from command line or in PROGNAME), use that to populate the PROG* values
             #NOTE: PROGNAME can be in format with or without semester
@@ -136,10 +139,8 @@ def create_prog(instrObj):
                 if log: log.warn('create_prog: Invalid PROGNAME: ' + str(progname))
 
             #try to assign PROG* keywords from progname
-            progid   = 'PROGID'
-            progpi   = 'PROGPI'
-            proginst = 'PROGINST'
-            progtitl = 'PROGTITL'
+            progid = 'PROGID'
+            semid  = None
             if isProgValid:
                 progname = progname.strip().upper()
                 if progname == 'ENG':
@@ -147,11 +148,23 @@ def create_prog(instrObj):
                 else:
                     if '_' in progname: sem, progname = progname.split('_')
                     semid = sem + '_' + progname
-                    progid   = progname
-                    progpi   = get_prog_pi   (semid, 'PROGPI'  , log)
-                    proginst = get_prog_inst (semid, 'PROGINST', log)
-                    progtitl = get_prog_title(semid, 'PROGTITL', log)
+                    progid = progname
+                    semids.append(semid)
+            rows.append((row, progid, semid))
+
+        #one lookup for all programs, then write out
+        get_prog_catalog(log).fetch(semids)
+        for row, progid, semid in rows:
+            progpi   = 'PROGPI'
+            proginst = 'PROGINST'
+            progtitl = 'PROGTITL'
+            if semid:
+                progpi   = get_prog_pi   (semid, 'PROGPI'  , log)
+                proginst = get_prog_inst (semid, 'PROGINST', log)
+                progtitl = get_prog_title(semid, 'PROGTITL', log)
 
+            for val in row:
+                ofile.write(val + '\n')
             ofile.write(progid + '\n')
             ofile.write(progpi   + '\n')
             ofile.write(proginst + '\n')
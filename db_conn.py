@@ -1,5 +1,7 @@
 import os
 import yaml
+import time
+import threading
 
 # import psycopg2
 # from psycopg2.extras import RealDictCursor
@@ -7,11 +9,61 @@ import yaml
 import pymysql.cursors
 
 
+#Process-wide caches shared by all db_conn objects: parsed config files (parsed
+#once), the first word (query type) of each query text, and connections, one per
+#thread per database, reused until they fail.  No statements are prepared/cached.
+#A pooled connection is only pinged if it has been idle for PING_IDLE secs.
+PING_IDLE = 60
+configCache = {}
+queryTypes = {}
+configLock = threading.Lock()
+poolLocal = threading.local()
+
+
+def get_config(configFile):
+    '''Returns parsed yaml config file, read only the first time.'''
+    key = os.path.abspath(configFile)
+    with configLock:
+        if key not in configCache:
+            assert os.path.isfile(configFile), f"ERROR: config file '{configFile}' does not exist.  Exiting."
+            with open(configFile) as f: configCache[key] = yaml.safe_load(f)
+        return configCache[key]
+
+
+def get_query_type(query):
+    '''Returns lowercase first word (ie select) of a query, cached by query text.'''
+    qtype = queryTypes.get(query)
+    if qtype is None:
+        words = query.split(None, 1)
+        qtype = words[0].lower() if words else ''
+        if len(queryTypes) < 10000: queryTypes[query] = qtype
+    return qtype
+
+
+def get_pool():
+    '''Returns this thread's dict of pooled connections (reset in a forked child).'''
+    if getattr(poolLocal, 'pid', None) != os.getpid():
+        poolLocal.pid = os.getpid()
+        poolLocal.conns = {}
+    return poolLocal.conns
+
+
+def close_pool():
+    '''Closes this thread's pooled connections.'''
+    pool = get_pool()
+    for conn, lastUsed in pool.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    pool.clear()
+
+
 
 class db_conn(object):
     '''
     Simple database connection and query layer.  
-    Opens and closes and new connection each query.
+    Connections are pooled per process and thread (see get_pool) and reused.
     Define db connection params in config file.
 
     Config file follows yaml format and should contain one dict entry per database:
@@ -28,6 +80,7 @@ class db_conn(object):
     Inputs:
     - configFile: Filepath to yaml config file
     - configKey: Optionally define a config dict key if config is within a larger yaml file.
+    - persist: Kept for compatibility, connections are always pooled now.
 
     TODO: improve error/warning reporting and logging
     '''
@@ -38,9 +91,9 @@ class db_conn(object):
         self.readOnly = 0
         self.VALID_DB_TYPES = ('mysql', 'postgresql')
 
-        #parse config file
-        assert os.path.isfile(configFile), f"ERROR: config file '{configFile}' does not exist.  Exiting."
-        with open(configFile) as f: self.config = yaml.safe_load(f)
+        #parse config file (cached)
+        self.config = get_config(configFile)
+        self.poolId = (os.path.abspath(configFile), configKey)
         if configKey:
             assert configKey in self.config, f"ERROR: config key '{configKey}' does not exist in config file. Exiting." 
             self.config = self.config[configKey]
@@ -54,13 +107,22 @@ class db_conn(object):
         Connect to the specified database.  
         '''
 
-        #see if we already have a connection and if so ping it to keep alive and return it.
-        #todo: read about conn.open == False?
-        if self.persist:                
-            if database in self.conns and self.conns[database]:
-                conn = self.conns[database]
-                conn.ping(reconnect=True)
+        #see if we already have a pooled connection for this thread.  If idle for 
+        #a while, ping it (reconnects) and drop it if that fails.
+        pool = get_pool()
+        poolKey = (self.poolId, database)
+        if poolKey in pool:
+            conn, lastUsed = pool[poolKey]
+            if time.time() - lastUsed > PING_IDLE:
+                try:
+                    conn.ping(reconnect=True)
+                except Exception:
+                    conn = None
+            if conn:
+                pool[poolKey] = (conn, time.time())
+                self.conns[database] = conn
                 return conn
+            del pool[poolKey]
 
 
         #get db connect data
@@ -90,31 +152,45 @@ class db_conn(object):
             print ('ERROR: ', e)
 
         #save connection
-        if self.persist:
-            self.conns[database] = conn
+        if conn:
+            pool[poolKey] = (conn, time.time())
+        self.conns[database] = conn
 
         #return
         return conn
 
 
     def close(self, database=None):
-
-        #close all connections unless they specify one
-        #todo: do we need to track the cursor and close it as well?
-        for key, conn in self.conns.items():
+        '''
+        Releases this object's connections.  They stay open in the pool for reuse
+        (use close_pool to close them).
+        '''
+        for key in list(self.conns.keys()):
             if database and key != database: 
                 continue
-            if conn:
+            del self.conns[key]
+
+
+    def drop(self, database):
+        '''Closes and removes a failed connection from the pool.'''
+        conn, lastUsed = get_pool().pop((self.poolId, database), (None, None))
+        self.conns.pop(database, None)
+        if conn:
+            try:
                 conn.close()
+            except Exception:
+                pass
 
 
-    def query(self, database, query, getOne=False, getColumn=False, getInsert=False):
+    def query(self, database, query, getOne=False, getColumn=False, getInsert=False, params=None):
         '''
         Executes basic query.  Determines query type and returns fetchall on select, otherwise rowcount on other query types.
-        Returns false on any exception error.  Opens and closes a new connection each time.
+        Optional params (tuple/list or dict) are passed to the driver for %s/%(name)s placeholders.
+        Returns false on any exception error.  Uses pooled connection (see connect).
         '''
 
         result = False
+        cursor = None
         try:
             conn = self.connect(database)
 
@@ -122,8 +198,8 @@ class db_conn(object):
             type = self.config[database]['type']
 
             #determine query type and check for read only restriction
-            qtype = query.strip().split()[0]
-            if self.readOnly and qtype not in ('select'):
+            qtype = get_query_type(query)
+            if self.readOnly and qtype != 'select':
                 print ('ERROR: Attempting to write to DB in read-only mode.')
                 return False
 
@@ -138,8 +214,8 @@ class db_conn(object):
 
             #execute query and determine return value by qtype
             if cursor:
-                cursor.execute(query)
-                if   qtype in ('select'): result = cursor.fetchall()
+                cursor.execute(query, params)
+                if   qtype == 'select'  : result = cursor.fetchall()
                 elif getInsert          : result = cursor.fetchone()
                 else                    : result = cursor.rowcount
                 cursor.close()
@@ -157,13 +233,45 @@ class db_conn(object):
         except Exception as e:
             print ('ERROR: ', e)
             result = False
+            #lost connection? don't reuse it
+            if isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+                self.drop(database)
 
         finally:
-            if not self.persist:
-                if cursor: cursor.close()
-                if conn: conn.close()
+            if cursor: cursor.close()
 
         return result
 
 
+    def executemany(self, database, query, paramsList):
+        '''
+        Executes a query once for each params in paramsList (ie bulk insert/update).
+        For mysql, an "insert ... values (%s, ...)" is sent as one multi-row insert.
+        Returns total rowcount or False on any exception error.
+        '''
+
+        result = False
+        cursor = None
+        try:
+            if self.readOnly and get_query_type(query) != 'select':
+                print ('ERROR: Attempting to write to DB in read-only mode.')
+                return False
+            paramsList = list(paramsList)
+            if not paramsList: return 0
+
+            conn = self.connect(database)
+            cursor = conn.cursor()
+            cursor.executemany(query, paramsList)
+            result = cursor.rowcount
 
+        except Exception as e:
+            print ('ERROR: ', e)
+            result = False
+            #lost connection? don't reuse it
+            if isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+                self.drop(database)
+
+        finally:
+            if cursor: cursor.close()
+
+        return result
@@ -14,12 +14,13 @@ import importlib
 from dep_obtain import dep_obtain
 from dep_locate import dep_locate
 from dep_add import dep_add
-from dep_dqa import dep_dqa
+from dep_dqa import dep_dqa, remake_metadata
 from dep_drp import dep_drp
 from dep_tar import dep_tar
 from koaxfr import koaxfr
 from send_email import send_email
 from common import *
+from tpx_updater import TpxUpdater
 import re
 import datetime as dt
 from dateutil import parser
@@ -124,14 +125,17 @@ class Dep:
             update_koatpx(self.instrObj.instr, self.instrObj.utDate, 'start_time', utcTimestamp, self.instrObj.log)
 
 
-        #run each step in order
+        #run each step in order (dqa can just remake metadata from existing lev0 files)
+        remakeMeta = int(self.config.get('MISC', {}).get('REMAKE_META', 0))
         for step in steps:
             self.instrObj.log.info('*** RUNNING DEP PROCESS STEP: ' + step + ' ***')
 
             if   step == 'obtain': dep_obtain(self.instrObj)
             elif step == 'locate': dep_locate(self.instrObj, self.tpx)
             elif step == 'add'   : dep_add(self.instrObj)
-            elif step == 'dqa'   : dep_dqa(self.instrObj, self.tpx)
+            elif step == 'dqa'   :
+                if remakeMeta: remake_metadata(self.instrObj)
+                else         : dep_dqa(self.instrObj, self.tpx)
             elif step == 'lev1'  : dep_drp(self.instrObj, step, self.tpx)
             elif step == 'tar'   : dep_tar(self.instrObj, self.tpx)
             elif step == 'koaxfr': koaxfr(self.instrObj, self.tpx)
@@ -165,8 +169,8 @@ class Dep:
         """
 
         self.instrObj.log.info('dep: verifying if can proceed')
-        query = f'select utdate as num from koatpx where instr="{self.instr}" and utdate="{self.utDate}"'
-        data = self.db.query('koa', query)
+        query = 'select utdate as num from koatpx where instr=%s and utdate=%s'
+        data = self.db.query('koa', query, params=(self.instr, self.utDate))
 #todo: test this
         if data is False:
             raise Exception('dep: could not query koa database. EXITING!')
@@ -276,6 +280,12 @@ class Dep:
         else:
             for result in results:
                 self.instrObj.log.info(result['compare'])
+                rows = result['rows']
+                self.instrObj.log.info(f"Meta compare: {rows['compared']} KOAIDs compared, "
+                                       f"{len(rows['diffCounts'])} with diffs, "
+                                       f"{len(rows['onlyInBase'])} only in MD0, {len(rows['onlyInOther'])} only in MD1")
+                for col, count in result['columns']['diffCounts'].items():
+                    self.instrObj.log.info(f'Meta compare: col "{col}": {count} diffs')
                 for warn in result['warnings']:
                     self.instrObj.log.warning(warn)
 
@@ -295,6 +305,7 @@ class Dep:
         count = 0
         errCount = 0
         warnCount = 0
+        timeoutCount = 0
         logOutFile = self.instrObj.log.handlers[0].baseFilename
         with open(logOutFile, 'r') as log:
             for line in log:
@@ -307,6 +318,7 @@ class Dep:
                     pos = line.upper().find('ERROR')
                     logStr += str(count) + ': ' + line[pos:].strip() + "\n"
                     errCount += 1
+                    if 'LOCATE TIMEOUT' in line: timeoutCount += 1
                 elif re.search('PROGID COUNT', line, re.IGNORECASE):
                     pos = line.find('PROGID COUNT') + 14
                     progStr += line[pos:].strip() + "\n"
@@ -316,6 +328,7 @@ class Dep:
         subject = ''
         if (errCount  > 0): subject += '(ERR:'  + str(errCount) + ')'
         if (warnCount > 0): subject += '(WARN:' + str(warnCount) + ')'
+        if (timeoutCount > 0): subject += '(LOCATE TIMEOUT)'
         subject += ' DEP : ' + self.instrObj.instr + ' ' + self.instrObj.utDate
 
 
@@ -356,8 +369,10 @@ class Dep:
         if self.tpx:
             self.instrObj.log.info('Updating KOA database with error status.')
             utcTimestamp = dt.datetime.utcnow().strftime("%Y%m%d %H:%M")
-            update_koatpx(instr, utDate, 'arch_stat', "ERROR", log)
-            update_koatpx(instr, utDate, 'arch_time', utcTimestamp, log)
+            tpxUpdater = TpxUpdater(instr, utDate, log)
+            tpxUpdater.set('arch_stat', "ERROR")
+            tpxUpdater.set('arch_time', utcTimestamp)
+            tpxUpdater.flush()
 
         #exit program
         self.instrObj.log.info('EXITING DEP!')
@@ -15,13 +15,16 @@ import getProgInfo as gpi
 from create_prog import *
 import shutil
 from common import *
+from tpx_updater import TpxUpdater
 from datetime import datetime as dt
 import metadata
 import re
+import json
 import hashlib
 import configparser
 from astropy.io import fits
 import update_koapi_send
+import ipac_table
 
 
 def dep_dqa(instrObj, tpx=0):
@@ -87,13 +90,21 @@ def dep_dqa(instrObj, tpx=0):
 
     #determine program info
     create_prog(instrObj)
-    progData = gpi.getProgInfo(utDate, instr, dirs['stage'], useHdrProg, splitTime, log)
+    progData = gpi.getProgInfo(utDate, instr, dirs['stage'], useHdrProg, splitTime, log, 
+                               schedule=instrObj.get_obtain_schedule())
 
 
     # Start the PSFR process
     instrObj.run_psfr()
 
 
+    #extension tables are written per file below while the HDU list is open
+    makeExtTables = (instr.upper() != 'KCWI')
+    extFiles = []
+    if makeExtTables:
+        removeFilesByWildcard(dirs['lev0'] + '/*.ext*.table')
+
+
     # Loop through each entry in input_list
     log.info('dep_dqa.py: Processing {} files'.format(len(files)))
     for filename in files:
@@ -119,12 +130,19 @@ def dep_dqa(instrObj, tpx=0):
 
         #keep list of good fits filenames
         procFiles.append(instrObj.fitsFilepath)
-        inFiles.append(os.path.basename(instrObj.fitsFilepath))
+        #raw file name as .fits (LOCATE KEEP_GZ leaves stage copies as .fits.gz)
+        inFiles.append(os.path.basename(instrObj.fitsFilepath).replace('.fits.gz', '.fits'))
         koaid = instrObj.fitsHeader.get('KOAID')
         if koaid.startswith('NC'): koaid = '/'.join(('scam', koaid))
         elif koaid.startswith('NS'): koaid = '/'.join(('spec', koaid))
         outFiles.append(koaid)
 #        outFiles.append(instrObj.fitsHeader.get('KOAID'))
+
+        #write extension tables to lev0 dir, only for files directly in lev0 (as before,
+        #NIRSPEC scam/spec subdir files get none)
+        if makeExtTables and '/' not in koaid:
+            extFiles += write_fits_extension_tables(instrObj.fitsHdu, instrObj.fitsHeader.get('KOAID'),
+                                                    outDir=dirs['lev0'], log=log)
         semids.append(instrObj.get_semid())
 
         #stats
@@ -165,12 +183,16 @@ def dep_dqa(instrObj, tpx=0):
     ymd = utDate.replace('-', '')
     metaOutFile =  dirs['lev0'] + '/' + ymd + '.metadata.table'
     keywordsDefFile = tablesDir + f'/KOA_{instr.upper()}_Keyword_Table.txt'
+    #NOTE: no metadata index here, every lev0 file was just rewritten with a new DQA_DATE
     metadata.make_metadata( keywordsDefFile, metaOutFile, dirs['lev0'], extraMeta=extraMeta, 
-                            dev=isDev, keyskips=instrObj.keywordSkips, create_md5=True)    
+                            dev=isDev, keyskips=instrObj.keywordSkips, create_md5=True)
+
+    #keep extra metadata for metadata-only re-runs (see remake_metadata)
+    save_extra_meta(dirs['stage'] + '/' + ymd + '.metadata.extra.json', extraMeta)
 
-    if instr.upper() != 'KCWI':
-        #Create the extension files
-        make_fits_extension_metadata_files(dirs['lev0']+ '/', md5Prepend=utDateDir+'.', log=log)
+    #Create the extension tables md5sum file
+    if makeExtTables:
+        make_ext_md5_table(dirs['lev0'], extFiles, md5Prepend=utDateDir+'.', log=log)
 
 
     #Create yyyymmdd.FITS.md5sum.table
@@ -195,10 +217,12 @@ def dep_dqa(instrObj, tpx=0):
     if tpx:
         log.info('dep_dqa.py: updating tpx DB records')
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instr, utDate, 'files_arch', str(len(procFiles)), log)
-        update_koatpx(instr, utDate, 'pi', piList, log)
-        update_koatpx(instr, utDate, 'sdata', sdataList, log)
-        update_koatpx(instr, utDate, 'sci_files', str(sciFiles), log)
+        tpxUpdater = TpxUpdater(instr, utDate, log)
+        tpxUpdater.set('files_arch', str(len(procFiles)))
+        tpxUpdater.set('pi', piList)
+        tpxUpdater.set('sdata', sdataList)
+        tpxUpdater.set('sci_files', str(sciFiles))
+        tpxUpdater.flush()
 
 
     #update koapi_send for all unique semids
@@ -212,9 +236,62 @@ def dep_dqa(instrObj, tpx=0):
     log.info('dep_dqa.py DQA Successful for {}'.format(instr))
 
 
+def remake_metadata(instrObj):
+    """
+    Regenerates the night's metadata table from the existing lev0 files without
+    re-running DQA (ie after fixing a few lev0 files or the keyword definitions).
+    Uses the extra metadata saved by dep_dqa and a sidecar index in the stage dir,
+    so only rows whose file, extra metadata or keyword definitions changed are
+    re-derived.  The FITS.md5sum.table is rewritten from the md5s in the index.
+
+    Usage: dep_go.py INSTR DATE 0 dqa dqa --remakeMeta 1
+
+    @type instrObj: instrument
+    @param instr: The instrument object
+    """
+    instr  = instrObj.instr
+    log    = instrObj.log
+    dirs   = instrObj.dirs
+    ymd    = instrObj.utDate.replace('-', '').replace('/', '')
+    isDev  = int(instrObj.config['RUNTIME']['DEV'])
+    log.info('dep_dqa.py: remaking metadata for {} {} from existing lev0 files'.format(instr, instrObj.utDate))
+
+    extraFile = dirs['stage'] + '/' + ymd + '.metadata.extra.json'
+    if not os.path.isfile(extraFile):
+        raise Exception('dep_dqa.py: {} not found, run dqa first.  EXITING.'.format(extraFile))
+    with open(extraFile, 'r') as f:
+        extraMeta = json.load(f)
+
+    metaOutFile = dirs['lev0'] + '/' + ymd + '.metadata.table'
+    keywordsDefFile = instrObj.metadataTablesDir + f'/KOA_{instr.upper()}_Keyword_Table.txt'
+    indexFile = dirs['stage'] + '/' + ymd + '.metadata.index.json'
+    metadata.make_metadata( keywordsDefFile, metaOutFile, dirs['lev0'], extraMeta=extraMeta,
+                            dev=isDev, keyskips=instrObj.keywordSkips, create_md5=True,
+                            indexFile=indexFile)
+
+    #FITS md5sum table from the index (same format as make_dir_md5_table)
+    with open(indexFile, 'r') as f:
+        index = json.load(f)
+    md5Outfile = dirs['lev0'] + '/' + instrObj.utDateDir + '.FITS.md5sum.table'
+    log.info('dep_dqa.py creating {}'.format(md5Outfile))
+    with open(md5Outfile, 'w') as fp:
+        for path in sorted(index['files']):
+            fp.write(index['files'][path]['md5'] + '  ' + os.path.relpath(path, dirs['lev0']) + '\n')
+
+
+def save_extra_meta(filepath, extraMeta):
+    '''Writes the extra metadata by KOAID as JSON (numpy values as python values).'''
+    def to_json(val):
+        return val.item() if hasattr(val, 'item') else str(val)
+    with open(filepath, 'w') as f:
+        json.dump(extraMeta, f, default=to_json)
+
+
 def make_fits_extension_metadata_files(inDir='./', outDir=None, endsWith='.fits', log=None, md5Prepend=''):
     '''
     Creates IPAC ASCII formatted data files for any extended header data found.
+    NOTE: dep_dqa now creates these per file while each HDU list is open (see
+    write_fits_extension_tables).  This standalone version is for reprocessing a dir.
     '''
     #todo: put in warnings for empty ext headers
 
@@ -234,74 +311,71 @@ def make_fits_extension_metadata_files(inDir='./', outDir=None, endsWith='.fits'
             filepaths.append(inDir + '/' + file)
 
     #for each file, read extensions and write to file
-    hduNames = []
     extFullList = []
     for filepath in filepaths:
-            file = os.path.basename(filepath)
-            hdus = fits.open(filepath)
-            for i in range(0, len(hdus)):
-                #wrap in try since some ext headers have been found to be corrupted
+        hdus = fits.open(filepath)
+        extFullList += write_fits_extension_tables(hdus, filepath, outDir, endsWith, log)
+        hdus.close()
+
+    #Create ext.md5sum.table
+    make_ext_md5_table(outDir, extFullList, md5Prepend, log)
+
+
+def write_fits_extension_tables(hdus, filepath, outDir=None, endsWith='.fits', log=None):
+    '''
+    Writes an IPAC ASCII table for each table extension in an open HDU list.
+    Output files are named after the basename of 'filepath' (ie the KOAID).
+
+    @param hdus: open FITS HDU list
+    @param filepath: FITS filepath the tables are named after
+    @param outDir: output dir (defaults to dir of filepath)
+    @return: list of table filepaths written
+    '''
+    file = os.path.basename(filepath)
+    if outDir == None: outDir = os.path.dirname(filepath)
+    if not outDir.endswith('/'): outDir += '/'
+
+    extList = []
+    for i in range(0, len(hdus)):
+        #wrap in try since some ext headers have been found to be corrupted
+        try:
+            hdu = hdus[i]
+            if 'TableHDU' not in str(type(hdu)): continue
+            if hdu.name == 'Exposure Events': continue
+
+            #calc col widths
+            cols = []
+            for idx, colName in enumerate(hdu.data.columns.names):
                 try:
-                    hdu = hdus[i]
-                    if 'TableHDU' not in str(type(hdu)): continue
-                    if hdu.name == 'Exposure Events': continue
-
-                    #keep track of hdu names processed
-                    if hdu.name not in hduNames: hduNames.append(hdu.name)
-
-                    #calc col widths
-                    dataStr = ''
-                    colWidths = []
-                    for idx, colName in enumerate(hdu.data.columns.names):
-                        try:
-                            fmtWidth = int(hdu.data.formats[idx][1:])
-                        except:
-                            fmtWidth = int(hdu.data.formats[idx][:-1])
-                            if fmtWidth < 16: fmtWidth = 16
-                        colWidth = max(fmtWidth, len(colName))
-                        colWidths.append(colWidth)
-
-                    #add hdu name as comment
-                    dataStr += '\ Extended Header Name: ' + hdu.name + "\n"
-
-                    #add header
-                    #TODO: NOTE: Found that all ext data is stored as strings regardless of type it seems to hardcoding to 'char' for now.
-                    for idx, cw in enumerate(colWidths):
-                        dataStr += '|' + hdu.data.columns.names[idx].ljust(cw)
-                    dataStr += "|\n"
-                    for idx, cw in enumerate(colWidths):
-                        dataStr += '|' + 'char'.ljust(cw)
-                    dataStr += "|\n"
-                    for idx, cw in enumerate(colWidths):
-                        dataStr += '|' + ''.ljust(cw)
-                    dataStr += "|\n"
-                    for idx, cw in enumerate(colWidths):
-                        dataStr += '|' + ''.ljust(cw)
-                    dataStr += "|\n"
-
-                    #add data rows
-                    for j in range(0, len(hdu.data)):
-                        row = hdu.data[j]
-                        for idx, cw in enumerate(colWidths):
-                            valStr = row[idx]
-                            dataStr += ' ' + str(valStr).ljust(cw)
-                        dataStr += "\n"
-
-                    #write to outfile
-                    outFile = file.replace(endsWith, '.ext' + str(i) + '.' + hdu.name + '.tbl')
-                    outFilepath = outDir + outFile
-                    extFullList.append(outFilepath)
-                    with open(outFilepath, 'w') as f:
-                        f.write(dataStr)
+                    fmtWidth = int(hdu.data.formats[idx][1:])
                 except:
-                    if log: log.error(f'Could not create extended header table for ext header index {i} for file {file}!')
+                    fmtWidth = int(hdu.data.formats[idx][:-1])
+                    if fmtWidth < 16: fmtWidth = 16
+                #TODO: NOTE: Found that all ext data is stored as strings regardless of type it seems to hardcoding to 'char' for now.
+                cols.append(ipac_table.make_col(colName, 'char', fmtWidth))
 
+            #get data column-wise (formatted as whole columns by ipac_table)
+            columns = [hdu.data.field(idx) for idx in range(len(cols))]
 
-    #Create ext.md5sum.table
-    if len(extFullList) > 0:
-        md5Outfile = outDir + md5Prepend + 'ext.md5sum.table'
-        if log: log.info('dep_dqa.py creating {}'.format(md5Outfile))
-        make_dir_md5_table(outDir, None, md5Outfile, regex='.ext\d')
+            #write to outfile (with hdu name as comment)
+            outFile = file.replace(endsWith, '.ext' + str(i) + '.' + hdu.name + '.tbl')
+            outFilepath = outDir + outFile
+            ipac_table.write_table(outFilepath, cols, columns=columns, comments=['Extended Header Name: ' + hdu.name])
+            extList.append(outFilepath)
+        except:
+            if log: log.error(f'Could not create extended header table for ext header index {i} for file {file}!')
+    return extList
+
+
+def make_ext_md5_table(outDir, extFullList, md5Prepend='', log=None):
+    '''
+    Creates the ext.md5sum.table from the list of extension tables written.
+    '''
+    if len(extFullList) == 0: return
+    if not outDir.endswith('/'): outDir += '/'
+    md5Outfile = outDir + md5Prepend + 'ext.md5sum.table'
+    if log: log.info('dep_dqa.py creating {}'.format(md5Outfile))
+    make_dir_md5_table(outDir, None, md5Outfile, fileList=sorted(extFullList))
 
 
 
@@ -378,8 +452,10 @@ def notify_zero_files(instrObj, dqaFile, tpx, log):
     if tpx:
         log.info('dep_dqa.py: updating tpx DB records')
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instrObj.instr, instrObj.utDate, 'arch_stat', 'DONE', log)
-        update_koatpx(instrObj.instr, instrObj.utDate, 'arch_time', utcTimestamp, log)
+        tpxUpdater = TpxUpdater(instrObj.instr, instrObj.utDate, log)
+        tpxUpdater.set('arch_stat', 'DONE')
+        tpxUpdater.set('arch_time', utcTimestamp)
+        tpxUpdater.flush()
 
 
 
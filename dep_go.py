@@ -23,10 +23,12 @@ parser.add_argument('procStop'      , type=str, nargs='?', default=None,    help
 parser.add_argument('--searchDir'   , type=str, nargs='?', const=None,      help='(OPTIONAL) Directory to search (recursively) for FITS files.  Default search dirs are defined in instrument class files.')
 parser.add_argument('--reprocess'   , type=str, nargs='?', const=None,      help='(OPTIONAL) Set to "1" to indicate reprocessing old data (skips certain locate/search checks)')
 parser.add_argument('--modtimeOverride' , type=str, nargs='?', const=None,  help='(OPTIONAL) Set to "1" to ignore modtime on files during FITS locate search.')
+parser.add_argument('--stageMode'   , type=str, nargs='?', const=None,      help='(OPTIONAL) How locate stages files: "copy" (default), "hardlink", "reflink" or "symlink-readonly".')
 parser.add_argument('--metaCompareDir'  , type=str, nargs='?', const=None,  help='(OPTIONAL) Directory to use for special metadata compare report for reprocessing old data.')
 parser.add_argument('--useHdrProg'  , type=str, nargs='?', const=None,      help='(OPTIONAL) Set to "force" to force header val if different.  Set to "assist" to use only if indeterminate (useful for processing old data).')
 parser.add_argument('--splitTime'   , type=str, nargs='?', const=None,      help='(OPTIONAL) HH:mm of suntimes midpoint for overriding split night timing.')
 parser.add_argument('--emailReport' , type=str, nargs='?', default="0",       help='(OPTIONAL) Set to "1" to send email report whether or not it is a full run')
+parser.add_argument('--remakeMeta'  , type=str, nargs='?', const=None,      help='(OPTIONAL) Set to "1" to have the dqa step only remake the metadata table from existing lev0 files (only changed files are re-read).')
 parser.add_argument('--assignProgname' , type=str, nargs='?', default='',    help='(OPTIONAL) Force assign all data to provided progname (ie U190 or 2020A_U190). Can use split time str like "U205,10:21:00,C251"')
 
 # Get input params
@@ -45,10 +47,12 @@ assignProgname = args.assignProgname
 configArgs = []
 if args.searchDir      : configArgs.append({'section':'LOCATE', 'key':'SEARCH_DIR',         'val': args.searchDir})
 if args.modtimeOverride: configArgs.append({'section':'LOCATE', 'key':'MODTIME_OVERRIDE',   'val': args.modtimeOverride})
+if args.stageMode      : configArgs.append({'section':'LOCATE', 'key':'STAGE_MODE',         'val': args.stageMode})
 if args.reprocess      : configArgs.append({'section':'MISC',   'key':'REPROCESS',          'val': args.reprocess})
 if args.metaCompareDir : configArgs.append({'section':'MISC',   'key':'META_COMPARE_DIR',   'val': args.metaCompareDir})
 if args.useHdrProg     : configArgs.append({'section':'MISC',   'key':'USE_HDR_PROG',       'val': args.useHdrProg})
 if args.splitTime      : configArgs.append({'section':'MISC',   'key':'SPLIT_TIME',         'val': args.splitTime})
+if args.remakeMeta     : configArgs.append({'section':'MISC',   'key':'REMAKE_META',        'val': args.remakeMeta})
 configArgs.append({'section':'MISC',   'key':'EMAIL_REPORT',       'val': args.emailReport})
 configArgs.append({'section':'MISC',   'key':'ASSIGN_PROGNAME',    'val': args.assignProgname})
 
@@ -16,14 +16,19 @@
 import calendar as cal               ## Used to convert a time object into a number of seconds
 import time as t                     ## Used to convert a string date into a time object
 from astropy.io import fits          ## Used for everything with fits
-from common import update_koatpx 
+from tpx_updater import TpxUpdater
 import os
 import shutil
 from sys import argv
 from datetime import datetime as dt, timedelta
 import gzip
 import shutil
-import subprocess
+from sdata_inventory import SdataInventory
+from timed_crawl import TimedCrawler
+import locate_watch
+import stage_copy
+from header_cache import HeaderCache
+import fits_scan
 
 
 
@@ -47,9 +52,10 @@ def dep_locate(instrObj, tpx=0):
     stageDir = instrObj.dirs['stage']
 
 
-    #Find sdata dirs list. Return if none found.
+    #Find sdata dirs list (dir checks that time out are reported with the crawl's). Return if none found.
+    failedDirs = []
     if ('SEARCH_DIR' in instrObj.config['LOCATE']): useDirs = [instrObj.config['LOCATE']['SEARCH_DIR']]
-    else                                          : useDirs = instrObj.get_dir_list()
+    else                                          : useDirs = instrObj.get_search_dirs(failedDirs)
     if len(useDirs) == 0:
         log.error('dep_locate: Did not find any directories to search!')
         return
@@ -64,7 +70,19 @@ def dep_locate(instrObj, tpx=0):
     # Find the files in the last 24 hours
     log.info('Looking for FITS files in {}'.format(useDirs))
     modtimeOverride = int(instrObj.config['LOCATE']['MODTIME_OVERRIDE']) if 'MODTIME_OVERRIDE' in instrObj.config['LOCATE'] else 0
-    filePaths = find_24hr_fits(useDirs, instrObj.utDate, instrObj.endTime, modtimeOverride)
+    crawlThreads = int(instrObj.config['LOCATE']['CRAWL_THREADS']) if 'CRAWL_THREADS' in instrObj.config['LOCATE'] else 8
+    inventoryFile = None
+    if 'INVENTORY_DIR' in instrObj.config['LOCATE']:
+        inventoryFile = ''.join((instrObj.config['LOCATE']['INVENTORY_DIR'], '/', instr, '.inventory.sqlite'))
+    watchDir = None
+    if int(instrObj.config['LOCATE'].get('USE_WATCH', 0)) == 1:
+        watchDir = locate_watch.get_watch_dir(instrObj.rootDir, instr)
+    crawlTimeout = float(instrObj.config['LOCATE']['CRAWL_TIMEOUT']) if 'CRAWL_TIMEOUT' in instrObj.config['LOCATE'] else 120
+    crawlRetries = int(instrObj.config['LOCATE']['CRAWL_RETRIES'])   if 'CRAWL_RETRIES' in instrObj.config['LOCATE'] else 1
+    filePaths = find_24hr_fits(useDirs, instrObj.utDate, instrObj.endTime, modtimeOverride, crawlThreads, 
+                               inventoryFile, log, watchDir, crawlTimeout, crawlRetries, failedDirs)
+    if failedDirs:
+        log.error('dep_locate: LOCATE TIMEOUT, files in these dirs were not found: {}'.format(failedDirs))
 
 
     #write filepaths to outfile
@@ -75,48 +93,68 @@ def dep_locate(instrObj, tpx=0):
 
 
     # Read presortFile list and do some more filtering before we do final copy to staging.
+    sources = []
+    with open(presort1File, 'r') as pre:
+        for line in pre:
+            if ('.fits' in line 
+                    and ('/fcs' not in line  or 'storageserver' in line) 
+                    and 'mira' not in line 
+                    and 'savier-protected' not in line 
+                    and 'SPEC/ORP/' not in line
+                    and '/subtracted' not in line
+                    and 'idf' not in line):
+                sources.append(line.strip())
+
+
+    # Copy the files to stageDir (pooled) and update files to use local copy file list
+    copyThreads = int(instrObj.config['LOCATE']['COPY_THREADS']) if 'COPY_THREADS' in instrObj.config['LOCATE'] else 4
+    copyMd5     = int(instrObj.config['LOCATE']['COPY_MD5'])     if 'COPY_MD5'     in instrObj.config['LOCATE'] else 0
+    stageMode   = instrObj.config['LOCATE']['STAGE_MODE']        if 'STAGE_MODE'   in instrObj.config['LOCATE'] else 'copy'
+    log.info('dep_locate: staging {} files to {} ({}, {} threads)'.format(len(sources), stageDir, stageMode, copyThreads))
+    results = stage_copy.copy_files([(src, ''.join((stageDir, src))) for src in sources], copyThreads, copyMd5, log, stageMode)
+    stageFiles = [[r] for r in results]
+
+    #a file we could not stage would be missing from the night, so stop here (errors logged by stage_copy)
+    failed = [r['source'] for r in results if not r['ok']]
+    if failed:
+        raise Exception('dep_locate: could not stage {} of {} files: {}'.format(len(failed), len(results), failed))
+
+    #special DEIMOS step (read FCS config name from local stage copy)
+    #todo: move this to instr class?
+    if 'DEIMOS' in instr:
+        fcsConfigs = []
+        fcsCopies = []
+        for files in stageFiles:
+            if not files[0]['ok']: continue
+            try:
+                fcs = fits.getheader(files[0]['dest'])['FCSIMGFI']
+                if fcs != '' and fcs not in fcsConfigs:
+                    fcsConfigs.append(fcs)
+                    if '/s/' not in fcs:
+                        fcs = '/s' + fcs
+                    fcsCopies.append((files, fcs))
+            except:
+                pass
+        fcsResults = stage_copy.copy_files([(fcs, ''.join((stageDir, fcs))) for files, fcs in fcsCopies], copyThreads, copyMd5, log, stageMode)
+        for (files, fcs), result in zip(fcsCopies, fcsResults):
+            files.append(result)
+        del fcsConfigs
+
     with open(presort2File, 'w') as f:
-        with open(presort1File, 'r') as pre:
-            fcsConfigs = []
-            for line in pre:
-                if ('.fits' in line 
-                        and ('/fcs' not in line  or 'storageserver' in line) 
-                        and 'mira' not in line 
-                        and 'savier-protected' not in line 
-                        and 'SPEC/ORP/' not in line
-                        and '/subtracted' not in line
-                        and 'idf' not in line):
-
-                    # Copy the files to stageDir and update files 
-                    # to use local copy file list
-                    newFile = ''.join((stageDir, line.strip()))
-                    log.info('copying file {} to {}'.format(line.strip(), newFile))                    
-                    copy_file(line.strip(), newFile)
-                    toFile = ''.join((newFile, '\n'))
-                    f.write(toFile)
-
-                    #special DEIMOS step
-                    #todo: move this to instr class?
-                    if 'DEIMOS' in instr:
-                        try:
-                            fcs = fits.getheader(line.strip())['FCSIMGFI']
-                            if fcs != '' and fcs not in fcsConfigs:
-                                fcsConfigs.append(fcs)
-                                if '/s/' not in fcs:
-                                    fcs = '/s' + fcs
-                                newFile = ''.join((stageDir, fcs))
-                                copy_file(fcs, newFile)
-                                toFile = ''.join((newFile, '\n'))
-                                f.write(toFile)
-                        except:
-                            pass
-            del fcsConfigs
+        for files in stageFiles:
+            for result in files:
+                if not result['ok']: continue
+                if result['copied']:
+                    md5 = ', md5 ' + result['md5'] if result['md5'] else ''
+                    log.info('staged file {} to {} ({}{})'.format(result['source'], result['dest'], result['method'], md5))
+                f.write(result['dest'] + '\n')
 
 
     # Verify the files are valid - no corrupt headers, valid KOAID
     isReprocess = int(instrObj.config['MISC']['REPROCESS']) if 'REPROCESS' in instrObj.config['MISC'] else 0
     locateFile = stageDir +'/dep_locate' + instr + '.txt'
-    dep_rawfiles(instr, utDate, presort2File, locateFile, ancDir, isReprocess, log)
+    keepGz = int(instrObj.config['LOCATE']['KEEP_GZ']) if 'KEEP_GZ' in instrObj.config['LOCATE'] else 0
+    dep_rawfiles(instr, utDate, presort2File, locateFile, ancDir, isReprocess, log, copyThreads, keepGz)
 
 
     #log completion with count
@@ -127,18 +165,20 @@ def dep_locate(instrObj, tpx=0):
     #update koatpx
     if tpx:
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instr, utDate, 'files', str(num), log)
-        update_koatpx(instr, utDate, 'ondisk_stat', 'DONE', log)
-        update_koatpx(instr, utDate, 'ondisk_time', utcTimestamp, log)
+        tpxUpdater = TpxUpdater(instr, utDate, log)
+        tpxUpdater.set('files', str(num))
+        tpxUpdater.set('ondisk_stat', 'DONE')
+        tpxUpdater.set('ondisk_time', utcTimestamp)
+        tpxUpdater.flush()
 
 
 #-----------------------END DEP LOCATE----------------------------------
 
 
-def copy_file(source, destination):
+def copy_file(source, destination, stageMode='copy'):
     '''
     Copy source file to destination.  If destination directory does nott
-    exist, then create it.
+    exist, then create it.  See stage_copy.py for stageMode options.
 
     @type source: string
     @param source: The source file path
@@ -146,14 +186,10 @@ def copy_file(source, destination):
     @param destination: The destination file path
     '''
 
-    rDir = os.path.dirname(destination)
-    if not os.path.exists(rDir):
-        os.makedirs(rDir)
-    if not os.path.exists(destination):
-        shutil.copy2(source, destination)
+    stage_copy.copy_file(source, destination, mode=stageMode)
 
 
-def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
+def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log, numThreads=4, keepGz=0):
     """
     This function will remove empty, corrupt, and non-raw fits files
     and create a new outFile list.
@@ -174,6 +210,12 @@ def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
     @param ancDir: The anc directory to store the bad and corrupted fits files
     @type log: Logger Object
     @param log: The log handler for the script. Writes to the logfile
+    @type numThreads: int
+    @param numThreads: Number of .fits.gz files to decompress at once
+    @type keepGz: int
+    @param keepGz: If 1, leave .fits.gz files compressed (DQA reads them directly).
+                   This only affects staging: outFile lists the .fits.gz stage paths,
+                   names recorded by later steps (ie filelist.table) are still .fits.
     """
     log.info('dep_locate: starting rawfiles check: {0} {1} {2}'.format(instr, utDate, ancDir))
 
@@ -187,7 +229,9 @@ def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
             fitsList.append(line.strip())
 
     # Check the validity of each fits file (raw[i]=1 means good file)
+    # (keep the validated headers for the night header cache)
     goodFiles = []
+    goodHeaders = {}
     for i in range(len(fitsList)):
 
         #only do these checks if not a reprocessing job
@@ -198,16 +242,23 @@ def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
               copy_bad_file(instr, fitsList[i], ancDir, 'Empty File', log)
               continue
 
-          # Get fits header (check for bad header)
+          # Get fits header keywords (check for bad header)
+          # Try fast card scan first, fall back to astropy for anything unusual
           try:
-              if instr == 'NIRC2':
-                  header0 = fits.getheader(fitsList[i], ignore_missing_end=True)
-                  header0['INSTRUME'] = 'NIRC2'
-              else:
-                  header0 = fits.getheader(fitsList[i])
-          except:
-              copy_bad_file(instr, fitsList[i], ancDir, 'Unreadable Header', log)
-              continue
+              header0, headerStr = fits_scan.scan_header(fitsList[i], FILENAME_KEYWORDS)
+              if instr == 'NIRC2': header0['INSTRUME'] = 'NIRC2'
+          except Exception:
+              try:
+                  if instr == 'NIRC2':
+                      header0 = fits.getheader(fitsList[i], ignore_missing_end=True)
+                      headerStr = header0.tostring()
+                      header0['INSTRUME'] = 'NIRC2'
+                  else:
+                      header0 = fits.getheader(fitsList[i])
+                      headerStr = header0.tostring()
+              except:
+                  copy_bad_file(instr, fitsList[i], ancDir, 'Unreadable Header', log)
+                  continue
 
           # Construct the original file name
           filename, successful = construct_filename(instr, fitsList[i], ancDir, header0, log)
@@ -224,15 +275,26 @@ def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
 
         #if we make it here, it is a good good file!
         goodFiles.append(fitsList[i])
+        if not isReprocess: goodHeaders[fitsList[i]] = headerStr
 
 
-    #look for .gz fits to unzip
-    for i in range(len(goodFiles)):
-      filepath = goodFiles[i]
-      targetDir = os.path.dirname(filepath)
-      if filepath.endswith('.fits.gz'):
-            output = subprocess.call(['gunzip', filepath])
-            goodFiles[i] = filepath.replace(".fits.gz", ".fits")
+    #look for .gz fits to unzip (in-process, pooled)
+    if not keepGz:
+        gzFiles = [f for f in goodFiles if f.endswith('.fits.gz')]
+        if gzFiles: log.info('dep_locate: decompressing {} .fits.gz files'.format(len(gzFiles)))
+        unzipped = dict(zip(gzFiles, stage_copy.gunzip_files(gzFiles, numThreads, log)))
+        for filepath, outPath in unzipped.items():
+            if outPath is None:
+                copy_bad_file(instr, filepath, ancDir, 'Bad Gzip', log)
+        goodHeaders = {unzipped.get(f, f): h for f, h in goodHeaders.items()}
+        goodFiles = [unzipped.get(f, f) for f in goodFiles if unzipped.get(f, f)]
+
+
+    # Save validated headers for later steps (keyed by final stage path)
+    headerCache = HeaderCache(HeaderCache.get_cache_file(os.path.dirname(outFile), instr))
+    for path, headerStr in goodHeaders.items():
+        if path and path in goodFiles: headerCache.add(path, headerStr)
+    headerCache.save()
 
 
     # Create final dqa_<instr>.txt file with only the good lines from dep_locateINSTR.txt
@@ -278,6 +340,11 @@ def copy_bad_file(instr, fitsFile, ancDir, errorCode, log):
 #-------------End copy-bad-file()---------------------------
 
 
+#header keywords used by construct_filename
+FILENAME_KEYWORDS = ['INSTRUME', 'DATAFILE', 'OFNAME', 'OUTFILE', 'ROOTNAME', 'FILENAME',
+                     'IMGNUM', 'FRAMENUM', 'FRAMENO', 'FILENUM', 'FILENUM2']
+
+
 def construct_filename(instr, fitsFile, ancDir, keywords, log):
    """
     Constructs the original filename from the fits header keywords
@@ -371,20 +438,36 @@ def construct_filename(instr, fitsFile, ancDir, keywords, log):
 #---------------------End construct_filename-------------------------
 
 
-def find_24hr_fits(useDirs, utDate, endTime, modtimeOverride=0):
+def find_24hr_fits(useDirs, utDate, endTime, modtimeOverride=0, numThreads=8, inventoryFile=None, log=None,
+                   watchDir=None, timeout=None, retries=0, failedDirs=None):
     """
-    Uses the os.walk function to recurse through a given directory
-    and return all the leaf files which are checked to be
-    fits files.
-
-    @type useDirs: string
-    @param useDirs: The directory that we want to search in
+    Crawls the given directories (see crawl_fits_dirs) and returns all FITS
+    files modified in the 24 hours before utDate endTime, sorted by mod time.
+    If inventoryFile is given, the persistent sdata inventory is refreshed 
+    and queried instead (see sdata_inventory.py).  If watchDir is given and the
+    live watcher's manifest for the night is complete, it is used instead of
+    either (see locate_watch.py).
+
+    @type useDirs: list
+    @param useDirs: The directories that we want to search in
     @type utDate: datetime
     @param utDate: The date of observation of the files we want to search for
-    @type outfile: string
-    @param outfile: Where we want to store the output
-    @type log: Logger Object
-    @param log: The log handler for the script. Writes to the logfile
+    @type endTime: string
+    @param endTime: HH:MM:SS end of 24 hour window on utDate
+    @type modtimeOverride: int
+    @param modtimeOverride: If 1, return all FITS files regardless of mod time
+    @type numThreads: int
+    @param numThreads: Number of directories to scan concurrently
+    @type inventoryFile: string
+    @param inventoryFile: Optional SQLite inventory file path
+    @type watchDir: string
+    @param watchDir: Optional locate_watch manifest dir
+    @type timeout: float
+    @param timeout: Optional seconds allowed per dir scan before it is retried/skipped
+    @type retries: int
+    @param retries: Number of retries of a timed out dir scan before its root dir is skipped
+    @type failedDirs: list
+    @param failedDirs: Optional list to append root dirs that were skipped due to timeouts
     """
 
     # Break utDate into its pieces
@@ -408,30 +491,87 @@ def find_24hr_fits(useDirs, utDate, endTime, modtimeOverride=0):
     maxTimeSinceMod = cal.timegm(t.strptime(utMaxTime, '%Y%m%d %H:%M:%S'))
     minTimeSinceMod = cal.timegm(t.strptime(utMinTime, '%Y%m%d %H:%M:%S'))
 
-    # Iterate through the list of directories from the locate script to look for fits files
-    filePaths = []
-    for fitsDir in useDirs:
-        for root, dirs, files in os.walk(fitsDir):
-            for item in sorted(files):
-                if not item.endswith('.fits') and not item.endswith('fits.gz'): 
-                  continue
+    # Check to see if each fits file was created/modified in the last day. 
+    # st_mtime needs to be greater than the minTimeSinceMod to be within the past 24 hours
+    records = None
+    timedOut = []
+    if watchDir and modtimeOverride != 1:
+        records = locate_watch.get_manifest_records(watchDir, utDate, useDirs, minTimeSinceMod, maxTimeSinceMod, log,
+                                                    numThreads, timeout, retries, timedOut)
+    if records is None and inventoryFile:
+        inventory = SdataInventory(inventoryFile, log=log)
+        inventory.refresh(useDirs, numThreads, timeout, retries)
+        timedOut = inventory.failedDirs
+        findDirs = [d for d in useDirs if d not in timedOut]
+        if modtimeOverride == 1: records = inventory.find(findDirs)
+        else                   : records = inventory.find(findDirs, minTimeSinceMod, maxTimeSinceMod)
+        inventory.close()
+    if records is None:
+        records, timedOut = crawl_fits_dirs(useDirs, numThreads, timeout, retries, log)
+    if timedOut and failedDirs is not None:
+        failedDirs.extend(timedOut)
+
+    found = []
+    for fullPath, modTime, order in records:
+        if ( (modTime <= maxTimeSinceMod and modTime > minTimeSinceMod) or modtimeOverride == 1):
+            found.append((modTime, order, fullPath))
+
+    #sort all files by mod time (using mod time found during crawl)
+    #NOTE: This is important for getProgInfo to assign programs for split nights
+    #(and ensuring latter duplicates are kicked out instead of first original)
+    found.sort()
+    return [fullPath for modTime, order, fullPath in found]
 
-                # Create the path to the current file we want to check
-                if root.endswith('/'): root = root[:-1]
-                fullPath = ''.join((root, '/', item))
 
-                # Check to see if the file is a fits file created/modified in the last day. 
-                # st_mtime needs to be greater than the minTimeSinceMod to be within the past 24 hours
-                modTime = os.stat(fullPath).st_mtime
-                if ( (modTime <= maxTimeSinceMod and modTime > minTimeSinceMod) or modtimeOverride == 1):
-                    filePaths.append(fullPath)
+def crawl_fits_dirs(useDirs, numThreads=8, timeout=None, retries=0, log=None):
+    """
+    Recursively finds all .fits and .fits.gz files under the given directories.
+    Directories are scanned concurrently with os.scandir so each file is
+    stat'ed only once.  Like os.walk, symlinked dirs are not followed and
+    unreadable dirs are skipped.  If a dir scan takes longer than timeout secs
+    (ie hung NFS mount) and still does after the retries, that root dir is 
+    skipped (see timed_crawl.py).
+
+    Returns list of (path, mtime, order) where order is (root index, path) 
+    for a deterministic tie-break when sorting by mtime, and list of the root
+    dirs that timed out.
+    """
+    results = []
+    def handle(idx, task, result):
+        files, subDirs = result
+        for path, modTime in files:
+            results.append((path, modTime, (idx, path)))
+        return [(subDir,) for subDir in subDirs]
+
+    crawler = TimedCrawler(scan_fits_dir, numThreads, timeout, retries, log)
+    failed = crawler.run([(fitsDir,) for fitsDir in useDirs], handle)
+    failedDirs = [useDirs[idx] for idx in failed]
+    return [r for r in results if r[2][0] not in failed], failedDirs
 
-    #sort all files by mod time
-    #NOTE: This is important for getProgInfo to assign programs for split nights
-    #(and ensuring latter duplicates are kicked out instead of first original)
-    filePaths.sort(key=lambda p: os.stat(p).st_mtime)
 
-    return filePaths
+def scan_fits_dir(fitsDir):
+    """
+    Scans one directory.  Returns list of (fits path, mtime) and list of subdirs.
+    """
+    files = []
+    subDirs = []
+    if fitsDir.endswith('/') and len(fitsDir) > 1: fitsDir = fitsDir[:-1]
+    try:
+        entries = list(os.scandir(fitsDir))
+    except OSError:
+        return files, subDirs
+
+    for entry in sorted(entries, key=lambda e: e.name):
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink(): subDirs.append(entry.path)
+                continue
+            if not entry.name.endswith('.fits') and not entry.name.endswith('fits.gz'): 
+                continue
+            files.append((''.join((fitsDir, '/', entry.name)), entry.stat().st_mtime))
+        except OSError:
+            continue
+    return files, subDirs
 
 
 #-----------------------End find_24hr_fits-----------------------------------
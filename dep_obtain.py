@@ -1,5 +1,7 @@
 import os
 from datetime import datetime as dt, timedelta
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from common import get_api_data
 import subprocess
 
@@ -35,14 +37,40 @@ def dep_obtain(instrObj):
     notScheduledFile = ''.join((instrObj.dirs['stage'], '/dep_notsched', instrObj.instr, '.txt'))
     obtainFile       = ''.join((instrObj.dirs['stage'], '/dep_obtain', instrObj.instr, '.txt'))
 
+    # API request options (each request can take up to timeout * (retries+1) secs)
+    apiConfig = instrObj.config.get('API', {})
+    timeout = float(apiConfig['TIMEOUT']) if 'TIMEOUT' in apiConfig else 30
+    retries = int(apiConfig['RETRIES'])   if 'RETRIES' in apiConfig else 2
+    def get_data(url):
+        return get_api_data(url, timeout=timeout, retries=retries)
+
     try:
 
-        # Get OA
+        # Request night staff and schedule at once, then all observers at once
+        # (so obtain takes about as long as the slowest requests, not their sum)
 
         telnr = instrObj.get_telnr()
         oaUrl = ''.join((instrObj.telUrl, 'cmd=getNightStaff', '&date=', prevDate, '&telnr=', str(telnr), '&type=oa'))
-        log.info('dep_obtain: retrieving night staff info: {}'.format(oaUrl))
-        oaData = get_api_data(oaUrl)
+        instrBase = 'NIRSP' if (instrObj.instr == 'NIRSPEC') else instrObj.instr
+        schedUrl = ''.join((instrObj.telUrl, 'cmd=getSchedule', '&date=', prevDate, '&instr=', instrBase))
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            log.info('dep_obtain: retrieving night staff info: {}'.format(oaUrl))
+            oaFuture = pool.submit(get_data, oaUrl)
+            log.info('dep_obtain: retrieving telescope schedule info: {}'.format(schedUrl))
+            schedData = pool.submit(get_data, schedUrl).result()
+            if schedData and isinstance(schedData, dict): schedData = [schedData]
+
+            obsFutures = []
+            for entry in (schedData or []):
+                obsUrl = instrObj.telUrl + 'cmd=getObservers' + '&schedid=' + entry['SchedId']
+                log.info('dep_obtain: retrieving observers info: {}'.format(obsUrl))
+                obsFutures.append(pool.submit(get_data, obsUrl))
+            obsDatas = [future.result() for future in obsFutures]
+            oaData = oaFuture.result()
+
+        # Get OA
+
         oa = 'None'
         if oaData:
             if isinstance(oaData, dict):
@@ -53,14 +81,9 @@ def dep_obtain(instrObj):
                     if entry['Type'] == 'oa' or entry['Type'] == 'oar':
                         oa = entry['Alias']
 
-        # Read the telescope schedul URL
+        # Read the telescope schedule
         # No entries found: Create stageDir/dep_notschedINSTR.txt and dep_obtainINSTR.txt
 
-        instrBase = 'NIRSP' if (instrObj.instr == 'NIRSPEC') else instrObj.instr
-        schedUrl = ''.join((instrObj.telUrl, 'cmd=getSchedule', '&date=', prevDate, '&instr=', instrBase))
-        log.info('dep_obtain: retrieving telescope schedule info: {}'.format(schedUrl))
-        schedData = get_api_data(schedUrl)
-        if schedData and isinstance(schedData, dict): schedData = [schedData]
         if not schedData:
             log.info('dep_obtain: no telescope schedule info found for {}'.format(instrObj.instr))
 
@@ -75,13 +98,10 @@ def dep_obtain(instrObj):
         else:
             with open(obtainFile, 'w') as fp:
                 num = 0
-                for entry in schedData:
+                for entry, obsData in zip(schedData, obsDatas):
 
                     if entry['Account'] == '': entry['Account'] = '-'
 
-                    obsUrl = instrObj.telUrl + 'cmd=getObservers' + '&schedid=' + entry['SchedId']
-                    log.info('dep_obtain: retrieving observers info: {}'.format(obsUrl))
-                    obsData = get_api_data(obsUrl)
                     if obsData and len(obsData) > 0: observers = obsData[0]['Observers']
                     else                           : observers = 'None'
 
@@ -109,6 +129,9 @@ def dep_obtain(instrObj):
         log.info('dep_obtain: {} error reading telescope schedule'.format(instrObj.instr))
         return False
 
+    #new obtain file, drop any schedule already loaded from an older one
+    instrObj.obtainSchedule = None
+
     return True
 
 
@@ -150,3 +173,54 @@ def get_obtain_data(file):
             del row
 
     return data
+
+
+class ObtainSchedule:
+    '''
+    Read-only night schedule parsed once from an obtain output file (see 
+    get_obtain_data), shared by everything that needs the OA or programs.
+
+    Usage:
+        schedule = ObtainSchedule.load(obtainFile)
+        schedule.oa, schedule.programs, schedule.times
+    '''
+
+    def __init__(self, rows):
+        self._rows = tuple(MappingProxyType(dict(row)) for row in rows)
+
+    @classmethod
+    def load(cls, file):
+        return cls(get_obtain_data(file))
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_rows'): raise AttributeError('ObtainSchedule is read-only')
+        super().__setattr__(name, value)
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def rows(self):
+        '''All obtain rows (read-only), including the legacy "NONE" program row.'''
+        return self._rows
+
+    @property
+    def oa(self):
+        '''OA of the night or None.'''
+        return self._rows[0]['OA'] if self._rows else None
+
+    @property
+    def programs(self):
+        '''
+        New list of (mutable) program dicts, empty if only a blank (NONE) program
+        was scheduled (legacy).
+        '''
+        if len(self._rows) == 1 and self._rows[0]['ProjCode'] == 'NONE':
+            return []
+        return [dict(row) for row in self._rows]
+
+    @property
+    def times(self):
+        '''List of (StartTime, EndTime) of the programs.'''
+        return [(prog['StartTime'], prog['EndTime']) for prog in self.programs]
+
@@ -4,6 +4,7 @@ import tarfile
 import gzip
 import hashlib
 from common import *
+from tpx_updater import TpxUpdater
 from datetime import datetime as dt
 
 
@@ -83,9 +84,11 @@ def dep_tar(instrObj, tpx):
     if tpx:
         log.info('dep_dqa.py: updating tpx DB records')
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instr, utDate, 'arch_stat', 'DONE', log)
-        update_koatpx(instr, utDate, 'arch_time', utcTimestamp, log)       
-        update_koatpx(instr, utDate, 'size', get_directory_size(dirs['output']), log)
+        tpxUpdater = TpxUpdater(instr, utDate, log)
+        tpxUpdater.set('arch_stat', 'DONE')
+        tpxUpdater.set('arch_time', utcTimestamp)
+        tpxUpdater.set('size', get_directory_size(dirs['output']))
+        tpxUpdater.flush()
 
 
     log.info('dep_tar.py complete.')
@@ -0,0 +1,107 @@
+"""
+  Lightweight FITS primary header scanner.
+
+  Reads the primary header with mmap, one 80 char card at a time up to END, and
+  parses only the requested keywords (first occurrence, like astropy).  Raises
+  ScanFallback for anything it does not handle (gzipped files, missing SIMPLE or
+  END, non-ascii, long string CONTINUE cards, undefined or complex values) so the
+  caller can use astropy instead.
+
+  Usage:
+    try:
+        vals, headerStr = fits_scan.scan_header(filepath, ['OUTFILE', 'FRAMENO'])
+    except fits_scan.ScanFallback:
+        header = fits.getheader(filepath)
+"""
+import os
+import re
+import mmap
+
+
+CARD_LEN  = 80
+BLOCK_LEN = 2880
+END_CARD  = b'END' + b' ' * 77
+MAX_HEADER_LEN = 1000 * BLOCK_LEN   #no END by here: let astropy deal with it
+INT_RE    = re.compile(r'^[+-]?\d+$')
+
+
+class ScanFallback(Exception):
+    pass
+
+
+def scan_header(filepath, keywords):
+    '''
+    Returns (dict of requested keyword values found, primary header card string
+    up to and including END).  Missing keywords are not in the dict.
+    '''
+    if filepath.endswith('.gz'):
+        raise ScanFallback('gzipped file')
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < BLOCK_LEN:
+            raise ScanFallback('file smaller than one FITS block')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:9] != b'SIMPLE  =':
+                raise ScanFallback('no SIMPLE card')
+            end = find_end(mm, size)
+            raw = mm[:end]
+
+    try:
+        headerStr = raw.decode('ascii')
+    except UnicodeDecodeError:
+        raise ScanFallback('non-ascii header')
+
+    wanted = set(keywords)
+    vals = {}
+    for pos in range(0, len(headerStr), CARD_LEN):
+        key = headerStr[pos:pos+8].rstrip()
+        if key not in wanted or key in vals: continue
+        card = headerStr[pos:pos+CARD_LEN]
+        if card[8:10] != '= ':
+            raise ScanFallback(f'{key}: no value indicator')
+        vals[key] = parse_value(key, card[10:], headerStr[pos+CARD_LEN:pos+CARD_LEN+8])
+    return vals, headerStr
+
+
+def find_end(mm, size, maxLen=MAX_HEADER_LEN):
+    '''Returns offset just past the END card (must start on a card boundary).'''
+    stop = min(size, maxLen)
+    pos = mm.find(END_CARD, 0, stop)
+    while pos != -1:
+        if pos % CARD_LEN == 0: return pos + CARD_LEN
+        pos = mm.find(END_CARD, pos + 1, stop)
+    raise ScanFallback('no END card')
+
+
+def parse_value(key, field, nextKey):
+    '''Parses the value part of a card (cols 11-80) like astropy does for simple types.'''
+    text = field.lstrip()
+    if text.startswith("'"):
+        #string, '' is an escaped quote, trailing spaces are not significant
+        i = 1
+        chars = []
+        while i < len(text):
+            if text[i] == "'":
+                if text[i+1:i+2] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(text[i])
+            i += 1
+        else:
+            raise ScanFallback(f'{key}: unterminated string')
+        val = ''.join(chars).rstrip()
+        if val.endswith('&') and nextKey.startswith('CONTINUE'):
+            raise ScanFallback(f'{key}: long string')
+        return val
+
+    text = text.split('/', 1)[0].strip()
+    if text == 'T': return True
+    if text == 'F': return False
+    if INT_RE.match(text): return int(text)
+    try:
+        if re.search(r'\d', text) and text[0] != '(': return float(text.replace('D', 'E').replace('d', 'e'))
+    except ValueError:
+        pass
+    raise ScanFallback(f'{key}: unhandled value "{text}"')
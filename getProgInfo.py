@@ -33,15 +33,39 @@ import urllib.request as url
 import time
 import create_log as cl
 from common import *
-from dep_obtain import get_obtain_data
+from dep_obtain import ObtainSchedule
 from datetime import datetime, timedelta
 import re
 from astropy.io import fits
 
 
+class ProgData(list):
+    """
+    getProgInfo result: the list of file program info dicts, plus an index by
+    normalized file path so finding a file's program info is a dict lookup.
+    """
+
+    def __init__(self, rows=()):
+        super().__init__(rows)
+        self.index = {}
+        for row in self:
+            self.index.setdefault(os.path.normpath(row['file']), row)
+
+    def find(self, filepath):
+        """
+        Returns the program info dict for filepath or None.  Falls back to the old 
+        substring match if the path differs (ie has an extra prefix).
+        """
+        row = self.index.get(os.path.normpath(filepath))
+        if row is not None: return row
+        for progFile in self:
+            if progFile['file'] in filepath: return progFile
+        return None
+
+
 class ProgSplit:
 
-    def __init__(self, ut_date, instr, stage_dir, log=None):
+    def __init__(self, ut_date, instr, stage_dir, log=None, schedule=None):
         """
         Initialization function for the ProgSplit class
 
@@ -51,6 +75,8 @@ class ProgSplit:
         @param instr: Instrument that is being observed
         @type stage_dir: string
         @param stage_dir: directory we are moving processed files to
+        @type schedule: dep_obtain.ObtainSchedule
+        @param schedule: night schedule if already loaded (else read from dep_obtain file)
         """
 
         #save inputs
@@ -58,6 +84,7 @@ class ProgSplit:
         self.instrument = instr
         self.stageDir = stage_dir
         self.log = log
+        self.schedule = schedule
 
         #consts        
         self.instrList = {  'DEIMOS'    :2, 
@@ -150,6 +177,21 @@ class ProgSplit:
         if self.instrument not in self.instrList:
             raise Exception("progInfo - instrument name not valid: " + self.instrument)
 
+    def prefetch_programs(self):
+        """
+        This method fetches the program info for all semids in createprog.txt
+        (ToO outdirs) and the night's schedule at once (see prog_catalog.py)
+        """
+        catalog = get_prog_catalog(self.log)
+        semids = []
+        fname = self.stageDir +  '/createprog.txt'
+        if os.path.isfile(fname):
+            semids += catalog.get_createprog_semids(fname, self.semester)
+        obFile = self.stageDir + '/dep_obtain' + self.instrument + '.txt'
+        if self.schedule or os.path.isfile(obFile):
+            semids += catalog.get_obtain_semids(self.get_schedule().rows, self.semester)
+        catalog.fetch(semids)
+
     def read_file_list(self):
         """
         This method reads the list of files from the file list
@@ -413,19 +455,23 @@ class ProgSplit:
 
 #---------------------------- END ASSIGN SINGLE BY OBSERVER -------------------------------------------
 
+    def get_schedule(self):
+        """
+        This method returns the night schedule, read from the dep_obtain output file if not given
+        """
+        if self.schedule is None:
+            obFile = self.stageDir + '/dep_obtain' + self.instrument + '.txt'
+            self.schedule = ObtainSchedule.load(obFile)
+        return self.schedule
+
     def get_programs(self):
 
         """
         This method obtains the data from the dep_obtain output file
         """
 
-        #use obtain func
-        obFile = self.stageDir + '/dep_obtain' + self.instrument + '.txt'
-        self.programs = get_obtain_data(obFile)
-
-        #if only one program and it is blank, this is actually no programs (legacy)
-        if len(self.programs) == 1 and self.programs[0]['ProjCode'] == 'NONE':
-            self.programs = []
+        #use obtain schedule (no programs if only one blank program, legacy)
+        self.programs = self.get_schedule().programs
 
 #---------------------------------- END GET SCHEDULE VALUE------------------------------------
 
@@ -675,7 +721,7 @@ class ProgSplit:
 
 
 
-def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None, log=None, test=False):
+def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None, log=None, test=False, schedule=None):
 
     if test: 
         rootDir = stageDir.split('/stage')[0]
@@ -686,9 +732,10 @@ def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None,
     instrument = instrument.upper()
 
     #gather info
-    progSplit = ProgSplit(utdate, instrument, stageDir, log)
+    progSplit = ProgSplit(utdate, instrument, stageDir, log, schedule)
     progSplit.check_stage_dir()
     progSplit.check_instrument()
+    progSplit.prefetch_programs()
     progSplit.read_file_list()
 
     #get list of programs and determine if instrument split night
@@ -742,4 +789,4 @@ def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None,
 
     #return data written for convenience
     progSplit.log.info('getProgInfo: finished, {} created'.format(fname))
-    return progSplit.fileList
+    return ProgData(progSplit.fileList)
@@ -0,0 +1,94 @@
+"""
+  Per-night cache of the primary FITS headers validated by dep_locate.dep_rawfiles,
+  so later steps (create_prog) don't have to open and parse each file again.
+
+  Stored as a pickled dict in the stage dir (dep_headers<INSTR>.pkl):
+    {path: (mtime, size, header card string)}
+  A cached header is only returned if the file mtime and size still match.  Each
+  header is parsed at most once per cache object (get returns the same fits.Header
+  for a path, so edits to it are seen by later lookups).
+
+  LazyHDUList stands in for instrObj.fitsHdu when a cached header is used; the
+  FITS file is only opened if something accesses the HDUs (ie image data).
+"""
+import os
+import pickle
+from astropy.io import fits
+
+
+class HeaderCache:
+
+    def __init__(self, cacheFile):
+        self.cacheFile = cacheFile
+        self.headers = {}
+        self.parsed  = {}
+
+    @classmethod
+    def get_cache_file(cls, stageDir, instr):
+        return ''.join((stageDir, '/dep_headers', instr, '.pkl'))
+
+    @classmethod
+    def load(cls, stageDir, instr, log=None):
+        '''Loads cache for the night.  Returns an empty cache if not found/readable.'''
+        cache = cls(cls.get_cache_file(stageDir, instr))
+        if os.path.isfile(cache.cacheFile):
+            try:
+                with open(cache.cacheFile, 'rb') as f:
+                    cache.headers = pickle.load(f)
+            except Exception as e:
+                if log: log.warning('header_cache: could not load {}: {}'.format(cache.cacheFile, e))
+        return cache
+
+    def add(self, path, header):
+        '''Stores header (fits.Header or card string) for path with the file's current stats.'''
+        st = os.stat(path)
+        hdrStr = header if isinstance(header, str) else header.tostring()
+        self.headers[path] = (st.st_mtime, st.st_size, hdrStr)
+        if isinstance(header, str): self.parsed.pop(path, None)
+        else                      : self.parsed[path] = header
+
+    def get(self, path):
+        '''Returns fits.Header for path or None if not cached or the file changed.'''
+        entry = self.headers.get(path)
+        if not entry: return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if (st.st_mtime, st.st_size) != entry[:2]: return None
+        if path not in self.parsed:
+            self.parsed[path] = fits.Header.fromstring(entry[2])
+        return self.parsed[path]
+
+    def save(self):
+        tmpFile = self.cacheFile + '.tmp'
+        with open(tmpFile, 'wb') as f:
+            pickle.dump(self.headers, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFile, self.cacheFile)
+
+
+class LazyHDUList:
+    '''
+    Opens the FITS file on first HDU access.
+    NOTE: Header changes should go through instrObj.fitsHeader (the cached header),
+    the primary header of the file opened here is not the same object.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hdus = None
+
+    def load(self):
+        if self.hdus is None:
+            self.hdus = fits.open(self.filename, ignore_missing_end=True)
+        return self.hdus
+
+    def __getitem__(self, key): return self.load()[key]
+    def __len__(self)         : return len(self.load())
+    def __iter__(self)        : return iter(self.load())
+    def __getattr__(self, name):
+        if name in ('filename', 'hdus'): raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def close(self):
+        if self.hdus is not None: self.hdus.close()
@@ -17,11 +17,14 @@ import create_log as cl
 from verification import *
 import urllib.request
 import json
+import glob
 import numpy as np
 import re
-from dep_obtain import get_obtain_data
+from dep_obtain import ObtainSchedule
 import math
 import db_conn
+from header_cache import LazyHDUList
+from timed_crawl import TimedCrawler
 
 import matplotlib as mpl
 mpl.use('Agg')
@@ -31,6 +34,13 @@ from astropy.visualization import ZScaleInterval, AsinhStretch
 from astropy.visualization.mpl_normalize import ImageNormalize
 
 
+#Telescope number by instrument (fallback if not in config and the API fails),
+#and the numbers resolved so far in this process (see get_telnr)
+TELNR = {'DEIMOS': 2, 'ESI': 2, 'HIRES': 1, 'KCWI': 2, 'LRIS': 1, 
+         'MOSFIRE': 1, 'NIRC2': 2, 'NIRSPEC': 2, 'OSIRIS': 1, 'NIRES': 2}
+telnrCache = {}
+
+
 class Instrument:
     def __init__(self, instr, utDate, config, log=None):
         """
@@ -117,6 +127,80 @@ class Instrument:
     def set_koaimtyp(self) : raise NotImplementedError("Abstract method not implemented!")
 
 
+    def get_search_dirs(self, failedDirs=None):
+        '''
+        Returns the list of sdata account dirs that exist, for locate to search.
+        Candidate dirs come from config [INSTR] SDATA_GLOBS glob patterns if defined 
+        (one dir listing per parent instead of a lookup per theoretical path), 
+        else from get_dir_list().  The live list is expanded once per run and cached in
+        <ROOTDIR>/stage/<INSTR>/live_dirs.json for LOCATE LIVE_DIRS_TTL hours (default 12)
+        so repeat runs (ie reprocessing a range of dates) don't look up every path again.
+        A list where some glob matched nothing or some get_dir_list() dir was missing
+        (ie account disk not mounted) is not reused.
+
+        The globs/dir checks run on TimedCrawler workers with the LOCATE CRAWL_TIMEOUT
+        and CRAWL_RETRIES limits, so a hung NFS mount can't stall locate here.  Patterns
+        or dirs that timed out are appended to 'failedDirs' and the list is not cached.
+        '''
+        if getattr(self, 'liveDirs', None) is not None:
+            return self.liveDirs
+
+        instrConfig = self.config.get(self.instr, {}) or {}
+        globs = instrConfig.get('SDATA_GLOBS')
+        if isinstance(globs, str): globs = [globs]
+        ttl = float(self.config.get('LOCATE', {}).get('LIVE_DIRS_TTL', 12))
+        source = {'globs': globs} if globs else {'dirs': self.get_dir_list()}
+
+        #use cached list if same source and not expired
+        cacheFile = ''.join((self.rootDir, '/stage/', self.instr.upper(), '/live_dirs.json'))
+        try:
+            with open(cacheFile) as f: cache = json.load(f)
+            if cache['source'] == source and cache.get('complete', True) \
+               and dt.now().timestamp() - cache['time'] < ttl * 3600:
+                self.liveDirs = cache['dirs']
+                return self.liveDirs
+        except (OSError, ValueError, KeyError):
+            pass
+
+        #expand globs or check each dir exists (on timed workers)
+        locateConfig = self.config.get('LOCATE', {})
+        timeout = float(locateConfig['CRAWL_TIMEOUT']) if 'CRAWL_TIMEOUT' in locateConfig else 120
+        retries = int(locateConfig['CRAWL_RETRIES'])   if 'CRAWL_RETRIES' in locateConfig else 1
+        threads = int(locateConfig['CRAWL_THREADS'])   if 'CRAWL_THREADS' in locateConfig else 8
+        if globs: tasks, scanFunc = globs, lambda pattern: [d for d in glob.glob(pattern) if os.path.isdir(d)]
+        else    : tasks, scanFunc = source['dirs'], lambda d: [d] if os.path.isdir(d) else []
+        found = {}
+        def handle(idx, task, result):
+            found[idx] = result
+            return []
+        crawler = TimedCrawler(scanFunc, threads, timeout, retries, self.log)
+        failed = crawler.run([(task,) for task in tasks], handle)
+
+        complete = True
+        dirs = set()
+        for idx, task in enumerate(tasks):
+            if idx in failed: continue
+            if not found.get(idx):
+                complete = False
+                if self.log: self.log.warning(f'get_search_dirs: no dirs found for {task}')
+            dirs.update(found.get(idx, []))
+        dirs = sorted(dirs) if globs else [d for d in tasks if d in dirs]
+        self.liveDirs = dirs
+        if failed:
+            timedOut = [tasks[idx] for idx in failed]
+            if self.log: self.log.error(f'get_search_dirs: LOCATE TIMEOUT checking {timedOut}')
+            if failedDirs is not None: failedDirs.extend(timedOut)
+            return self.liveDirs
+
+        try:
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+            with open(cacheFile, 'w') as f:
+                json.dump({'time': dt.now().timestamp(), 'source': source, 'dirs': dirs, 'complete': complete}, f)
+        except OSError as e:
+            if self.log: self.log.warning(f'get_search_dirs: could not write {cacheFile}: {e}')
+        return self.liveDirs
+
+
     def dep_init(self, fullRun=True):
         '''
         Perform specific initialization tasks for DEP processing.
@@ -178,15 +262,20 @@ class Instrument:
 
 
 
-    def set_fits_file(self, filename):
+    def set_fits_file(self, filename, header=None):
         '''
         Sets the current FITS file we are working on.  Clears out temp fits variables.
+        If a (cached) primary header is given, the file is only opened if the HDUs are accessed.
+        NOTE: Only use 'header' for read-only steps (ie create_prog), not for writing lev0.
         '''
 
-        #todo: should we have option to just read the header for performance if that is all that is needed?
         try:
-            self.fitsHdu = fits.open(filename, ignore_missing_end=True)
-            self.fitsHeader = self.fitsHdu[0].header
+            if header is not None:
+                self.fitsHdu = LazyHDUList(filename)
+                self.fitsHeader = header
+            else:
+                self.fitsHdu = fits.open(filename, ignore_missing_end=True)
+                self.fitsHeader = self.fitsHdu[0].header
             # print('hdu0',type(self.fitsHeader
             # print('hdu1',type(self.fitsHdu[1]))
             #self.fitsHeader = fits.getheader(filename)
@@ -603,15 +692,11 @@ class Instrument:
 
         #note: progData is also stored in newproginfo.txt output from getProgInfo.py
 
-        #find matching filename in array 
-        dataKey = None
-        data = None
-        for key, progFile in enumerate(progData):
-            filepath = progFile['file']
-            if filepath in self.fitsFilepath:
-                dataKey = key
-                data = progFile
-                break
+        #find matching filename (getProgInfo.ProgData path index, else search list)
+        if hasattr(progData, 'find'): 
+            data = progData.find(self.fitsFilepath)
+        else:
+            data = next((progFile for progFile in progData if progFile['file'] in self.fitsFilepath), None)
         if data == None: 
             self.log.error('set_prog_info: Could not get program info.  UDF!')
             return False
@@ -718,6 +803,25 @@ class Instrument:
 
 
 
+    def get_night_propints(self):
+        '''
+        Returns dict of koa_ppp propmin by semid for the night (one query, then
+        cached on this object), or None if the query failed (not retried).
+        '''
+        if getattr(self, 'propintDate', None) != self.utDate:
+            query = 'select semid, propmin from koa_ppp where utdate=%s'
+            rows = self.db.query('koa', query, params=(self.utDate,))
+            self.propintDate = self.utDate
+            self.propints = None
+            if rows is False:
+                self.log.warning('get_night_propints: could not query koa_ppp for ' + self.utDate)
+                return None
+            self.propints = {}
+            for row in rows:
+                self.propints.setdefault(row['semid'], row['propmin'])
+        return self.propints
+
+
     def set_propint(self, progData):
         '''
         Set proprietary period length.
@@ -736,10 +840,13 @@ class Instrument:
         if progid == 'ENG':
             propint = 18
         else:
-            #create url and get data
-#todo: test this
-            query = f'select propmin from koa_ppp where semid="{semid}" and utdate="{self.utDate}"'
-            data = self.db.query('koa', query, getOne=True)
+            #look up in night's koa_ppp rows (else query if they could not be loaded)
+            propints = self.get_night_propints()
+            if propints is not None:
+                data = {'propmin': propints[semid]} if semid in propints else None
+            else:
+                query = 'select propmin from koa_ppp where semid=%s and utdate=%s'
+                data = self.db.query('koa', query, getOne=True, params=(semid, self.utDate))
             if not data:
                 self.log.info('set_propint: PROPINT not found for ' + semid + ' and ' + self.utDate + ', defaulting to 18 months')
                 propint = 18
@@ -818,16 +925,24 @@ class Instrument:
         return True
 
 
+    def get_obtain_schedule(self):
+        '''
+        Returns the night's dep_obtain.ObtainSchedule, read from the dep_obtain 
+        file the first time it is needed.
+        '''
+        if getattr(self, 'obtainSchedule', None) is None:
+            obFile = self.dirs['stage'] + '/dep_obtain' + self.instr + '.txt'
+            self.obtainSchedule = ObtainSchedule.load(obFile)
+        return self.obtainSchedule
+
+
     def set_oa(self):
         '''
         Adds observing assistant name to header
         '''
 
-        # Get OA from dep_obtain file
-        obFile = self.dirs['stage'] + '/dep_obtain' + self.instr + '.txt'
-        obData = get_obtain_data(obFile)
-        oa = None
-        if len(obData) >= 1: oa = obData[0]['OA']
+        # Get OA from dep_obtain schedule
+        oa = self.get_obtain_schedule().oa
 
         if oa == None:
             self.log.warning("set_oa: Could not find OA data")
@@ -898,15 +1013,27 @@ class Instrument:
 
     def get_telnr(self):
         '''
-        Gets telescope number for instrument via API
-        #todo: store this and skip api call if exists?  Would need to clear var on fits reload.
-        #todo: Replace API call with hard-coded?
+        Gets telescope number for instrument, resolved once per process from config
+        [INSTR] TELNR if defined, else via API, else from the static TELNR list.
         '''
 
-        url = self.telUrl + 'cmd=getTelnr&instr=' + self.instr.upper()
-        data = get_api_data(url, getOne=True)
-        telNr = int(data['TelNr'])
-        assert telNr in [1, 2], 'telNr "' + telNr + '"" not allowed'
+        instr = self.instr.upper()
+        if instr in telnrCache:
+            return telnrCache[instr]
+
+        telNr = (self.config.get(instr) or {}).get('TELNR')
+        if telNr is None:
+            url = self.telUrl + 'cmd=getTelnr&instr=' + instr
+            data = get_api_data(url, getOne=True)
+            try:
+                telNr = int(data['TelNr'])
+            except (TypeError, KeyError, ValueError):
+                telNr = TELNR.get(instr)
+                if self.log: self.log.warning(f'get_telnr: API failed, using telnr {telNr} for {instr}')
+
+        telNr = int(telNr) if telNr is not None else None
+        assert telNr in [1, 2], f'telNr "{telNr}" not allowed'
+        telnrCache[instr] = telNr
         return telNr
 
 
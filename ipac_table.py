@@ -0,0 +1,253 @@
+"""
+  Reads and writes the IPAC ASCII fixed-width tables used for the KOA metadata
+  tables and FITS extension tables.
+
+  Table layout (each column is 'width' chars plus one separator char):
+
+    \\ optional comment line(s)
+    |KOAID         |AIRMASS  |      <- column names
+    |char          |double   |      <- column types
+    |              |         |      <- units
+    |              |null     |      <- null value
+     HI.2021...     1.02            <- data rows, ' ' + value.ljust(width)
+
+  Columns are described by a list of column spec dicts (see make_col).
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+
+#types that read_table will convert to numbers
+NUMERIC_TYPES = ('int', 'integer', 'long', 'double', 'float', 'real')
+
+
+def make_col(name, type='char', width=0, null='', unit=''):
+    '''
+    Returns a column spec dict.  Width is increased to fit the column name if needed.
+    '''
+    width = max(int(width), len(name))
+    return {'name': name, 'type': type, 'width': width, 'null': null, 'unit': unit}
+
+
+def format_header(cols, comments=None):
+    '''
+    Returns the header lines (comments, names, types, units, nulls) as one string.
+    '''
+    lines = []
+    if comments:
+        for comment in comments:
+            lines.append('\\ ' + comment)
+    for key in ('name', 'type', 'unit', 'null'):
+        lines.append(''.join('|' + str(col[key]).ljust(col['width']) for col in cols) + '|')
+    return '\n'.join(lines) + '\n'
+
+
+def format_row(cols, vals):
+    '''
+    Returns one data row string (no newline) for a list of values.
+    NOTE: Values longer than the column width are not truncated.
+    '''
+    return ''.join(' ' + str(val).ljust(col['width']) for col, val in zip(cols, vals))
+
+
+def format_column(col, vals):
+    '''
+    Returns a string array of ' ' + value.ljust(width) for one column of values,
+    matching format_row cell for cell.  Uses vectorized np.char ops; columns that
+    can't be cast to str in one go (ie multi-dimensional cells) are done per cell.
+    '''
+    vals = np.asarray(vals)
+    strs = None
+    if vals.ndim == 1:
+        try:
+            if vals.dtype.kind == 'S': strs = np.char.decode(vals, 'ascii')
+            elif vals.dtype.kind != 'O': strs = vals.astype(str)
+        except (UnicodeDecodeError, ValueError):
+            strs = None
+    if strs is None:
+        strs = np.array([str(val) for val in vals], dtype=str)
+    return np.char.add(' ', np.char.ljust(strs, col['width']))
+
+
+def format_columns(cols, columns):
+    '''
+    Returns list of data row strings (no newlines) for a list of column value
+    arrays (one array per col spec).  Work is done column-wise so time scales
+    linearly with the number of rows.
+    '''
+    if not cols: return []
+    rows = None
+    for col, vals in zip(cols, columns):
+        strs = format_column(col, vals)
+        rows = strs if rows is None else np.char.add(rows, strs)
+    return rows.tolist()
+
+
+def write_table(filepath, cols, rows=None, comments=None, columns=None):
+    '''
+    Writes a complete IPAC table.  Data is given either as 'rows' (lists of values
+    in column order) or as 'columns' (one array of values per column, faster for
+    large tables such as FITS binary table extensions).
+    '''
+    if columns is not None:
+        lines = format_columns(cols, columns)
+    else:
+        lines = [format_row(cols, vals) for vals in rows] if rows else []
+    with open(filepath, 'w') as f:
+        f.write(format_header(cols, comments))
+        if lines:
+            f.write('\n'.join(lines))
+            f.write('\n')
+
+
+def read_header(lines):
+    '''
+    Parses the header lines of a table.
+    Returns list of column specs, list of column start offsets, line width and
+    number of header lines (including comments).
+    '''
+    numLines = 0
+    hdrLines = []
+    for line in lines:
+        if   line.startswith('\\'): numLines += 1
+        elif line.startswith('|') : numLines += 1; hdrLines.append(line.rstrip('\r\n'))
+        else                      : break
+    if not hdrLines:
+        raise ValueError('ipac_table: no header lines found')
+
+    #column boundaries are the '|' positions in the names line
+    bars = [i for i, c in enumerate(hdrLines[0]) if c == '|']
+    starts = bars[:-1]
+    cols = []
+    for k, start in enumerate(starts):
+        end = bars[k+1]
+        vals = [line[start+1:end].strip() if len(line) > start else '' for line in hdrLines]
+        vals += [''] * (4 - len(vals))
+        col = make_col(vals[0], vals[1], end - start - 1, vals[3], vals[2])
+        cols.append(col)
+    return cols, starts, bars[-1], numLines
+
+
+def read_table(filepath, nullValues=('null', ''), convert=True, encoding='utf-8'):
+    '''
+    Reads an IPAC table into a pandas DataFrame.  Null values become NaN and,
+    if 'convert' is set, columns with a numeric header type are converted to numbers.
+
+    Fixed-width rows are sliced by byte offset with a NumPy structured dtype.  If
+    the rows are not all the same length (ie hand edited or non-ascii values),
+    it falls back to slicing each line by character offset.
+    '''
+    with open(filepath, 'rb') as f:
+        raw = f.read()
+
+    #parse header lines (comments and '|' lines at top of file)
+    headLines = []
+    pos = 0
+    while pos < len(raw) and raw[pos:pos+1] in (b'\\', b'|'):
+        end = raw.find(b'\n', pos)
+        end = len(raw) if end < 0 else end + 1
+        headLines.append(raw[pos:end].decode(encoding, errors='replace'))
+        pos = end
+    cols, starts, width, numLines = read_header(headLines)
+    data = raw[pos:]
+    if data and not data.endswith(b'\n'): data += b'\n'
+
+    colData = None
+    if data.isascii():
+        colData = read_fixed_width_bytes(data, starts, width)
+    if colData is None:
+        lines = data.decode(encoding, errors='replace').splitlines()
+        colData = [np.array([line[s:e].strip() for line in lines], dtype=str)
+                   for s, e in zip(starts, starts[1:] + [width])]
+
+    #convert each column array, marking nulls
+    series = []
+    for col, vals in zip(cols, colData):
+        vals = vals.astype(str)
+        isNull = np.isin(vals, list(nullValues))
+        converted = None
+        if convert and col['type'].lower() in NUMERIC_TYPES:
+            converted = to_number_array(vals, isNull, col['type'].lower())
+        if converted is None:
+            converted = vals.astype(object)
+            converted[isNull] = np.nan
+        series.append(pd.Series(converted))
+    df = pd.concat(series, axis=1, ignore_index=True) if series else pd.DataFrame()
+    df.columns = [col['name'] for col in cols]
+    return df
+
+
+def to_number_array(vals, isNull, type):
+    '''
+    Converts a string array to float (or int if integer type without nulls).
+    Returns None if any non-null value is not a number.
+    '''
+    try:
+        if not isNull.any() and type in ('int', 'integer', 'long'):
+            try:
+                return vals.astype(np.int64)
+            except (ValueError, OverflowError):
+                pass
+        vals = np.where(isNull, 'nan', vals)
+        return vals.astype(np.float64)
+    except ValueError:
+        return None
+
+
+def read_fixed_width_bytes(data, starts, width):
+    '''
+    Slices equal length ascii rows into columns using a NumPy structured dtype.
+    Returns list of stripped column bytes arrays, or None if rows are not fixed width.
+    '''
+    rowLen = data.find(b'\n') + 1
+    if rowLen <= 0:
+        return [np.array([], dtype='S1') for s in starts]
+    if len(data) % rowLen != 0 or rowLen - 1 > width:
+        return None
+    #every row must end with the newline and have no other (ie two short lines that add up to rowLen)
+    chars = np.frombuffer(data, dtype='S1').reshape(-1, rowLen)
+    if not (chars[:, -1] == b'\n').all() or data.count(b'\n') != len(chars):
+        return None
+
+    #one field per column, last column runs to the end of the row
+    ends = [min(e, rowLen - 1) for e in starts[1:] + [width]]
+    dtype = np.dtype({'names'  : [f'c{k}' for k in range(len(starts))],
+                      'formats': [f'S{max(e - s, 1)}' for s, e in zip(starts, ends)],
+                      'offsets': starts,
+                      'itemsize': rowLen})
+    recs = np.frombuffer(data, dtype=dtype)
+    return [np.char.strip(recs[name]) for name in dtype.names]
+
+
+def benchmark(filepath, repeat=5):
+    '''
+    Times read_table against the pd.read_fwf method previously used for metadata tables.
+    '''
+    with open(filepath, 'r', errors='replace') as f:
+        header = f.readline().strip()
+    colWidths = [len(col) + 1 for col in header.split('|') if len(col) > 1]
+
+    def fwf():
+        data = pd.read_fwf(filepath, widths=colWidths, skiprows=range(1,4))
+        data.columns = data.columns.str.replace('|','').str.strip()
+        return data
+
+    results = {}
+    for name, func in (('read_table', lambda: read_table(filepath)), ('read_fwf', fwf)):
+        times = []
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            df = func()
+            times.append(time.perf_counter() - t0)
+        results[name] = min(times)
+        print(f'{name:10s}: {len(df)} rows x {len(df.columns)} cols, best of {repeat}: {min(times)*1000:.1f} ms')
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('USAGE: python ipac_table.py <ipac table file> [repeat]')
+        sys.exit(0)
+    benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -1,5 +1,6 @@
 from send_email import *
-from common import update_koatpx, get_api_data
+from common import get_api_data
+from tpx_updater import TpxUpdater
 from datetime import datetime as dt
 import os
 import yaml
@@ -67,15 +68,17 @@ def koaxfr(instrObj, tpx=0):
             send_email(emailFrom, emailFrom, subject, message)
         # Update koatpx
         if tpx:
-            update_koatpx(instr, utDate, 'files_arch', '0', log)
-            update_koatpx(instr, utDate, 'sci_files', '0', log)
-            update_koatpx(instr, utDate, 'ondisk_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'arch_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'metadata_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'dvdwrit_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'dvdsent_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'dvdstor_stat', 'N/A', log)
-            #update_koatpx(instr, utDate, 'tpx_stat', 'N/A', log)
+            tpxUpdater = TpxUpdater(instr, utDate, log)
+            tpxUpdater.set('files_arch', '0')
+            tpxUpdater.set('sci_files', '0')
+            tpxUpdater.set('ondisk_stat', 'N/A')
+            tpxUpdater.set('arch_stat', 'N/A')
+            tpxUpdater.set('metadata_stat', 'N/A')
+            tpxUpdater.set('dvdwrit_stat', 'N/A')
+            tpxUpdater.set('dvdsent_stat', 'N/A')
+            tpxUpdater.set('dvdstor_stat', 'N/A')
+            #tpxUpdater.set('tpx_stat', 'N/A')
+            tpxUpdater.flush()
 
         return True
 
@@ -116,8 +119,10 @@ def koaxfr(instrObj, tpx=0):
         if tpx:
             utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
             val = 'ERROR' if not data or data.get('stat').lower() != 'ok' else 'DONE'
-            update_koatpx(instr, utDate, 'dvdsent_stat', val, log)
-            update_koatpx(instr, utDate, 'dvdsent_time', utcTimestamp, log)
+            tpxUpdater = TpxUpdater(instr, utDate, log)
+            tpxUpdater.set('dvdsent_stat', val)
+            tpxUpdater.set('dvdsent_time', utcTimestamp)
+            tpxUpdater.flush()
         return True
     else:
         # Send email notifying of error
@@ -0,0 +1,297 @@
+"""
+  Live locate watcher.  Uses Linux inotify to record new FITS files in an
+  instrument's sdata dirs as they are closed during the night, so dep_locate
+  can read a per-night manifest instead of crawling all of sdata.
+
+  Files written to <ROOTDIR>/stage/<INSTR>/watch/:
+    <yyyymmdd>.manifest  - one "path<tab>mtime" line per closed/moved-in FITS file,
+                           night assigned by mtime vs the instrument endTime
+    <yyyymmdd>.overflow  - inotify queue overflowed that night (events may be lost)
+    <yyyymmdd>.unwatched - a dir could not be watched that night (ie max_user_watches)
+    start.json           - watcher start time and list of watched root dirs
+    heartbeat            - time of last heartbeat (updated every HEARTBEAT_SEC)
+
+  dep_locate only uses a manifest (LOCATE USE_WATCH: 1) if the watcher was started
+  before the 24 hour window began, was still running at the end of it, watched all
+  search dirs and did not overflow or fail to watch a dir.  Otherwise it falls back
+  to the crawl.
+
+  Usage: python locate_watch.py INSTR [--searchDir DIR]
+"""
+import os
+import sys
+import json
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import argparse
+import importlib
+from timed_crawl import TimedCrawler
+from datetime import datetime as dt, timedelta, timezone
+
+
+#inotify event masks (see inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+WATCH_MASK    = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HDR     = struct.Struct('iIII')
+HEARTBEAT_SEC = 60
+
+
+def get_watch_dir(rootDir, instr):
+    return ''.join((rootDir, '/stage/', instr.upper(), '/watch'))
+
+
+def is_fits_name(name):
+    return name.endswith('.fits') or name.endswith('fits.gz')
+
+
+def get_night(modTime, endTime):
+    '''
+    Returns the yyyymmdd UT night a mod time belongs to, ie the utDate whose
+    24 hour window (utDate-1 endTime, utDate endTime] contains it.
+    '''
+    t = dt.fromtimestamp(modTime, timezone.utc)
+    if t.strftime('%H:%M:%S') > endTime or (t.strftime('%H:%M:%S') == endTime and t.microsecond > 0):
+        t += timedelta(days=1)
+    return t.strftime('%Y%m%d')
+
+
+class Inotify:
+    '''Minimal ctypes wrapper around the Linux inotify API.'''
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        return wd
+
+    def read_events(self, timeout):
+        '''Waits up to timeout secs and returns list of (wd, mask, name).'''
+        ready, w, x = select.select([self.fd], [], [], timeout)
+        if not ready: return []
+        try:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + EVENT_HDR.size <= len(data):
+            wd, mask, cookie, nameLen = EVENT_HDR.unpack_from(data, pos)
+            pos += EVENT_HDR.size
+            name = data[pos:pos+nameLen].rstrip(b'\0').decode(errors='surrogateescape')
+            pos += nameLen
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LocateWatcher:
+    '''
+    Watches dir trees and appends closed FITS files to per-night manifests.
+    '''
+
+    def __init__(self, useDirs, watchDir, endTime='20:00:00', log=None):
+        self.useDirs  = [d[:-1] if d.endswith('/') and len(d) > 1 else d for d in useDirs]
+        self.watchDir = watchDir
+        self.endTime  = endTime
+        self.log      = log
+        self.wds      = {}
+        self.unwatched = set()
+        self.inotify  = None
+        if not os.path.isdir(watchDir): os.makedirs(watchDir)
+
+    def start(self):
+        self.inotify = Inotify()
+        self.startTime = time.time()
+        for root in self.useDirs:
+            self.add_tree(root, scanFiles=False)
+        with open(self.watchDir + '/start.json', 'w') as f:
+            json.dump({'time': self.startTime, 'dirs': self.useDirs, 'pid': os.getpid()}, f)
+        self.heartbeat()
+        if self.log: self.log.info(f'locate_watch: watching {len(self.wds)} dirs under {self.useDirs}')
+
+    def add_tree(self, root, scanFiles=True):
+        '''
+        Adds watches for a dir and all subdirs.  For dirs created while running,
+        files already in them (created before the watch existed) are recorded.
+        '''
+        for path, dirs, files in os.walk(root):
+            try:
+                wd = self.inotify.add_watch(path, WATCH_MASK)
+                self.wds[wd] = path
+            except OSError as e:
+                self.mark_unwatched(path, e)
+                continue
+            if scanFiles:
+                for name in files:
+                    if is_fits_name(name): self.record(path + '/' + name)
+
+    def record(self, path):
+        try:
+            modTime = os.stat(path).st_mtime
+        except OSError:
+            return
+        night = get_night(modTime, self.endTime)
+        with open(f'{self.watchDir}/{night}.manifest', 'a') as f:
+            f.write(f'{path}\t{modTime}\n')
+
+    def mark_overflow(self):
+        night = get_night(time.time(), self.endTime)
+        with open(f'{self.watchDir}/{night}.overflow', 'a') as f:
+            f.write(f'{time.time()}\n')
+        if self.log: self.log.error(f'locate_watch: inotify queue overflow, night {night} will be crawled')
+
+    def mark_unwatched(self, path, error=None):
+        '''
+        Records a dir that could not be watched.  Its files may be missing from the
+        manifest, so every night while it stays unwatched is marked to be crawled.
+        '''
+        if path not in self.unwatched:
+            self.unwatched.add(path)
+            if self.log: self.log.error(f'locate_watch: could not watch {path} ({error}), nights will be crawled')
+        night = get_night(time.time(), self.endTime)
+        with open(f'{self.watchDir}/{night}.unwatched', 'a') as f:
+            f.write(f'{path}\t{time.time()}\n')
+
+    def heartbeat(self):
+        self.lastBeat = time.time()
+        night = get_night(self.lastBeat, self.endTime)
+        if not os.path.exists(f'{self.watchDir}/{night}.unwatched'):
+            for path in sorted(self.unwatched): self.mark_unwatched(path)
+        tmpFile = self.watchDir + '/heartbeat.tmp'
+        with open(tmpFile, 'w') as f:
+            f.write(str(self.lastBeat))
+        os.replace(tmpFile, self.watchDir + '/heartbeat')
+
+    def process(self, events):
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.mark_overflow()
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self.wds.pop(wd, None)
+                continue
+            dirPath = self.wds.get(wd)
+            if dirPath is None or not name: continue
+            path = dirPath + '/' + name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.islink(path):
+                    self.add_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_fits_name(name):
+                self.record(path)
+
+    def run(self, stopTime=None):
+        self.start()
+        try:
+            while stopTime is None or time.time() < stopTime:
+                self.process(self.inotify.read_events(1.0))
+                if time.time() - self.lastBeat >= HEARTBEAT_SEC:
+                    self.heartbeat()
+        finally:
+            self.inotify.close()
+
+
+def get_manifest_records(watchDir, utDate, useDirs, minTime, maxTime, log=None,
+                         numThreads=8, timeout=None, retries=0, failedDirs=None):
+    '''
+    Returns list of (path, mtime, order) from the night's manifest for files under
+    useDirs with minTime < mtime <= maxTime, or None if the manifest can't be trusted
+    (watcher not running for the whole window, dirs not watched or queue overflow).
+    Each manifest file is stat'ed again for its current mtime, per search dir on
+    TimedCrawler workers.  Search dirs whose stats timed out are skipped and appended
+    to 'failedDirs'.
+    '''
+    ymd = utDate.replace('-', '').replace('/', '')
+    manifest = f'{watchDir}/{ymd}.manifest'
+    reason = None
+    try:
+        with open(watchDir + '/start.json') as f: start = json.load(f)
+        with open(watchDir + '/heartbeat') as f: beat = float(f.read().strip())
+    except (OSError, ValueError):
+        start, beat = None, 0
+    useDirs = [d[:-1] if d.endswith('/') and len(d) > 1 else d for d in useDirs]
+    if   not start                        : reason = 'watcher state not found'
+    elif start['time'] > minTime          : reason = 'watcher started after window start'
+    elif beat < maxTime                   : reason = 'watcher not running at window end'
+    elif os.path.exists(f'{watchDir}/{ymd}.overflow'): reason = 'inotify overflow'
+    elif os.path.exists(f'{watchDir}/{ymd}.unwatched'): reason = 'dirs not watched'
+    elif not all(any(d == w or d.startswith(w + '/') for w in start['dirs']) for d in useDirs):
+        reason = 'search dirs not all watched'
+    if reason:
+        if log: log.info(f'locate_watch: not using manifest ({reason})')
+        return None
+
+    #group manifest paths by search dir
+    dirPaths = {}
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            paths = [line.split('\t')[0] for line in f if line.strip()]
+        for path in dict.fromkeys(paths):
+            idx = next((i for i, d in enumerate(useDirs) if path.startswith(d + '/')), None)
+            if idx is not None: dirPaths.setdefault(idx, []).append(path)
+
+    #stat each search dir's files on a timed worker (a hung mount only fails that dir)
+    def stat_paths(dirPath, paths):
+        stats = []
+        for path in paths:
+            try:
+                stats.append((path, os.stat(path).st_mtime))
+            except OSError:
+                pass
+        return stats
+
+    records = {}
+    dirIdxs = sorted(dirPaths)
+    def handle(rootIdx, task, result):
+        idx = dirIdxs[rootIdx]
+        for path, modTime in result:
+            if modTime > minTime and modTime <= maxTime:
+                records[path] = (path, modTime, (idx, path))
+        return []
+    crawler = TimedCrawler(stat_paths, numThreads, timeout, retries, log)
+    failed = crawler.run([(useDirs[idx], dirPaths[idx]) for idx in dirIdxs], handle)
+    if failed and failedDirs is not None:
+        failedDirs.extend(useDirs[dirIdxs[i]] for i in failed)
+
+    if log: log.info(f'locate_watch: using manifest {manifest} ({len(records)} files)')
+    return sorted(records.values(), key=lambda r: r[2])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Live locate inotify watcher')
+    parser.add_argument('instr'      , type=str,                        help='Instrument name')
+    parser.add_argument('--searchDir', type=str, nargs='?', const=None, help='(OPTIONAL) Directory to watch instead of instrument dirs.')
+    args = parser.parse_args()
+    instr = args.instr.upper()
+
+    import yaml
+    import create_log as cl
+    with open('config.live.ini') as f: config = yaml.safe_load(f)
+    utDate = dt.utcnow().strftime('%Y-%m-%d')
+    module = importlib.import_module('instr_' + instr.lower())
+    instrObj = getattr(module, instr.capitalize())(instr, utDate, config)
+    useDirs = [args.searchDir] if args.searchDir else instrObj.get_search_dirs()
+
+    log = cl.create_log(instrObj.rootDir, instr, utDate, True)
+    watcher = LocateWatcher(useDirs, get_watch_dir(instrObj.rootDir, instr), instrObj.endTime, log)
+    watcher.run()
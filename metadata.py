@@ -23,14 +23,23 @@ import hashlib
 import json
 import logging
 from pathlib import Path
+import ipac_table
+from common import get_file_md5
 
 log = logging.getLogger("koa_dep")
 
 def make_metadata(keywordsDefFile, metaOutFile, searchdir=None, filepath=None, 
-                  extraMeta=dict(), dev=False, keyskips=[], create_md5=False):
+                  extraMeta=dict(), dev=False, keyskips=[], create_md5=False, indexFile=None):
     """
     Creates the archiving metadata file as part of the DQA process.
 
+    If 'indexFile' is given, a JSON sidecar index of each FITS file's mtime, size,
+    md5 and rendered metadata row is kept there.  On re-runs, rows are only
+    re-derived for files whose inputs (file, extra metadata or keyword definitions
+    file) changed; other rows are copied from the index.  This is for re-running
+    on existing lev0 files (see dep_dqa.remake_metadata; a full dep_dqa run rewrites
+    every file, so it does not use it).
+
     @param keywordsDefFile: keywords format definition input file path
     @type keywordsDefFile: string
     @param metaOutFile: metadata output file path
@@ -39,6 +48,8 @@ def make_metadata(keywordsDefFile, metaOutFile, searchdir=None, filepath=None,
     @type searchdir: string
     @param extraMeta: dictionary of any extra key val pairs not in header
     @type extraMeta: dictionary
+    @param indexFile: optional sidecar index file path for incremental re-runs
+    @type indexFile: string
     """
 
     #open keywords format file and read data
@@ -69,13 +80,49 @@ def make_metadata(keywordsDefFile, metaOutFile, searchdir=None, filepath=None,
         fitsFiles.append(filepath)
     if len(fitsFiles) == 0:
         log.info(f'No fits file(s) found')
+
+    #load index of previously rendered rows (reset if keyword defs changed)
+    index = None
+    if indexFile:
+        index = load_metadata_index(indexFile, get_file_md5(keywordsDefFile))
+    numReused = 0
+
     for fitsFile in sorted(fitsFiles):
         extra = {}
         baseName = os.path.basename(fitsFile)
         if baseName in extraMeta:
             extra = extraMeta[baseName]
+
+        #reuse indexed row if inputs unchanged
+        if index is not None:
+            entry, fileStat = get_metadata_index_entry(index, fitsFile, extra)
+            if entry:
+                with open(metaOutFile, 'a') as out:
+                    out.write(entry['row'] + "\n")
+                for warn, numWarns in entry['warns'].items():
+                    warns[warn] = warns.get(warn, 0) + numWarns
+                numReused += 1
+                continue
+
         log.info("Creating metadata record for: " + fitsFile)
-        warns = add_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, dev, keyskips)
+        if index is None:
+            warns = add_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, dev, keyskips)
+        else:
+            rowWarns = {warn: 0 for warn in warns}
+            line, rowWarns = get_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, rowWarns, dev, keyskips)
+            with open(metaOutFile, 'a') as out:
+                out.write(line + "\n")
+            for warn, numWarns in rowWarns.items():
+                warns[warn] = warns.get(warn, 0) + numWarns
+            fileStat['row'] = line
+            fileStat['warns'] = rowWarns
+            index['files'][fitsFile] = fileStat
+
+    #save index (dropping files no longer present)
+    if index is not None:
+        log.info(f'metadata.py: reused {numReused} of {len(fitsFiles)} rows from index {indexFile}')
+        index['files'] = {k: v for k, v in index['files'].items() if k in fitsFiles}
+        save_metadata_index(indexFile, index)
 
     #warn only if counts
     for warn, numWarns in warns.items():
@@ -90,6 +137,56 @@ def make_metadata(keywordsDefFile, metaOutFile, searchdir=None, filepath=None,
 
     return True
 
+def load_metadata_index(indexFile, keyDefsMd5):
+    '''
+    Loads the metadata sidecar index.  Returns an empty index if the file does not
+    exist, can't be read or was made with a different keyword definitions file.
+    '''
+    empty = {'keyDefsMd5': keyDefsMd5, 'files': {}}
+    if not os.path.isfile(indexFile):
+        return empty
+    try:
+        with open(indexFile, 'r') as f:
+            index = json.load(f)
+    except Exception as e:
+        log.warning(f'metadata.py: could not read metadata index {indexFile}: {e}')
+        return empty
+    if index.get('keyDefsMd5') != keyDefsMd5 or not isinstance(index.get('files'), dict):
+        log.info('metadata.py: keyword definitions changed, metadata index reset')
+        return empty
+    return index
+
+def save_metadata_index(indexFile, index):
+    '''Writes the metadata sidecar index (via temp file so a failed write does not corrupt it).'''
+    tmpFile = indexFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmpFile, indexFile)
+
+def get_metadata_index_entry(index, fitsFile, extra):
+    '''
+    Checks a FITS file against the index.  Returns (entry, fileStat) where entry is
+    the indexed entry if its row can be reused (else None) and fileStat is the
+    current mtime/size/md5/extra hash of the file to store with a new row.
+    The md5 is only computed if mtime or size changed.
+    '''
+    stat = os.stat(fitsFile)
+    extraMd5 = hashlib.md5(json.dumps(extra, sort_keys=True, default=str).encode()).hexdigest()
+    fileStat = {'mtime': stat.st_mtime, 'size': stat.st_size, 'md5': None, 'extra': extraMd5}
+
+    entry = index['files'].get(fitsFile)
+    if entry and entry.get('extra') == extraMd5 and entry.get('size') == stat.st_size:
+        if entry.get('mtime') == stat.st_mtime:
+            return entry, fileStat
+        fileStat['md5'] = get_file_md5(fitsFile)
+        if entry.get('md5') == fileStat['md5']:
+            entry['mtime'] = stat.st_mtime
+            return entry, fileStat
+
+    if fileStat['md5'] is None:
+        fileStat['md5'] = get_file_md5(fitsFile)
+    return None, fileStat
+
 def format_keyDefs(keyDefs):
     '''renames and type declarations for metadata table'''
     keyDefs = keyDefs.rename(columns={'FITSKeyword': 'keyword', 'MetadataDatatype': 'metaDataType', 'NullsAllowed':'allowNull', 'MetadataWidth': 'colSize', 'MinValue': 'minValue', 'MaxValue': 'maxValue'})
@@ -116,85 +213,84 @@ def create_md5_checksum_file(metaOutFile):
 
 def create_metadata_file(filename, keyDefs):
     #add header to output file
-    with open(filename, 'w+') as out:
-
-        #check col width is at least as big is the keyword name
-        for index, row in keyDefs.iterrows():
-            if (len(row['keyword']) > row['colSize']):
-                keyDefs.loc[index, 'colSize'] = len(row['keyword'])
-        for index, row in keyDefs.iterrows():
-            out.write('|' + row['keyword'].ljust(row['colSize']))
-        out.write("|\n")
-        for index, row in keyDefs.iterrows():
-            out.write('|' + row['metaDataType'].ljust(row['colSize']))
-        out.write("|\n")
-        #todo: add units?
-        for index, row in keyDefs.iterrows():
-            out.write('|' + ''.ljust(row['colSize']))
-        out.write("|\n")
-
-        for index, row in keyDefs.iterrows():
-            nullStr = '' if (row['allowNull'] == "N") else "null"
-            out.write('|' + nullStr.ljust(row['colSize']))
-        out.write("|\n")
-        out.flush()
+    #check col width is at least as big is the keyword name
+    for index, row in keyDefs.iterrows():
+        if (len(row['keyword']) > row['colSize']):
+            keyDefs.loc[index, 'colSize'] = len(row['keyword'])
+    #todo: add units?
+    ipac_table.write_table(filename, get_ipac_cols(keyDefs))
+
+
+def get_ipac_cols(keyDefs):
+    '''Returns the ipac_table column specs for the metadata keyword definitions.'''
+    cols = []
+    for index, row in keyDefs.iterrows():
+        nullStr = '' if (row['allowNull'] == "N") else "null"
+        cols.append(ipac_table.make_col(row['keyword'], row['metaDataType'], row['colSize'], nullStr))
+    return cols
 
 
 def add_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, dev, keyskips):
     """
     Adds a line to metadata file for one FITS file.
     """
+    line, warns = get_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, dev, keyskips)
+    with open(metaOutFile, 'a') as out:
+        out.write(line + "\n")
+    return warns
+
+
+def get_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, dev, keyskips):
+    """
+    Returns the metadata line (no newline) for one FITS file and updated warns.
+    """
 
     #get header object using astropy
     header = fits.getheader(fitsFile)
     #check keywords
     check_keyword_existance(header, keyDefs, dev, keyskips, extra)
     #write all keywords vals for image to a line
-    with open(metaOutFile, 'a') as out:
+    vals = []
+    for index, row in keyDefs.iterrows():
 
-        for index, row in keyDefs.iterrows():
-
-            keyword   = row['keyword']
-            dataType  = row['metaDataType']
-            colSize   = row['colSize']
-            allowNull = row['allowNull']
-
-            #get value from header, set to null if not found
-            if keyword in header: 
-                try:
-                    val = header[keyword]
-                except Exception as e:
-                    log.error('metadata check: Could not read header keyword (' + fitsFile + '): ' + keyword)
-                    val = 'null'
-            elif keyword in extra:
-                val = extra[keyword]
-            else: 
-                val = 'null'
-                if dev: log.error('metadata check: Keyword not found in header (' + fitsFile + '): ' + keyword)
+        keyword   = row['keyword']
+        dataType  = row['metaDataType']
+        colSize   = row['colSize']
+        allowNull = row['allowNull']
 
-            #special check for val = fits.Undefined
-            if isinstance(val, fits.Undefined):
+        #get value from header, set to null if not found
+        if keyword in header: 
+            try:
+                val = header[keyword]
+            except Exception as e:
+                log.error('metadata check: Could not read header keyword (' + fitsFile + '): ' + keyword)
                 val = 'null'
+        elif keyword in extra:
+            val = extra[keyword]
+        else: 
+            val = 'null'
+            if dev: log.error('metadata check: Keyword not found in header (' + fitsFile + '): ' + keyword)
 
-            #special check for 'NaN' or '-Nan'
-            if val in ('NaN', '-NaN'):
-                val = 'null'
+        #special check for val = fits.Undefined
+        if isinstance(val, fits.Undefined):
+            val = 'null'
 
-            #check keyword val and format
-            try:
-                val, warns = check_keyword_val(keyword, val, row, warns)
-            except Exception as err:
-                msg = 'Exception for metaOutFile {0} keyword: {1} val: {2}. Error: {3}'.format(os.path.basename(metaOutFile), keyword, val, err)
-                log.error(msg)
-                if not dev:
-                    raise Exception(msg)
-
-            #write out val padded to size
-            out.write(' ')
-            out.write(str(val).ljust(colSize))
-            out.flush()
-        out.write("\n")
-    return warns
+        #special check for 'NaN' or '-Nan'
+        if val in ('NaN', '-NaN'):
+            val = 'null'
+
+        #check keyword val and format
+        try:
+            val, warns = check_keyword_val(keyword, val, row, warns)
+        except Exception as err:
+            msg = 'Exception for metaOutFile {0} keyword: {1} val: {2}. Error: {3}'.format(os.path.basename(metaOutFile), keyword, val, err)
+            log.error(msg)
+            if not dev:
+                raise Exception(msg)
+        vals.append(val)
+
+    #return vals padded to size
+    return ipac_table.format_row(get_ipac_cols(keyDefs), vals), warns
 
 
 def check_keyword_existance(header, keyDefs, dev=False, keyskips=[], extra={}):
@@ -380,16 +476,17 @@ def compare_meta_files(filepaths, skipColCompareWarn=False):
     '''
     Takes an array of filepaths to metadata output files and compares them all to 
     the first metadata file in a smart manner.
+
+    Rows are joined on KOAID and each shared column is compared as a whole (see 
+    smart_diff_mask) instead of cell by cell.  Each result dict contains:
+        compare:  description line of the two files compared
+        warnings: list of warning strings (one per missing col/row and value diff)
+        columns:  dict with 'onlyInBase', 'onlyInOther', 'compared' and per column 'diffCounts'
+        rows:     dict with 'onlyInBase', 'onlyInOther', 'compared' and per KOAID 'diffCounts'
+        diffs:    list of dicts (koaid, col, val0, val1) for each value difference
     '''
     results = []
 
-    #columns we always skip value check
-    skips = ['DQA_DATE', 'DQA_VERS']
-
-    #store list of columns to compare
-    compareCols = []
-    compareKoaids = []
-
     #loop, parse and store dataframes
     dfs = []
     for filepath in filepaths:
@@ -399,66 +496,124 @@ def compare_meta_files(filepaths, skipColCompareWarn=False):
 
     #compare all to first df in list
     baseDf = dfs[0]
-    baseColList = baseDf.columns.tolist()
     for i, df in enumerate(dfs):
         if i == 0: continue
+        result = compare_meta_dfs(baseDf, df, i, skipColCompareWarn)
+        results.append(result)
 
-        result = {}
-        result['compare'] = '==> comparing (0){} to ({}){}:'.format(baseDf.name, i, df.name)
-        result['warnings'] = []
-
-        #basic two-way column name compare
-        colList = df.columns.tolist()
-        for col in colList:
-            if col not in baseColList:
-                if col not in skips:
-                    if not skipColCompareWarn: 
-                        result['warnings'].append('Meta compare: MD{} col "{}" not in MD0 col list.'.format(i, col))
-            else:
-                if col not in compareCols: compareCols.append(col)
-        for col in baseColList:
-            if col not in colList:
-                if col not in skips:
-                    if not skipColCompareWarn: 
-                        result['warnings'].append('Meta compare: MD0 col "{}" not in MD{} col list.'.format(col, i))
-            else:
-                if col not in compareCols: compareCols.append(col)
-
-        #basic two-way row find using koaid value
-        for index, row in df.iterrows():
-            koaid = row['KOAID']
-            baseRow = baseDf[baseDf['KOAID'] == koaid]
-            if baseRow.empty: 
-                result['warnings'].append('Meta compare: CANNOT FIND KOAID "{}" in MD0'.format(koaid))
-                continue
-            else:
-                if koaid not in compareKoaids: compareKoaids.append(koaid)
-
-        for index, baseRow in baseDf.iterrows():
-            koaid = baseRow['KOAID']
-            row = df[df['KOAID'] == koaid]
-            if row.empty: 
-                result['warnings'].append('Meta compare: CANNOT FIND KOAID "{}" in MD{}'.format(koaid, i))
-                continue
-            else:
-                if koaid not in compareKoaids: compareKoaids.append(koaid)
+    return results
 
-        #for koaids we found in both, compare those rows
-        for koaid in compareKoaids:
-            row0 = baseDf[baseDf['KOAID'] == koaid].iloc[0]
-            row1 = df[df['KOAID'] == koaid].iloc[0]
-            for col in compareCols:
-                if col in skips: continue
 
-                val0 = row0[col]
-                val1 = row1[col]
+def compare_meta_dfs(baseDf, df, i=1, skipColCompareWarn=False):
+    '''
+    Compares one metadata dataframe (MD<i>) to the base metadata dataframe (MD0).
+    See compare_meta_files for the returned result dict.
+    '''
 
-                if val_smart_diff(val0, val1, col):
-                    result['warnings'].append('Meta compare: {}: col "{}": (0)"{}" != ({})"{}"'.format(koaid, col, val0, i, val1))
+    #columns we always skip value check
+    skips = ['DQA_DATE', 'DQA_VERS']
 
-        results.append(result)
+    baseName = getattr(baseDf, 'name', '')
+    name = getattr(df, 'name', '')
+    result = {}
+    result['compare'] = '==> comparing (0){} to ({}){}:'.format(baseName, i, name)
+    result['warnings'] = []
+
+    #basic two-way column name compare
+    baseColList = baseDf.columns.tolist()
+    colList = df.columns.tolist()
+    onlyInOther = [col for col in colList     if col not in baseColList and col not in skips]
+    onlyInBase  = [col for col in baseColList if col not in colList     and col not in skips]
+    if not skipColCompareWarn:
+        for col in onlyInOther:
+            result['warnings'].append('Meta compare: MD{} col "{}" not in MD0 col list.'.format(i, col))
+        for col in onlyInBase:
+            result['warnings'].append('Meta compare: MD0 col "{}" not in MD{} col list.'.format(col, i))
+    compareCols = [col for col in baseColList if col in colList and col not in skips and col != 'KOAID']
+
+    #index both tables by koaid (first row wins on duplicates)
+    baseIdx = baseDf.drop_duplicates('KOAID').set_index('KOAID')
+    idx     = df.drop_duplicates('KOAID').set_index('KOAID')
+
+    #basic two-way row find using koaid value
+    missingInBase  = df['KOAID'][~df['KOAID'].isin(baseIdx.index)].tolist()
+    missingInOther = baseDf['KOAID'][~baseDf['KOAID'].isin(idx.index)].tolist()
+    for koaid in missingInBase:
+        result['warnings'].append('Meta compare: CANNOT FIND KOAID "{}" in MD0'.format(koaid))
+    for koaid in missingInOther:
+        result['warnings'].append('Meta compare: CANNOT FIND KOAID "{}" in MD{}'.format(koaid, i))
+
+    #for koaids we found in both, compare those rows one column at a time
+    koaids = baseIdx.index[baseIdx.index.isin(idx.index)]
+    rows0 = baseIdx.loc[koaids, compareCols]
+    rows1 = idx.loc[koaids, compareCols]
+    diffMask = pd.DataFrame(False, index=koaids, columns=compareCols)
+    for col in compareCols:
+        diffMask[col] = smart_diff_mask(rows0[col], rows1[col], col).to_numpy()
+
+    #report diffs by koaid, then col (stack keeps False entries, so select the True ones)
+    diffs = []
+    stacked = diffMask.stack()
+    for koaid, col in stacked[stacked].index:
+        val0 = rows0.at[koaid, col]
+        val1 = rows1.at[koaid, col]
+        diffs.append({'koaid': koaid, 'col': col, 'val0': val0, 'val1': val1})
+        result['warnings'].append('Meta compare: {}: col "{}": (0)"{}" != ({})"{}"'.format(koaid, col, val0, i, val1))
+
+    colCounts = diffMask.sum(axis=0)
+    rowCounts = diffMask.sum(axis=1)
+    result['columns'] = {'onlyInBase' : onlyInBase,
+                         'onlyInOther': onlyInOther,
+                         'compared'   : compareCols,
+                         'diffCounts' : {col: int(n) for col, n in colCounts[colCounts > 0].items()}}
+    result['rows']    = {'onlyInBase' : missingInOther,
+                         'onlyInOther': missingInBase,
+                         'compared'   : len(koaids),
+                         'diffCounts' : {koaid: int(n) for koaid, n in rowCounts[rowCounts > 0].items()}}
+    result['diffs'] = diffs
+    return result
+
+
+def smart_diff_mask(vals0, vals1, col=None):
+    '''
+    Vectorized version of val_smart_diff for two aligned pandas Series.
+    Returns a boolean Series that is True where the values differ.
+    '''
+
+    #identical values (or both null) can never differ, so only examine the rest
+    isDiff = pd.Series(False, index=vals0.index)
+    same = (vals0 == vals1) | (vals0.isna() & vals1.isna())
+    if same.all():
+        return isDiff
+    vals0 = vals0[~same]
+    vals1 = vals1[~same]
+
+    #turn pandas null to blank 
+    vals0 = vals0.astype(object).where(vals0.notna(), '')
+    vals1 = vals1.astype(object).where(vals1.notna(), '')
+
+    #special fix for progtitl
+    if col == 'PROGTITL':
+        vals0 = vals0.astype(str).str.replace('  ', ' ')
+        vals1 = vals1.astype(str).str.replace('  ', ' ')
+
+    #lowercase string compare
+    str0 = vals0.astype(str).str.lower()
+    str1 = vals1.astype(str).str.lower()
+    strDiff = str0 != str1
+
+    #where strings differ but both are numbers, compare in decimal format instead
+    if strDiff.any():
+        num0 = pd.to_numeric(vals0[strDiff], errors='coerce')
+        num1 = pd.to_numeric(vals1[strDiff], errors='coerce')
+        both = num0.notna() & num1.notna()
+        both = both[both].index
+        if len(both) > 0:
+            strDiff[both] = num0[both].map('{:.1f}'.format) != num1[both].map('{:.1f}'.format)
+
+    isDiff[strDiff.index] = strDiff
+    return isDiff
 
-    return results
 
 def val_smart_diff(val0, val1, col=None):
 
@@ -469,7 +624,7 @@ def val_smart_diff(val0, val1, col=None):
     #special fix for progtitl
     if col == 'PROGTITL':
         val0 = val0.replace('  ',' ')
-        val1 = val0.replace('  ',' ')
+        val1 = val1.replace('  ',' ')
 
     #try to decimal format (if not then no problem)
     try:
@@ -497,26 +652,9 @@ def load_metadata_file_as_df(filepath):
 
     if not os.path.isfile(filepath): return False
 
-    with open(filepath, 'r', errors='replace') as f:
-
-        # Read first line of header and find all column widths using '|' split
-        header = f.readline().strip()
-        cols = header.split('|')
-        colWidths = []
-        for col in cols:
-            w = len(col)
-            if w <= 1: continue;
-            colWidths.append(w+1)
-
-        #read fixed-width formatted metadata file using calculated col widths and remove garbage
-        data = pd.read_fwf(filepath, widths=colWidths, skiprows=range(1,4))
-        data.columns = data.columns.str.replace('|','')
-        data.columns = data.columns.str.strip()
-
-        data.name = os.path.basename(filepath)
-        return data
-
-    return None
+    data = ipac_table.read_table(filepath)
+    data.name = os.path.basename(filepath)
+    return data
 
 def header_keyword_report(keywordsDefFile, fitsFile):
 
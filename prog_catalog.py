@@ -0,0 +1,142 @@
+"""
+  Program info (PI last name, title, institution) by semid, fetched in bulk.
+
+  fetch() looks up all new semids with one koa_program/koa_pi query (semid IN ...)
+  and gets their institutions from the proposals API concurrently (the API has no
+  multi-program request).  Each semid is only fetched once; programs not found
+  are remembered as None so they are not looked up again.  An institution whose
+  API request failed is left unfetched (False) and requested again on next lookup.
+
+  The get_prog_pi/get_prog_title/get_prog_inst functions in common.py use one
+  shared catalog (common.get_prog_catalog()), so prefetching the night's semids
+  up front (schedule, createprog.txt) turns the per-file lookups into dict reads.
+
+  Usage:
+    catalog = get_prog_catalog()
+    catalog.fetch(catalog.get_obtain_semids(obData, '2021A'))
+    pi = catalog.get('2021A_U123', 'pi')
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+import db_conn
+import common
+
+
+KEYS = ('pi', 'title', 'inst')
+
+
+class ProgramCatalog:
+
+    def __init__(self, log=None, numThreads=8):
+        '''
+        @param log: optional logger
+        @param numThreads: max concurrent proposals API requests
+        '''
+        self.log        = log
+        self.numThreads = numThreads
+        self.progs      = {}
+
+
+    def clear(self):
+        self.progs = {}
+
+
+    def get(self, semid, key):
+        '''
+        Returns semid info value ('pi', 'title' or 'inst'), None if the program
+        was not found, or False if it was not fetched yet (or its request failed).
+        '''
+        prog = self.progs.get(semid)
+        if prog is None: return False
+        return prog.get(key)
+
+
+    def set(self, semid, key, val):
+        self.progs.setdefault(semid, dict.fromkeys(KEYS))[key] = val
+
+
+    def fetch(self, semids):
+        '''
+        Fetches info for all semids not already in the catalog, and institutions
+        whose API request failed before.
+        Returns False if the database query failed (those semids are not cached).
+        '''
+        semids = sorted(set(s for s in semids if s and is_semid(s)))
+        newSemids  = [s for s in semids if s not in self.progs]
+        instSemids = [s for s in semids if s not in self.progs or self.progs[s]['inst'] is False]
+        if not instSemids: return True
+
+        rows = {}
+        if newSemids:
+            db = db_conn.db_conn('config.live.ini', configKey='DATABASE')
+            query = ( 'select p.semid, p.progtitl, pi.pi_lastname '
+                      ' from koa_program as p left join koa_pi as pi on p.piID=pi.piID '
+                      ' where p.semid in (' + ', '.join(['%s'] * len(newSemids)) + ')')
+            data = db.query('koa', query, params=newSemids)
+            if data is False:
+                if self.log: self.log.warning(f'prog_catalog: unable to query program info for {newSemids}')
+                return False
+            rows = {row['semid']: row for row in data}
+
+        with ThreadPoolExecutor(max_workers=max(1, self.numThreads)) as pool:
+            insts = list(pool.map(get_inst, instSemids))
+
+        for semid in newSemids:
+            row = rows.get(semid, {})
+            pi = row.get('pi_lastname')
+            self.progs[semid] = {'pi'   : pi.replace(' ','') if pi is not None else None,
+                                 'title': row.get('progtitl'),
+                                 'inst' : False}
+        for semid, inst in zip(instSemids, insts):
+            self.progs[semid]['inst'] = inst
+        failed = [semid for semid, inst in zip(instSemids, insts) if inst is False]
+        if failed and self.log: self.log.warning(f'prog_catalog: institution request failed for {failed}, will retry')
+        if self.log: self.log.info(f'prog_catalog: fetched info for {len(newSemids)} programs ({len(rows)} in db)')
+        return True
+
+
+    def get_obtain_semids(self, obData, semester):
+        '''Returns semids of the programs in dep_obtain schedule data.'''
+        semids = []
+        for row in obData:
+            for progid in (row.get('ProjCode') or '').split(','):
+                progid = progid.strip().upper()
+                if progid and progid != 'NONE' and common.is_progid_valid(progid):
+                    semids.append(progid if '_' in progid else semester + '_' + progid)
+        return semids
+
+
+    def get_createprog_semids(self, fname, semester, numCols=12):
+        '''
+        Returns semids in a createprog.txt file: valid progids (cols 8) and
+        ToO programs in outdir (col 4, ie /s/sdata/.../2021A_ToO_U123).
+        '''
+        semids = []
+        with open(fname, 'r') as f:
+            lines = [line.strip() for line in f]
+        for i in range(0, len(lines) - numCols + 1, numCols):
+            outdir, progid = lines[i+3], lines[i+7]
+            if '_ToO_' in outdir:
+                progid = outdir.split('_ToO_')[1].split('/')[0]
+            if progid not in ('PROGID', 'ENG') and common.is_progid_valid(progid):
+                semids.append(progid if '_' in progid else semester + '_' + progid)
+        return semids
+
+
+def is_semid(semid):
+    '''Skips malformed semids, semid must look like 2021A_U123.'''
+    return re.match(r'^\d{4}[AB]_\w+$', semid) is not None
+
+
+def get_inst(semid):
+    '''
+    Returns program institution from the proposals API, None if the API has
+    none for semid, or False if the request failed.
+    '''
+    url = common.get_proposal_api() + 'ktn='+semid+'&cmd=getAllocInst&json=True'
+    data = common.get_api_data(url)
+    if not isinstance(data, dict):
+        return False
+    if not data.get('success'):
+        return None
+    return data.get('data', {}).get('AllocInst')
@@ -0,0 +1,187 @@
+"""
+  Persistent inventory of FITS files in the sdata search dirs, stored in SQLite
+  (one db file per instrument).  Used by dep_locate.find_24hr_fits so the nightly
+  24 hour search is an indexed query on mtime instead of a crawl of every file.
+
+  The inventory is refreshed incrementally: each known directory is stat'ed and
+  only listed again if its mtime changed, or if it was last listed within
+  'settle' seconds of its last change (files may still have been being written).
+  NOTE: A file modified in place (no create/delete/rename in its directory) does
+  not change the directory mtime and is not picked up until its directory changes.
+
+  Usage:
+    inv = SdataInventory('/path/to/HIRES.inventory.sqlite')
+    inv.refresh(useDirs)
+    records = inv.find(useDirs, minTime, maxTime)
+"""
+import os
+import sqlite3
+import time
+from timed_crawl import TimedCrawler
+
+
+class SdataInventory:
+
+    def __init__(self, dbFile, settle=3600, log=None):
+        '''
+        @param dbFile: SQLite inventory file path (created if needed)
+        @param settle: seconds after a dir change before a listing is trusted
+        @param log: optional logger
+        '''
+        self.dbFile = dbFile
+        self.settle = settle
+        self.log    = log
+        self.failedDirs = []
+        dbDir = os.path.dirname(dbFile)
+        if dbDir and not os.path.isdir(dbDir): os.makedirs(dbDir)
+        self.conn = sqlite3.connect(dbFile)
+        self.create_tables()
+
+
+    def create_tables(self):
+        cur = self.conn.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                    'path TEXT PRIMARY KEY, parent TEXT, mtime REAL, scanned REAL)')
+        cur.execute('CREATE TABLE IF NOT EXISTS files ('
+                    'path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL, inode INTEGER)')
+        cur.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+        cur.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+        cur.execute('CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)')
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def refresh(self, useDirs, numThreads=8, timeout=None, retries=0):
+        '''
+        Updates the inventory for the given root dirs.  Dirs are stat'ed/listed
+        concurrently; all db writes happen in this thread.  Root dirs with a dir
+        scan that timed out (see timed_crawl.py) are left partly refreshed and
+        listed in self.failedDirs.
+        Returns dict of counts: dirs listed, dirs skipped (unchanged).
+        '''
+        stats = {'listed': 0, 'skipped': 0}
+        now = time.time()
+        def handle(idx, task, result):
+            path = task[0]
+            if result is None:
+                self.remove_dir(path)
+                return []
+            if result['files'] is None:
+                stats['skipped'] += 1
+                subDirs = self.get_subdirs(path)
+            else:
+                stats['listed'] += 1
+                subDirs = result['subDirs']
+                self.update_dir(path, result, now)
+            return [(subDir, self.get_dir(subDir), self.settle) for subDir in subDirs]
+
+        roots = [norm_dir(root) for root in useDirs]
+        crawler = TimedCrawler(scan_dir, numThreads, timeout, retries, self.log)
+        failed = crawler.run([(root, self.get_dir(root), self.settle) for root in roots], handle)
+        self.failedDirs = [useDirs[idx] for idx in failed]
+        self.conn.commit()
+        if self.log: self.log.info('sdata_inventory: {} dirs listed, {} unchanged dirs skipped'.format(stats['listed'], stats['skipped']))
+        return stats
+
+
+    def find(self, useDirs, minTime=None, maxTime=None):
+        '''
+        Returns list of (path, mtime, order) for files under the given root dirs
+        with minTime < mtime <= maxTime (no limit if None), sorted by mtime.
+        Order is (root index, path) as with dep_locate.crawl_fits_dirs.
+        '''
+        sql = 'SELECT path, mtime FROM files WHERE (dir = ? OR dir LIKE ? ESCAPE ?)'
+        where = []
+        if minTime is not None: where.append(('AND mtime > ?', minTime))
+        if maxTime is not None: where.append(('AND mtime <= ?', maxTime))
+        sql += ' ' + ' '.join(w[0] for w in where)
+
+        records = {}
+        cur = self.conn.cursor()
+        for idx, root in enumerate(useDirs):
+            root = norm_dir(root)
+            likeRoot = root.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            likeRoot = (likeRoot if likeRoot.endswith('/') else likeRoot + '/') + '%'
+            params = [root, likeRoot, '\\'] + [w[1] for w in where]
+            for path, mtime in cur.execute(sql, params):
+                if path not in records:
+                    records[path] = (path, mtime, (idx, path))
+        return sorted(records.values(), key=lambda r: (r[1], r[2]))
+
+
+    def get_dir(self, path):
+        '''Returns (mtime, scanned) for a known dir or None.'''
+        return self.conn.execute('SELECT mtime, scanned FROM dirs WHERE path = ?', (path,)).fetchone()
+
+
+    def get_subdirs(self, path):
+        return [r[0] for r in self.conn.execute('SELECT path FROM dirs WHERE parent = ? ORDER BY path', (path,))]
+
+
+    def update_dir(self, path, result, scanTime):
+        '''Replaces the file and subdir records of one listed dir.'''
+        cur = self.conn.cursor()
+        cur.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime, scanned) VALUES (?, ?, ?, ?)',
+                    (path, os.path.dirname(path), result['mtime'], scanTime))
+        cur.execute('DELETE FROM files WHERE dir = ?', (path,))
+        cur.executemany('INSERT OR REPLACE INTO files (path, dir, size, mtime, inode) VALUES (?, ?, ?, ?, ?)',
+                        [(p, path, size, mtime, inode) for p, size, mtime, inode in result['files']])
+
+        #remove subdirs that no longer exist
+        for subDir in self.get_subdirs(path):
+            if subDir not in result['subDirs']:
+                self.remove_dir(subDir)
+
+
+    def remove_dir(self, path):
+        '''Removes a dir and everything below it from the inventory.'''
+        likePath = path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ? ESCAPE '\\'", (path, likePath))
+        cur.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (path, likePath))
+
+
+def norm_dir(path):
+    '''Strips trailing slash (except for root dir).'''
+    if path.endswith('/') and len(path) > 1: path = path[:-1]
+    return path
+
+
+def is_fits_name(name):
+    return name.endswith('.fits') or name.endswith('fits.gz')
+
+
+def scan_dir(path, known, settle):
+    '''
+    Stats a dir and lists it if it changed since the known (mtime, scanned).
+    Returns None if dir is unreadable, else dict with dir 'mtime', 'files'
+    (list of (path, size, mtime, inode), or None if unchanged) and 'subDirs'.
+    Like os.walk, symlinked dirs are not followed.
+    '''
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if known and known[0] == mtime and known[1] - mtime > settle:
+        return {'mtime': mtime, 'files': None, 'subDirs': None}
+
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return None
+    files = []
+    subDirs = []
+    for entry in sorted(entries, key=lambda e: e.name):
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink(): subDirs.append(entry.path)
+                continue
+            if not is_fits_name(entry.name): continue
+            st = entry.stat()
+            files.append((''.join((path, '/', entry.name)), st.st_size, st.st_mtime, entry.inode()))
+        except OSError:
+            continue
+    return {'mtime': mtime, 'files': files, 'subDirs': subDirs}
@@ -0,0 +1,199 @@
+"""
+  Pooled file copy used by dep_locate to copy sdata FITS files to the stage dir.
+
+  Each copy is written to a temp '.part' file and renamed into place, the size is
+  verified against the source and the source stats are copied (like shutil.copy2).
+  If an md5 is wanted it is computed from the chunks as they are copied (one read
+  of the source), otherwise a zero-copy (copy_file_range/sendfile) copy is used.
+
+  Staging modes (LOCATE STAGE_MODE) avoid the byte copy when source and stage are
+  on the same filesystem (ie reprocessing with --searchDir):
+    copy             - full copy (default)
+    hardlink         - hard link to source
+    reflink          - copy-on-write clone (FICLONE, ie btrfs/xfs)
+    symlink-readonly - symlink to source (stage files must only ever be read)
+  If a link/clone is not possible, the file is copied.  Gzipped files are always
+  copied since dep_rawfiles gunzips them in place.  No md5 is computed for files
+  that are linked/cloned (that would mean reading them).
+
+  gunzip_files decompresses staged .fits.gz files in-process on a thread pool
+  (zlib releases the GIL), like gunzip: the output gets the .gz file's stats and
+  the .gz is removed.
+
+  Usage:
+    results = copy_files([(src1, dst1), (src2, dst2)], numThreads=4, doMd5=True)
+    paths   = gunzip_files([path1, path2], numThreads=4)
+"""
+import os
+import shutil
+import hashlib
+import fcntl
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from common import get_file_md5
+
+
+CHUNK_SIZE = 4*1024*1024
+STAGE_MODES = ('copy', 'hardlink', 'reflink', 'symlink-readonly')
+FICLONE = 0x40049409
+
+
+def copy_files(pairs, numThreads=4, doMd5=False, log=None, mode='copy'):
+    '''
+    Copies list of (source, destination) pairs with at most numThreads at once.
+    Returns list of result dicts (same order as pairs) with keys:
+        source, dest, ok, copied (False if dest already existed), md5, error,
+        method (copy, hardlink, reflink or symlink-readonly)
+    '''
+    assert mode in STAGE_MODES, f'stage mode "{mode}" not in {STAGE_MODES}'
+    def do_copy(pair):
+        source, dest = pair
+        try:
+            return copy_file(source, dest, doMd5, mode)
+        except Exception as e:
+            if log: log.error('stage_copy: could not copy {} to {}: {}'.format(source, dest, e))
+            return {'source': source, 'dest': dest, 'ok': False, 'copied': False, 'md5': None, 'error': str(e), 'method': None}
+
+    if not pairs: return []
+    with ThreadPoolExecutor(max_workers=max(1, numThreads)) as pool:
+        return list(pool.map(do_copy, pairs))
+
+
+def copy_file(source, dest, doMd5=False, mode='copy'):
+    '''
+    Copies one file (see module doc).  If dest exists it is not copied again
+    (md5 of the existing dest is computed if doMd5).
+    '''
+    result = {'source': source, 'dest': dest, 'ok': True, 'copied': False, 'md5': None, 'error': None, 'method': None}
+
+    rDir = os.path.dirname(dest)
+    if rDir and not os.path.exists(rDir):
+        os.makedirs(rDir, exist_ok=True)
+    if os.path.exists(dest):
+        if doMd5: result['md5'] = get_file_md5(dest)
+        return result
+
+    size = os.stat(source).st_size
+    tmpDest = dest + '.part'
+    if mode != 'copy' and not source.endswith('.gz'):
+        if link_file(source, tmpDest, mode):
+            os.replace(tmpDest, dest)
+            result['copied'] = True
+            result['method'] = mode
+            return result
+
+    try:
+        with open(source, 'rb') as fsrc, open(tmpDest, 'wb') as fdst:
+            if doMd5: result['md5'] = copy_with_md5(fsrc, fdst)
+            else    : zero_copy(fsrc, fdst, size)
+        destSize = os.stat(tmpDest).st_size
+        if destSize != size:
+            raise IOError('size mismatch {} != {}'.format(destSize, size))
+        shutil.copystat(source, tmpDest)
+        os.replace(tmpDest, dest)
+    except:
+        if os.path.exists(tmpDest): os.remove(tmpDest)
+        raise
+
+    result['copied'] = True
+    result['method'] = 'copy'
+    return result
+
+
+def link_file(source, dest, mode):
+    '''
+    Creates dest as a hardlink, reflink clone or symlink of source.
+    Returns False (leaving no dest) if the filesystem does not allow it.
+    '''
+    if os.path.lexists(dest): os.remove(dest)
+    try:
+        if mode == 'hardlink':
+            os.link(source, dest)
+        elif mode == 'symlink-readonly':
+            os.symlink(os.path.abspath(source), dest)
+        elif mode == 'reflink':
+            with open(source, 'rb') as fsrc, open(dest, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(source, dest)
+        return True
+    except OSError:
+        if os.path.lexists(dest): os.remove(dest)
+        return False
+
+
+def copy_with_md5(fsrc, fdst, chunkSize=CHUNK_SIZE):
+    '''Copies in chunks, returns md5 hex digest of the data copied.'''
+    md5 = hashlib.md5()
+    buf = bytearray(chunkSize)
+    view = memoryview(buf)
+    while True:
+        n = fsrc.readinto(buf)
+        if not n: break
+        md5.update(view[:n])
+        fdst.write(view[:n])
+    return md5.hexdigest()
+
+
+def zero_copy(fsrc, fdst, size):
+    '''
+    Copies using copy_file_range (can be server side on NFS 4.2), then sendfile,
+    then a plain buffered copy, whichever the platform/filesystem supports.
+    '''
+    inFd  = fsrc.fileno()
+    outFd = fdst.fileno()
+    offset = 0
+    for func in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, func): continue
+        try:
+            while offset < size:
+                if func == 'copy_file_range': n = os.copy_file_range(inFd, outFd, min(size - offset, 1<<30))
+                else                        : n = os.sendfile(outFd, inFd, offset, min(size - offset, 1<<30))
+                if n == 0: break
+                offset += n
+            if offset >= size: return
+        except OSError:
+            #nothing written yet with this method? try next one from where we are
+            pass
+        os.lseek(inFd, offset, os.SEEK_SET)
+        os.lseek(outFd, offset, os.SEEK_SET)
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+
+def gunzip_files(paths, numThreads=4, log=None):
+    '''
+    Decompresses list of .gz files with at most numThreads at once.
+    Returns list (same order) of decompressed paths, or None for failures.
+    '''
+    def do_gunzip(path):
+        try:
+            return gunzip_file(path)
+        except Exception as e:
+            if log: log.error('stage_copy: could not gunzip {}: {}'.format(path, e))
+            return None
+
+    if not paths: return []
+    with ThreadPoolExecutor(max_workers=max(1, numThreads)) as pool:
+        return list(pool.map(do_gunzip, paths))
+
+
+def gunzip_file(path):
+    '''
+    Decompresses path (ending in .gz) next to itself and removes the .gz.
+    If the output already exists, it is used as is (and the .gz left alone).
+    '''
+    outPath = path[:-3]
+    if os.path.exists(outPath):
+        return outPath
+    tmpPath = outPath + '.part'
+    try:
+        with gzip.open(path, 'rb') as fin, open(tmpPath, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+        shutil.copystat(path, tmpPath)
+        os.replace(tmpPath, outPath)
+    except:
+        if os.path.exists(tmpPath): os.remove(tmpPath)
+        raise
+    os.remove(path)
+    return outPath
@@ -0,0 +1,109 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+import common
+import prog_catalog
+"""
+test_common.py runs tests on common.py helpers.
+Run with the shell command:
+pytest -m common test_common.py
+"""
+
+PROGS = {'2021A_U123': {'semid': '2021A_U123', 'progtitl': 'Title A', 'pi_lastname': 'Van Smith'},
+         '2021A_C456': {'semid': '2021A_C456', 'progtitl': 'Title B', 'pi_lastname': None}}
+
+class FakeDb:
+    queries = []
+    fail = False
+    def __init__(self, *args, **kwargs): pass
+    def query(self, database, query, getOne=False, params=None):
+        FakeDb.queries.append((query, params))
+        if FakeDb.fail: return False
+        return [row for semid, row in PROGS.items() if semid in params]
+
+
+@pytest.fixture
+def fake_services(monkeypatch):
+    apiCalls = []
+    def fake_api(url):
+        apiCalls.append(url)
+        return {'success': 1, 'data': {'AllocInst': 'UC'}}
+    monkeypatch.setattr(common.db_conn, 'db_conn', FakeDb)
+    monkeypatch.setattr(common, 'get_api_data', fake_api)
+    monkeypatch.setattr(common, 'get_proposal_api', lambda: 'http://api/?')
+    FakeDb.queries = []
+    FakeDb.fail = False
+    common.clear_prog_cache()
+    return apiCalls
+
+
+@pytest.mark.common
+def test_prog_info_cache(fake_services):
+    apiCalls = fake_services
+
+    #each semid looked up once
+    for i in range(3):
+        assert common.get_prog_pi('2021A_U123', 'PROGPI') == 'VanSmith'
+        assert common.get_prog_title('2021A_U123', 'PROGTITL') == 'Title A'
+        assert common.get_prog_inst('2021A_U123', 'PROGINST') == 'UC'
+        assert common.get_prog_pi('2021A_C456', 'NONE') == 'NONE'
+        assert common.get_prog_title('2021A_N999', 'NONE') == 'NONE'
+    assert len(FakeDb.queries) == 3
+    assert len(apiCalls) == 3
+
+    #failed query is not cached
+    common.clear_prog_cache()
+    FakeDb.fail = True
+    assert common.get_prog_title('2021A_U123', 'NONE') == 'NONE'
+    FakeDb.fail = False
+    assert common.get_prog_title('2021A_U123', 'NONE') == 'Title A'
+
+
+@pytest.mark.common
+def test_prog_inst_retry(fake_services, monkeypatch):
+    '''a failed institution request is retried on the next lookup, not cached'''
+    apiCalls = []
+    results = [None, {'success': 1, 'data': {'AllocInst': 'UC'}}, {'success': 0}]
+    def fake_api(url):
+        apiCalls.append(url)
+        return results[min(len(apiCalls), len(results)) - 1]
+    monkeypatch.setattr(common, 'get_api_data', fake_api)
+
+    assert common.get_prog_inst('2021A_U123', 'PROGINST') == 'PROGINST'
+    assert common.get_prog_pi('2021A_U123', 'PROGPI') == 'VanSmith'
+    assert common.get_prog_inst('2021A_U123', 'PROGINST') == 'UC'
+    assert common.get_prog_inst('2021A_U123', 'PROGINST') == 'UC'
+    assert len(apiCalls) == 2 and len(FakeDb.queries) == 1
+
+    #no institution in the API is cached
+    assert common.get_prog_inst('2021A_C456', 'PROGINST') == 'PROGINST'
+    assert common.get_prog_inst('2021A_C456', 'PROGINST') == 'PROGINST'
+    assert len(apiCalls) == 3
+
+
+@pytest.mark.common
+def test_prog_catalog_prefetch(fake_services, tmp_path):
+    apiCalls = fake_services
+    catalog = common.get_prog_catalog()
+    obData = [{'ProjCode': 'U123'}, {'ProjCode': 'NONE'}, {'ProjCode': 'C456,N999'}]
+    fname = str(tmp_path / 'createprog.txt')
+    with open(fname, 'w') as f:
+        for outdir, progid in (('/s/sdata/2021A_ToO_N111/', 'PROGID'), ('/s/sdata/x', 'U123'), ('/s/sdata/y', 'ENG')):
+            f.write('\n'.join(['file', 'utdate', 'utc', outdir, 'obs', '1', 'OBJECT', progid, 'pi', 'inst', 'titl', 'oa']) + '\n')
+    semids = catalog.get_obtain_semids(obData, '2021A') + catalog.get_createprog_semids(fname, '2021A')
+    assert sorted(set(semids)) == ['2021A_C456', '2021A_N111', '2021A_N999', '2021A_U123']
+
+    #one query for all, then no more lookups
+    assert catalog.fetch(semids + ['bad"semid'])
+    query, params = FakeDb.queries[0]
+    assert len(FakeDb.queries) == 1 and 'in (%s, %s, %s, %s)' in query
+    assert params == ['2021A_C456', '2021A_N111', '2021A_N999', '2021A_U123']
+    assert len(apiCalls) == 4
+    for semid in semids:
+        common.get_prog_pi(semid, 'NONE')
+        common.get_prog_inst(semid, 'NONE')
+    assert len(FakeDb.queries) == 1 and len(apiCalls) == 4
+    assert catalog.get('2021A_U123', 'title') == 'Title A'
+    assert catalog.get('2021A_N999', 'title') is None
+    assert catalog.get('2021A_X000', 'title') is False
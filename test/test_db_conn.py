@@ -0,0 +1,119 @@
+import pytest
+import sys
+import os
+import threading
+sys.path.append(os.path.pardir)
+import db_conn
+"""
+test_db_conn.py runs tests on the db_conn connection pool (no database needed).
+Run with the shell command:
+pytest -m db test_db_conn.py
+"""
+
+class FakeCursor:
+    def __init__(self, conn): self.conn = conn
+    def execute(self, query, params=None):
+        if self.conn.closed: raise db_conn.pymysql.err.InterfaceError('closed')
+        self.conn.queries += 1
+        self.rowcount = 1
+    def executemany(self, query, paramsList):
+        if self.conn.closed: raise db_conn.pymysql.err.OperationalError('lost')
+        self.conn.many.append((query, paramsList))
+        self.rowcount = len(paramsList)
+    def fetchall(self): return [{'x': 1}]
+    def close(self): pass
+
+class FakeConn:
+    def __init__(self):
+        self.pings = 0
+        self.queries = 0
+        self.many = []
+        self.closed = False
+    def cursor(self, cursorType=None): return FakeCursor(self)
+    def ping(self, reconnect=False): self.pings += 1
+    def close(self): self.closed = True
+
+
+@pytest.fixture
+def fake_db(tmp_path, monkeypatch):
+    configFile = str(tmp_path / 'config.live.ini')
+    with open(configFile, 'w') as f:
+        f.write("DATABASE: {koa: {server: 'x', user: 'u', pwd: 'p', type: 'mysql'}}\n")
+    conns = []
+    def connect(**kwargs):
+        conns.append(FakeConn())
+        return conns[-1]
+    monkeypatch.setattr(db_conn.pymysql, 'connect', connect)
+    db_conn.close_pool()
+    yield configFile, conns
+    db_conn.close_pool()
+
+
+@pytest.mark.db
+def test_pool_reuse(fake_db, monkeypatch):
+    configFile, conns = fake_db
+    loads = []
+    monkeypatch.setattr(db_conn.yaml, 'safe_load', lambda f: loads.append(1) or {'DATABASE': {'koa': {'server': 'x', 'user': 'u', 'pwd': 'p', 'type': 'mysql'}}})
+    db_conn.configCache.clear()
+
+    #one config parse and one connection for many objects and queries, no pings
+    for i in range(5):
+        db = db_conn.db_conn(configFile, configKey='DATABASE')
+        assert db.query('koa', 'select 1') == [{'x': 1}]
+        db.close()
+    assert len(loads) == 1
+    assert len(conns) == 1 and conns[0].queries == 5 and conns[0].pings == 0 and not conns[0].closed
+
+    #idle connection is pinged before reuse
+    monkeypatch.setattr(db_conn, 'PING_IDLE', -1)
+    db.query('koa', 'select 1')
+    assert conns[0].pings == 1 and len(conns) == 1
+
+    #lost connection is dropped and replaced
+    monkeypatch.setattr(db_conn, 'PING_IDLE', 60)
+    conns[0].closed = True
+    assert db.query('koa', 'select 1') is False
+    assert db.query('koa', 'select 1') == [{'x': 1}]
+    assert len(conns) == 2
+
+
+@pytest.mark.db
+def test_pool_per_thread(fake_db):
+    configFile, conns = fake_db
+    db = db_conn.db_conn(configFile, configKey='DATABASE')
+    used = []
+    def work():
+        for i in range(3): db.query('koa', 'select 1')
+        used.append(db.connect('koa'))
+        db_conn.close_pool()
+    threads = [threading.Thread(target=work) for i in range(3)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(conns) == 3
+    assert len(set(id(c) for c in used)) == 3
+
+
+@pytest.mark.db
+def test_executemany_and_query_types(fake_db):
+    configFile, conns = fake_db
+    db = db_conn.db_conn(configFile, configKey='DATABASE')
+    query = 'insert into koa_x (a, b) values (%s, %s)'
+    assert db.executemany('koa', query, [(1, 'x'), (2, 'y')]) == 2
+    assert db.executemany('koa', query, []) == 0
+    assert conns[0].many == [(query, [(1, 'x'), (2, 'y')])]
+
+    #query type is cached per query text, select is case insensitive
+    assert db.query('koa', '  SELECT 1') == [{'x': 1}]
+    assert db_conn.queryTypes['  SELECT 1'] == 'select'
+    assert db.query('koa', 'update koa_x set a=%s', params=(1,)) == 1
+
+    db.readOnly = 1
+    assert db.query('koa', 'update koa_x set a=1') is False
+    assert db.executemany('koa', query, [(1, 'x')]) is False
+
+    #lost connection is dropped from the pool, not reused
+    db.readOnly = 0
+    conns[0].closed = True
+    assert db.executemany('koa', query, [(1, 'x')]) is False
+    assert db.executemany('koa', query, [(3, 'z')]) == 1
+    assert len(conns) == 2 and conns[1].many == [(query, [(3, 'z')])]
@@ -0,0 +1,198 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+import numpy as np
+from astropy.io import fits
+import dep_dqa
+"""
+test_dep_dqa.py runs tests on the dep_dqa table writing functions.
+Run with the shell command:
+pytest -m dqa test_dep_dqa.py
+"""
+
+
+def make_hdus():
+    cols = [fits.Column(name='NAME', format='10A', array=np.array(['a', 'bb'])),
+            fits.Column(name='VAL', format='20A', array=np.array(['1.5', '2.0']))]
+    table = fits.BinTableHDU.from_columns(cols, name='TARGETS')
+    return fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.zeros((2, 2)), name='IMG'), table])
+
+
+@pytest.mark.dqa
+def test_write_fits_extension_tables(tmp_path):
+    '''tables go in outDir named after the KOAID, not in the NIRSPEC spec/scam subdirs'''
+    outDir = str(tmp_path)
+    extFiles = dep_dqa.write_fits_extension_tables(make_hdus(), 'spec/NS.20210208.00001.fits', outDir=outDir)
+    outFile = outDir + '/NS.20210208.00001.ext2.TARGETS.tbl'
+    assert extFiles == [outFile]
+    with open(outFile) as f:
+        assert f.read() == ('\\ Extended Header Name: TARGETS\n'
+                            '|NAME            |VAL                 |\n'
+                            '|char            |char                |\n'
+                            '|                |                    |\n'
+                            '|                |                    |\n'
+                            ' a                1.5                 \n'
+                            ' bb               2.0                 \n')
+
+    #default outDir is the dir of filepath
+    os.makedirs(outDir + '/lev0')
+    extFiles = dep_dqa.write_fits_extension_tables(make_hdus(), outDir + '/lev0/HI.20210208.00001.fits')
+    assert extFiles == [outDir + '/lev0/HI.20210208.00001.ext2.TARGETS.tbl']
+
+
+@pytest.mark.dqa
+def test_make_ext_md5_table(tmp_path):
+    outDir = str(tmp_path)
+    extFiles = dep_dqa.write_fits_extension_tables(make_hdus(), 'NS.20210208.00001.fits', outDir=outDir)
+    extFiles += dep_dqa.write_fits_extension_tables(make_hdus(), 'NS.20210208.00002.fits', outDir=outDir)
+    dep_dqa.make_ext_md5_table(outDir, extFiles, md5Prepend='20210208.')
+    with open(outDir + '/20210208.ext.md5sum.table') as f: lines = f.read().splitlines()
+    assert [line.split()[1] for line in lines] == ['NS.20210208.00001.ext2.TARGETS.tbl', 'NS.20210208.00002.ext2.TARGETS.tbl']
+    assert all(len(line.split()[0]) == 32 for line in lines)
+
+
+class FakeInstr:
+    '''Just enough of an instrument object to run dep_dqa on plain FITS files.'''
+
+    def __init__(self, rootDir):
+        import logging
+        self.instr     = 'HIRES'
+        self.utDate    = '2021-02-08'
+        self.utDateDir = '20210208'
+        self.endTime   = '20:00:00'
+        self.log       = logging.getLogger('test_dep_dqa')
+        self.dirs      = {'stage': rootDir + '/stage', 'lev0': rootDir + '/lev0', 'udf': rootDir + '/udf'}
+        self.config    = {'RUNTIME': {'DEV': 0}, 'MISC': {}}
+        self.metadataTablesDir = rootDir
+        self.keywordSkips = []
+        self.extraMeta = {}
+        self.dqaDate   = None
+        for d in self.dirs.values(): os.makedirs(d, exist_ok=True)
+
+    def dqa_loc(self, delete=0): pass
+    def run_psfr(self): pass
+    def make_jpg(self): pass
+    def get_obtain_schedule(self): return None
+    def get_semid(self): return '2021A_U123'
+    def is_science(self): return False
+    def is_fits_valid(self): return True
+    def check_filetime_vs_window(self, filename): return True
+
+    def set_fits_file(self, filename):
+        self.fitsHdu = fits.open(filename)
+        self.fitsHeader = self.fitsHdu[0].header
+        self.fitsFilepath = filename
+        return True
+
+    def run_dqa_checks(self, progData):
+        self.fitsHeader['DQA_DATE'] = self.dqaDate
+        return True
+
+    def write_lev0_fits_file(self):
+        subdir = {'NC': '/scam', 'NS': '/spec'}.get(self.fitsHeader['KOAID'][:2], '')
+        os.makedirs(self.dirs['lev0'] + subdir, exist_ok=True)
+        self.fitsHdu.writeto(self.dirs['lev0'] + subdir + '/' + self.fitsHeader['KOAID'], overwrite=True)
+        return True
+
+
+def setup_dqa(tmp_path, monkeypatch):
+    '''FakeInstr with keyword defs and two raw files (second staged with LOCATE KEEP_GZ)'''
+    from test_metadata import write_keyword_defs
+    monkeypatch.setattr(dep_dqa, 'create_prog', lambda instrObj: None)
+    monkeypatch.setattr(dep_dqa.gpi, 'getProgInfo', lambda *args, **kwargs: [])
+    instrObj = FakeInstr(str(tmp_path))
+    keyDefsFile = str(tmp_path / 'KOA_HIRES_Keyword_Table.txt')
+    write_keyword_defs(keyDefsFile)
+    with open(keyDefsFile, 'a') as f:
+        f.write('\t'.join(['DQA_DATE', 'char', 'N', '19', '', '', 'KOA', 'char', 'N', 'N', '']) + '\n')
+
+    rawFiles = []
+    for i, ext in enumerate(['.fits', '.fits.gz']):
+        rawFile = str(tmp_path / f'raw{i}{ext}')
+        hdr = fits.Header({'KOAID': f'HI.20210208.0000{i}.fits', 'OBJECT': 'M31', 'AIRMASS': 1.5})
+        fits.PrimaryHDU(header=hdr).writeto(rawFile)
+        rawFiles.append(rawFile)
+    with open(instrObj.dirs['stage'] + '/dep_locateHIRES.txt', 'w') as f:
+        f.write('\n'.join(rawFiles) + '\n')
+    return instrObj
+
+
+@pytest.mark.dqa
+def test_dep_dqa_twice(tmp_path, monkeypatch):
+    '''a re-run rewrites the lev0 files, so metadata rows must have the new DQA_DATE'''
+    import metadata
+    instrObj = setup_dqa(tmp_path, monkeypatch)
+    for dqaDate in ('2021-02-09T01:00:00', '2021-02-10T02:00:00'):
+        instrObj.dqaDate = dqaDate
+        dep_dqa.dep_dqa(instrObj)
+        df = metadata.load_metadata_file_as_df(instrObj.dirs['lev0'] + '/20210208.metadata.table')
+        assert df['KOAID'].tolist() == ['HI.20210208.00000.fits', 'HI.20210208.00001.fits']
+        assert df['DQA_DATE'].tolist() == [dqaDate, dqaDate]
+    assert not any(f.endswith('.index.json') for f in os.listdir(instrObj.dirs['stage']))
+    with open(instrObj.dirs['lev0'] + '/20210208.filelist.table') as f:
+        assert f.read().splitlines()[:2] == ['raw0.fits HI.20210208.00000.fits', 'raw1.fits HI.20210208.00001.fits']
+
+
+@pytest.mark.dqa
+def test_remake_metadata(tmp_path, monkeypatch):
+    '''metadata-only re-run re-reads only changed lev0 files and does not rewrite any'''
+    import metadata
+    instrObj = setup_dqa(tmp_path, monkeypatch)
+    with pytest.raises(Exception, match='run dqa first'):
+        dep_dqa.remake_metadata(instrObj)
+
+    instrObj.dqaDate = '2021-02-09T01:00:00'
+    dep_dqa.dep_dqa(instrObj)
+    lev0 = instrObj.dirs['lev0']
+    metaFile = lev0 + '/20210208.metadata.table'
+    md5File = lev0 + '/20210208.FITS.md5sum.table'
+    with open(metaFile) as f: origMeta = f.read()
+    with open(md5File) as f: origMd5 = f.read()
+
+    calls = []
+    getLine = metadata.get_fits_metadata_line
+    def spy(fitsFile, *args, **kwargs):
+        calls.append(os.path.basename(fitsFile))
+        return getLine(fitsFile, *args, **kwargs)
+    monkeypatch.setattr(metadata, 'get_fits_metadata_line', spy)
+
+    #first remake builds the index, output matches the full run
+    dep_dqa.remake_metadata(instrObj)
+    assert calls == ['HI.20210208.00000.fits', 'HI.20210208.00001.fits']
+    with open(metaFile) as f: assert f.read() == origMeta
+    with open(md5File) as f: assert f.read() == origMd5
+
+    #fix one lev0 file, only it is re-read
+    calls.clear()
+    fits.setval(lev0 + '/HI.20210208.00001.fits', 'DQA_DATE', value='2021-02-11T03:00:00')
+    mtime = os.path.getmtime(lev0 + '/HI.20210208.00000.fits')
+    dep_dqa.remake_metadata(instrObj)
+    assert calls == ['HI.20210208.00001.fits']
+    assert os.path.getmtime(lev0 + '/HI.20210208.00000.fits') == mtime
+    df = metadata.load_metadata_file_as_df(metaFile)
+    assert df['DQA_DATE'].tolist() == ['2021-02-09T01:00:00', '2021-02-11T03:00:00']
+    dep_dqa.make_dir_md5_table(lev0, '.fits', str(tmp_path / 'check.md5'))
+    with open(md5File) as f, open(tmp_path / 'check.md5') as f2:
+        assert f.read() == f2.read()
+
+
+@pytest.mark.dqa
+def test_dep_dqa_ext_tables(tmp_path, monkeypatch):
+    '''extension tables only for files directly in lev0, not NIRSPEC scam/spec subdirs'''
+    instrObj = setup_dqa(tmp_path, monkeypatch)
+    rawFiles = []
+    for i, koaid in enumerate(['HI.20210208.00010.fits', 'NS.20210208.00011.fits']):
+        rawFile = str(tmp_path / f'rawext{i}.fits')
+        hdus = make_hdus()
+        hdus[0].header['KOAID'] = koaid
+        hdus.writeto(rawFile)
+        rawFiles.append(rawFile)
+    with open(instrObj.dirs['stage'] + '/dep_locateHIRES.txt', 'w') as f:
+        f.write('\n'.join(rawFiles) + '\n')
+
+    dep_dqa.dep_dqa(instrObj)
+    lev0 = instrObj.dirs['lev0']
+    assert os.path.isfile(lev0 + '/spec/NS.20210208.00011.fits')
+    assert sorted(f for f in os.listdir(lev0) if '.ext' in f) == ['20210208.ext.md5sum.table', 'HI.20210208.00010.ext2.TARGETS.tbl']
+    assert not any('.ext' in f for f in os.listdir(lev0 + '/spec'))
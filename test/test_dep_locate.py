@@ -0,0 +1,458 @@
+import pytest
+import sys
+import os
+import calendar
+sys.path.append(os.path.pardir)
+import dep_locate
+"""
+test_dep_locate.py runs tests on the dep_locate file search.
+Run with the shell command:
+pytest -m locate test_dep_locate.py
+"""
+
+def make_file(path, modTime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f: f.write('x')
+    os.utime(path, (modTime, modTime))
+
+
+@pytest.mark.locate
+@pytest.mark.parametrize('numThreads', [1, 4])
+def test_find_24hr_fits(tmp_path, numThreads):
+    '''finds fits files in 24hr window across dirs, sorted by mtime'''
+    endTime = calendar.timegm((2021, 2, 8, 20, 0, 0))
+    root1 = str(tmp_path / 'sdata1')
+    root2 = str(tmp_path / 'sdata2') + '/'
+    make_file(root1 + '/a/b/late.fits', endTime - 10)
+    make_file(root1 + '/early.fits.gz', endTime - 20000)
+    make_file(root1 + '/old.fits', endTime - 90000)
+    make_file(root1 + '/future.fits', endTime + 10)
+    make_file(root1 + '/notes.txt', endTime - 100)
+    make_file(root2 + 'mid.fits', endTime - 5000)
+    os.symlink(root1 + '/a', root2 + 'link')
+    os.makedirs(str(tmp_path / 'empty'))
+
+    useDirs = [root1, root2, str(tmp_path / 'empty'), str(tmp_path / 'missing')]
+    paths = dep_locate.find_24hr_fits(useDirs, '2021-02-08', '20:00:00', numThreads=numThreads)
+    assert paths == [root1 + '/early.fits.gz', root2 + 'mid.fits', root1 + '/a/b/late.fits']
+
+    paths = dep_locate.find_24hr_fits(useDirs, '2021-02-08', '20:00:00', modtimeOverride=1, numThreads=numThreads)
+    assert paths[0] == root1 + '/old.fits' and paths[-1] == root1 + '/future.fits'
+    assert len(paths) == 5
+
+
+@pytest.mark.locate
+def test_find_24hr_fits_inventory(tmp_path):
+    '''inventory search matches the crawl and only relists changed dirs'''
+    import sdata_inventory
+    endTime = calendar.timegm((2021, 2, 8, 20, 0, 0))
+    root = str(tmp_path / 'sdata')
+    make_file(root + '/a/one.fits', endTime - 10)
+    make_file(root + '/b/two.fits', endTime - 20)
+    make_file(root + '/b/old.fits', endTime - 90000)
+    for d in (root + '/a', root + '/b', root):
+        os.utime(d, (endTime - 7200, endTime - 7200))
+    invFile = str(tmp_path / 'inv' / 'HIRES.inventory.sqlite')
+
+    args = ([root], '2021-02-08', '20:00:00')
+    crawl = dep_locate.find_24hr_fits(*args)
+    assert crawl == [root + '/b/two.fits', root + '/a/one.fits']
+    assert dep_locate.find_24hr_fits(*args, inventoryFile=invFile) == crawl
+
+    #unchanged dirs skipped after settle, new file in one dir found
+    inv = sdata_inventory.SdataInventory(invFile, settle=0)
+    assert inv.refresh([root]) == {'listed': 0, 'skipped': 3}
+    make_file(root + '/a/three.fits', endTime - 5)
+    assert inv.refresh([root]) == {'listed': 1, 'skipped': 2}
+    os.remove(root + '/b/two.fits')
+    assert inv.refresh([root])['listed'] == 1
+    paths = [r[0] for r in inv.find([root], endTime - 86400, endTime)]
+    assert paths == [root + '/a/one.fits', root + '/a/three.fits']
+    inv.close()
+
+
+
+@pytest.mark.locate
+def test_crawl_timeout(tmp_path, monkeypatch):
+    import time
+    import threading
+    for name in ('ok/a.fits', 'ok/sub/b.fits', 'hung/c.fits', 'slow/d.fits'):
+        make_file(str(tmp_path / name), 1000)
+    useDirs = [str(tmp_path / d) for d in ('ok', 'hung', 'slow')]
+
+    #hung dir never returns, slow dir only hangs on the first try
+    release = threading.Event()
+    tries = {'slow': 0}
+    scan = dep_locate.scan_fits_dir
+    def hanging_scan(fitsDir):
+        if fitsDir.endswith('/hung'): release.wait()
+        if fitsDir.endswith('/slow'):
+            tries['slow'] += 1
+            if tries['slow'] == 1: release.wait()
+        return scan(fitsDir)
+    monkeypatch.setattr(dep_locate, 'scan_fits_dir', hanging_scan)
+
+    start = time.time()
+    records, failedDirs = dep_locate.crawl_fits_dirs(useDirs, 2, timeout=0.2, retries=1)
+    release.set()
+    assert time.time() - start < 5
+    assert failedDirs == [useDirs[1]]
+    assert sorted(os.path.basename(r[0]) for r in records) == ['a.fits', 'b.fits', 'd.fits']
+    assert tries['slow'] == 2
+
+@pytest.mark.locate
+def test_locate_watch_manifest(tmp_path):
+    '''watcher records closed fits files and locate uses the manifest only if complete'''
+    import time
+    import json
+    import locate_watch
+    root = str(tmp_path / 'sdata')
+    os.makedirs(root + '/a')
+    watchDir = str(tmp_path / 'watch')
+    watcher = locate_watch.LocateWatcher([root], watchDir)
+    watcher.start()
+    make_file(root + '/a/one.fits', time.time())
+    os.makedirs(root + '/b/c')
+    make_file(root + '/b/c/two.fits.gz', time.time())
+    make_file(root + '/a/notes.txt', time.time())
+    for i in range(3): watcher.process(watcher.inotify.read_events(0.2))
+    watcher.inotify.close()
+
+    utDate = locate_watch.get_night(time.time(), '20:00:00')
+    utDate = f'{utDate[:4]}-{utDate[4:6]}-{utDate[6:]}'
+    with open(f"{watchDir}/{utDate.replace('-', '')}.manifest") as f:
+        assert sorted(line.split('\t')[0] for line in f) == [root + '/a/one.fits', root + '/b/c/two.fits.gz']
+
+    #watcher started after window start: fall back to crawl
+    assert locate_watch.get_manifest_records(watchDir, utDate, [root], time.time() - 86400, time.time() + 10) is None
+
+    #complete manifest used by find_24hr_fits (crawl would also find old.fits)
+    with open(watchDir + '/start.json', 'w') as f:
+        json.dump({'time': 0, 'dirs': [root]}, f)
+    with open(watchDir + '/heartbeat', 'w') as f:
+        f.write(str(time.time() + 86400*2))
+    make_file(root + '/old.fits', time.time())
+    paths = dep_locate.find_24hr_fits([root], utDate, '20:00:00', watchDir=watchDir)
+    assert sorted(paths) == [root + '/a/one.fits', root + '/b/c/two.fits.gz']
+    open(f"{watchDir}/{utDate.replace('-', '')}.overflow", 'w').close()
+    assert len(dep_locate.find_24hr_fits([root], utDate, '20:00:00', watchDir=watchDir)) == 3
+
+
+@pytest.mark.locate
+def test_locate_watch_manifest_timeout(tmp_path, monkeypatch):
+    '''manifest files in a dir whose stat hangs are skipped and the dir reported'''
+    import time
+    import json
+    import locate_watch
+    roots = [str(tmp_path / 'sdata1'), str(tmp_path / 'sdata2')]
+    for root in roots: make_file(root + '/one.fits', time.time())
+    watchDir = str(tmp_path / 'watch')
+    os.makedirs(watchDir)
+    utDate = locate_watch.get_night(time.time(), '20:00:00')
+    with open(f'{watchDir}/{utDate}.manifest', 'w') as f:
+        for root in roots: f.write(f'{root}/one.fits\t{time.time()}\n')
+    with open(watchDir + '/start.json', 'w') as f:
+        json.dump({'time': 0, 'dirs': roots}, f)
+    with open(watchDir + '/heartbeat', 'w') as f:
+        f.write(str(time.time() + 86400*2))
+    realStat = os.stat
+    def slow_stat(path, *args, **kwargs):
+        if str(path).startswith(roots[1]): time.sleep(2)
+        return realStat(path, *args, **kwargs)
+    monkeypatch.setattr(locate_watch.os, 'stat', slow_stat)
+
+    failedDirs = []
+    start = time.time()
+    records = locate_watch.get_manifest_records(watchDir, utDate, roots, time.time() - 86400, time.time() + 10,
+                                                timeout=0.2, retries=0, failedDirs=failedDirs)
+    assert time.time() - start < 1.5
+    assert [r[0] for r in records] == [roots[0] + '/one.fits']
+    assert failedDirs == [roots[1]]
+
+
+@pytest.mark.locate
+def test_locate_watch_unwatched(tmp_path):
+    '''a dir that can't be watched marks the night so locate crawls instead'''
+    import time
+    import json
+    import locate_watch
+    root = str(tmp_path / 'sdata')
+    os.makedirs(root + '/a')
+    os.makedirs(root + '/b')
+    watchDir = str(tmp_path / 'watch')
+    watcher = locate_watch.LocateWatcher([root], watchDir)
+    watcher.inotify = locate_watch.Inotify()
+    addWatch = watcher.inotify.add_watch
+    def add_watch(path, mask):
+        if path.endswith('/b'): raise OSError(28, 'inotify_add_watch failed for ' + path)
+        return addWatch(path, mask)
+    watcher.inotify.add_watch = add_watch
+    watcher.add_tree(root, scanFiles=False)
+    watcher.heartbeat()
+    watcher.inotify.close()
+    assert watcher.unwatched == {root + '/b'}
+
+    utDate = locate_watch.get_night(time.time(), '20:00:00')
+    with open(f'{watchDir}/{utDate}.unwatched') as f:
+        assert [line.split('\t')[0] for line in f] == [root + '/b']
+    utDate = f'{utDate[:4]}-{utDate[4:6]}-{utDate[6:]}'
+    with open(watchDir + '/start.json', 'w') as f:
+        json.dump({'time': 0, 'dirs': [root]}, f)
+    with open(watchDir + '/heartbeat', 'w') as f:
+        f.write(str(time.time() + 86400*2))
+    assert locate_watch.get_manifest_records(watchDir, utDate, [root], time.time() - 86400, time.time() + 10) is None
+
+
+@pytest.mark.locate
+@pytest.mark.parametrize('doMd5', [True, False])
+def test_stage_copy_files(tmp_path, doMd5):
+    '''pooled copy keeps content and mtime, reports md5, skips existing and logs failures'''
+    import hashlib
+    import stage_copy
+    src = str(tmp_path / 'sdata')
+    stage = str(tmp_path / 'stage')
+    data = os.urandom(3*1024*1024 + 17)
+    make_file(src + '/a/one.fits', 1600000000)
+    with open(src + '/a/one.fits', 'wb') as f: f.write(data)
+    os.utime(src + '/a/one.fits', (1600000000, 1600000000))
+    make_file(stage + src + '/a/two.fits', 1600000000)
+    make_file(src + '/a/two.fits', 1600000000)
+
+    pairs = [(p, stage + p) for p in (src + '/a/one.fits', src + '/a/two.fits', src + '/missing.fits')]
+    results = stage_copy.copy_files(pairs, numThreads=2, doMd5=doMd5)
+    assert [r['ok'] for r in results] == [True, True, False]
+    assert [r['copied'] for r in results] == [True, False, False]
+    with open(stage + src + '/a/one.fits', 'rb') as f: assert f.read() == data
+    assert os.stat(stage + src + '/a/one.fits').st_mtime == 1600000000
+    assert not os.path.exists(stage + src + '/missing.fits.part')
+    if doMd5: assert results[0]['md5'] == hashlib.md5(data).hexdigest()
+    else    : assert results[0]['md5'] is None
+
+
+@pytest.mark.locate
+def test_dep_locate_copy_failure(tmp_path, monkeypatch):
+    '''a file that can't be staged stops locate instead of dropping it from the night'''
+    import logging
+    src = str(tmp_path / 'sdata')
+    make_file(src + '/one.fits', 1600000000)
+    monkeypatch.setattr(dep_locate, 'find_24hr_fits', lambda *args: [src + '/one.fits', src + '/gone.fits'])
+    class Obj: pass
+    instrObj = Obj()
+    instrObj.instr  = 'HIRES'
+    instrObj.utDate = '2021-02-08'
+    instrObj.endTime = '20:00:00'
+    instrObj.rootDir = str(tmp_path)
+    instrObj.log    = logging.getLogger('test_dep_locate')
+    instrObj.dirs   = {'anc': str(tmp_path / 'anc'), 'stage': str(tmp_path / 'stage')}
+    instrObj.config = {'LOCATE': {'SEARCH_DIR': src}, 'MISC': {}}
+    os.makedirs(instrObj.dirs['stage'])
+    with pytest.raises(Exception, match='could not stage 1 of 2 files'):
+        dep_locate.dep_locate(instrObj)
+    assert not os.path.exists(instrObj.dirs['stage'] + '/dep_locateHIRES.txt')
+
+
+@pytest.mark.locate
+@pytest.mark.parametrize('mode', ['hardlink', 'reflink', 'symlink-readonly'])
+def test_stage_copy_modes(tmp_path, mode):
+    '''link modes link when possible (else copy) and always copy gz files'''
+    import stage_copy
+    src = str(tmp_path / 'sdata')
+    stage = str(tmp_path / 'stage')
+    make_file(src + '/one.fits', 1600000000)
+    make_file(src + '/two.fits.gz', 1600000000)
+    pairs = [(src + '/one.fits', stage + '/one.fits'), (src + '/two.fits.gz', stage + '/two.fits.gz')]
+    results = stage_copy.copy_files(pairs, doMd5=True, mode=mode)
+    assert results[1]['method'] == 'copy' and results[1]['md5']
+    assert results[0]['method'] in (mode, 'copy')
+    if mode == 'hardlink':
+        assert os.stat(stage + '/one.fits').st_ino == os.stat(src + '/one.fits').st_ino
+    if mode == 'symlink-readonly':
+        assert os.readlink(stage + '/one.fits') == src + '/one.fits'
+    with open(stage + '/one.fits') as f: assert f.read() == 'x'
+    assert not os.path.islink(stage + '/two.fits.gz')
+
+
+@pytest.mark.locate
+def test_gunzip_files(tmp_path):
+    '''pooled gunzip replaces .gz with data and keeps .gz mtime, bad files return None'''
+    import gzip
+    import stage_copy
+    data = os.urandom(100000)
+    good = str(tmp_path / 'one.fits.gz')
+    with gzip.open(good, 'wb') as f: f.write(data)
+    os.utime(good, (1600000000, 1600000000))
+    bad = str(tmp_path / 'bad.fits.gz')
+    make_file(bad, 1600000000)
+    assert stage_copy.gunzip_files([good, bad], numThreads=2) == [good[:-3], None]
+    with open(good[:-3], 'rb') as f: assert f.read() == data
+    assert os.stat(good[:-3]).st_mtime == 1600000000
+    assert not os.path.exists(good) and os.path.exists(bad)
+    assert not os.path.exists(bad[:-3]) and not os.path.exists(bad[:-3] + '.part')
+
+
+@pytest.mark.locate
+def test_rawfiles_header_cache(tmp_path):
+    '''dep_rawfiles caches validated headers and lazy HDU list opens file on access'''
+    import logging
+    import numpy as np
+    from astropy.io import fits
+    from header_cache import HeaderCache, LazyHDUList
+    stage = str(tmp_path)
+    os.makedirs(stage + '/anc/udf')
+    paths = []
+    for i in (1, 2):
+        path = f'{stage}/hires000{i}.fits'
+        hdr = fits.Header({'OUTFILE': 'hires', 'FRAMENO': i})
+        fits.PrimaryHDU(data=np.zeros((2, 2)), header=hdr).writeto(path)
+        paths.append(path)
+    with open(stage + '/pre.txt', 'w') as f: f.write('\n'.join(paths) + '\n')
+    dep_locate.dep_rawfiles('HIRES', '2021-02-08', stage + '/pre.txt', stage + '/dep_locateHIRES.txt',
+                            stage + '/anc', 0, logging.getLogger('test'))
+
+    cache = HeaderCache.load(stage, 'HIRES')
+    hdr = cache.get(paths[0])
+    assert hdr['FRAMENO'] == 1 and hdr.tostring() == fits.getheader(paths[0]).tostring()
+    #parsed once, later lookups return the same header
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(fits.Header, 'fromstring', lambda *args: pytest.fail('header parsed again'))
+        assert cache.get(paths[0]) is hdr
+    os.utime(paths[1], (1600000000, 1600000000))
+    assert cache.get(paths[1]) is None
+
+    hdus = LazyHDUList(paths[0])
+    assert hdus.hdus is None
+    assert hdus[0].data.shape == (2, 2) and len(hdus) == 1
+    hdus.close()
+
+
+@pytest.mark.locate
+def test_fits_scan_matches_astropy(tmp_path):
+    '''card scanner values match astropy, unusual headers fall back'''
+    import numpy as np
+    from astropy.io import fits
+    import fits_scan
+    path = str(tmp_path / 'a.fits')
+    hdr = fits.Header()
+    hdr['OUTFILE']  = ("it''s  ", 'comment / with slash')
+    hdr['FRAMENO']  = 12
+    hdr['AIRMASS']  = 1.5e-3
+    hdr['FLAG']     = True
+    hdr['EMPTY']    = ''
+    hdr['OUTFILE']  = 'not me'
+    hdr.append(('OUTFILE', 'dup'))
+    for i in range(60): hdr[f'PAD{i}'] = i
+    fits.PrimaryHDU(data=np.zeros(3), header=hdr).writeto(path)
+    keys = ['OUTFILE', 'FRAMENO', 'AIRMASS', 'FLAG', 'EMPTY', 'MISSING']
+    vals, headerStr = fits_scan.scan_header(path, keys)
+    astro = fits.getheader(path)
+    assert vals == {k: astro[k] for k in keys if k in astro}
+    assert fits.Header.fromstring(headerStr).tostring() == astro.tostring()
+
+    #long string, undefined value and gz need astropy
+    hdr = fits.Header()
+    hdr['OUTFILE'] = 'x' * 100
+    hdr['FRAMENO'] = None
+    fits.PrimaryHDU(header=hdr).writeto(str(tmp_path / 'b.fits'))
+    for key in ('OUTFILE', 'FRAMENO'):
+        with pytest.raises(fits_scan.ScanFallback):
+            fits_scan.scan_header(str(tmp_path / 'b.fits'), [key])
+    with pytest.raises(fits_scan.ScanFallback):
+        fits_scan.scan_header(str(tmp_path / 'b.fits.gz'), ['OUTFILE'])
+
+
+@pytest.mark.locate
+def test_fits_scan_find_end(tmp_path):
+    '''END must be on a card boundary, missing or far END falls back'''
+    import mmap
+    import fits_scan
+    def find(data, maxLen=fits_scan.MAX_HEADER_LEN):
+        path = str(tmp_path / 'c.fits')
+        with open(path, 'wb') as f: f.write(data)
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return fits_scan.find_end(mm, len(data), maxLen)
+    card = lambda text: text.encode().ljust(80)
+    block = card('SIMPLE  =                    T') + card('COMMENT   END') + card('') + fits_scan.END_CARD
+    assert find(block.ljust(2880)) == 4 * 80
+    nothing = card('SIMPLE  =                    T').ljust(2880) * 3
+    with pytest.raises(fits_scan.ScanFallback):
+        find(nothing)
+    with pytest.raises(fits_scan.ScanFallback):
+        find(nothing + fits_scan.END_CARD.ljust(2880), maxLen=3*2880)
+
+
+@pytest.mark.locate
+def test_get_search_dirs(tmp_path):
+    pytest.importorskip('matplotlib')
+    import instrument
+    for d in ('sdata1001/deimos1', 'sdata1002/deimos2', 'sdata1002/dmoseng', 'sdata1003/other'):
+        os.makedirs(str(tmp_path / d))
+    class Obj: pass
+    obj = Obj()
+    obj.instr   = 'DEIMOS'
+    obj.rootDir = str(tmp_path / 'koadata')
+    obj.log     = None
+    obj.config  = {'DEIMOS': {'SDATA_GLOBS': [str(tmp_path) + '/sdata100[1-2]/deimos*',
+                                              str(tmp_path) + '/sdata100[1-2]/dmoseng']},
+                   'LOCATE': {}}
+    expected = [str(tmp_path / d) for d in ('sdata1001/deimos1', 'sdata1002/deimos2', 'sdata1002/dmoseng')]
+    assert instrument.Instrument.get_search_dirs(obj) == expected
+
+    #new run reads the cached list even though a new dir now exists
+    os.makedirs(str(tmp_path / 'sdata1001/deimos3'))
+    obj.liveDirs = None
+    assert instrument.Instrument.get_search_dirs(obj) == expected
+
+    #expired cache is expanded again
+    obj.liveDirs = None
+    obj.config['LOCATE']['LIVE_DIRS_TTL'] = 0
+    assert str(tmp_path / 'sdata1001/deimos3') in instrument.Instrument.get_search_dirs(obj)
+
+    #a glob that matched nothing (ie disk not mounted) is looked up again next run
+    obj.config['LOCATE']['LIVE_DIRS_TTL'] = 12
+    obj.config['DEIMOS']['SDATA_GLOBS'].append(str(tmp_path) + '/sdata1004/deimos*')
+    obj.liveDirs = None
+    assert str(tmp_path / 'sdata1004/deimos4') not in instrument.Instrument.get_search_dirs(obj)
+    os.makedirs(str(tmp_path / 'sdata1004/deimos4'))
+    obj.liveDirs = None
+    assert str(tmp_path / 'sdata1004/deimos4') in instrument.Instrument.get_search_dirs(obj)
+    obj.liveDirs = None
+    os.makedirs(str(tmp_path / 'sdata1004/deimos5'))
+    assert str(tmp_path / 'sdata1004/deimos5') not in instrument.Instrument.get_search_dirs(obj)
+
+    #same for a missing dir from get_dir_list (no SDATA_GLOBS)
+    missing = str(tmp_path / 'sdata1005/deimos1')
+    obj.get_dir_list = lambda: [str(tmp_path / 'sdata1001/deimos1'), missing]
+    del obj.config['DEIMOS']['SDATA_GLOBS']
+    obj.liveDirs = None
+    assert instrument.Instrument.get_search_dirs(obj) == [str(tmp_path / 'sdata1001/deimos1')]
+    os.makedirs(missing)
+    obj.liveDirs = None
+    assert instrument.Instrument.get_search_dirs(obj) == [str(tmp_path / 'sdata1001/deimos1'), missing]
+
+
+@pytest.mark.locate
+def test_get_search_dirs_timeout(tmp_path, monkeypatch):
+    '''a glob on a hung mount is reported in failedDirs and the list is not cached'''
+    pytest.importorskip('matplotlib')
+    import time
+    import instrument
+    os.makedirs(str(tmp_path / 'sdata1001/deimos1'))
+    hung = str(tmp_path) + '/sdata1002/deimos*'
+    realGlob = instrument.glob.glob
+    def slow_glob(pattern):
+        if pattern == hung: time.sleep(2)
+        return realGlob(pattern)
+    monkeypatch.setattr(instrument.glob, 'glob', slow_glob)
+    class Obj: pass
+    obj = Obj()
+    obj.instr   = 'DEIMOS'
+    obj.rootDir = str(tmp_path / 'koadata')
+    obj.log     = None
+    obj.config  = {'DEIMOS': {'SDATA_GLOBS': [str(tmp_path) + '/sdata1001/deimos*', hung]},
+                   'LOCATE': {'CRAWL_TIMEOUT': 0.2, 'CRAWL_RETRIES': 0}}
+    failedDirs = []
+    start = time.time()
+    assert instrument.Instrument.get_search_dirs(obj, failedDirs) == [str(tmp_path / 'sdata1001/deimos1')]
+    assert time.time() - start < 1.5
+    assert failedDirs == [hung]
+    assert not os.path.exists(obj.rootDir + '/stage/DEIMOS/live_dirs.json')
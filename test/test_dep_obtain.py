@@ -0,0 +1,116 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+import dep_obtain
+"""
+test_dep_obtain.py runs tests on dep_obtain (no network or database needed).
+Run with the shell command:
+pytest -m obtain test_dep_obtain.py
+"""
+
+@pytest.mark.obtain
+def test_obtain_schedule(tmp_path):
+    obFile = str(tmp_path / 'dep_obtainHIRES.txt')
+    with open(obFile, 'w') as f:
+        f.write('2021-02-07\tjdoe\thires1\tUCB\tSmith\tU123\tA. Obs\t18:00\t23:00\tHIRESr\t1\n')
+        f.write('2021-02-07\tjdoe\thires2\tCIT\tJones\tC456\tB. Obs\t23:00\t05:00\tHIRESr\t1')
+    schedule = dep_obtain.ObtainSchedule.load(obFile)
+    assert schedule.oa == 'jdoe'
+    assert len(schedule) == 2
+    assert [p['ProjCode'] for p in schedule.programs] == ['U123', 'C456']
+    assert schedule.times == [('18:00', '23:00'), ('23:00', '05:00')]
+
+    #programs are copies, the schedule itself can't be changed
+    progs = schedule.programs
+    progs[0]['ProjCode'] = 'X'
+    progs.reverse()
+    assert schedule.programs[0]['ProjCode'] == 'U123'
+    with pytest.raises(TypeError):
+        schedule.rows[0]['OA'] = 'x'
+    with pytest.raises(AttributeError):
+        schedule.oa = 'x'
+
+    #legacy blank program row means no programs
+    with open(obFile, 'w') as f:
+        f.write('2021-02-07\tjdoe\tNONE\tNONE\tNONE\tNONE\tNONE\tNONE\tNONE\tNONE\tNONE')
+    schedule = dep_obtain.ObtainSchedule.load(obFile)
+    assert schedule.oa == 'jdoe' and schedule.programs == [] and len(schedule) == 1
+
+
+@pytest.fixture
+def mock_tel_api():
+    '''Local telescope API server: each request takes DELAY secs, first night staff request fails.'''
+    import json
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+    state = {'staff': 0, 'requests': []}
+    DELAY = 0.5
+    responses = {
+        'getNightStaff': [{'Type': 'oa', 'Alias': 'jdoe'}],
+        'getSchedule'  : [{'SchedId': str(i), 'Account': 'hires'+str(i), 'Institution': 'UCB', 'Principal': 'Smith',
+                           'ProjCode': f'U{i:03}', 'StartTime': '18:00', 'EndTime': '23:00',
+                           'Instrument': 'HIRESr', 'TelNr': '1'} for i in range(4)],
+    }
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            import time
+            query = parse_qs(urlparse(self.path).query)
+            cmd = query['cmd'][0]
+            request = {'cmd': cmd, 'start': time.monotonic()}
+            state['requests'].append(request)
+            time.sleep(DELAY)
+            request['end'] = time.monotonic()
+            if cmd == 'getNightStaff':
+                state['staff'] += 1
+                if state['staff'] == 1:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+            if cmd == 'getObservers': data = [{'Observers': 'Obs' + query['schedid'][0]}]
+            else                    : data = responses[cmd]
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args): pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/telSchedule.php?', state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.obtain
+def test_dep_obtain_concurrent(tmp_path, mock_tel_api):
+    import logging
+    url, state = mock_tel_api
+    class Obj: pass
+    instrObj = Obj()
+    instrObj.instr  = 'HIRES'
+    instrObj.utDate = '2021-02-08'
+    instrObj.dirs   = {'stage': str(tmp_path)}
+    instrObj.telUrl = url
+    instrObj.config = {'API': {'TIMEOUT': 5, 'RETRIES': 1}}
+    instrObj.log    = logging.getLogger('test_dep_obtain')
+    instrObj.get_telnr = lambda: 1
+
+    assert dep_obtain.dep_obtain(instrObj)
+
+    #6 requests + 1 retry: staff overlaps schedule, observers overlap each other
+    requests = state['requests']
+    assert sorted(r['cmd'] for r in requests) == ['getNightStaff'] * 2 + ['getObservers'] * 4 + ['getSchedule']
+    overlap = lambda reqs: max(r['start'] for r in reqs) < min(r['end'] for r in reqs)
+    staff = next(r for r in requests if r['cmd'] == 'getNightStaff')
+    sched = next(r for r in requests if r['cmd'] == 'getSchedule')
+    assert overlap([staff, sched])
+    assert overlap([r for r in requests if r['cmd'] == 'getObservers'])
+    assert all(r['start'] >= sched['end'] for r in requests if r['cmd'] == 'getObservers')
+
+    schedule = dep_obtain.ObtainSchedule.load(str(tmp_path / 'dep_obtainHIRES.txt'))
+    assert schedule.oa == 'jdoe'
+    assert [p['ProjCode'] for p in schedule.programs] == ['U000', 'U001', 'U002', 'U003']
+    assert [p['Observer'] for p in schedule.programs] == ['Obs0', 'Obs1', 'Obs2', 'Obs3']
@@ -0,0 +1,27 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+from getProgInfo import ProgData
+"""
+test_getProgInfo.py runs tests on the getProgInfo result lookups.
+Run with the shell command:
+pytest -m proginfo test_getProgInfo.py
+"""
+
+@pytest.mark.proginfo
+def test_prog_data_find():
+    rows = [{'file': f'/koadata/stage/HIRES/20210208/s/sdata125/hires1/2021feb08/hires{i:04}.fits', 'progid': f'U{i:03}'}
+            for i in range(5000)]
+    rows.append({'file': '/s/sdata125/hires1/2021feb08/extra.fits', 'progid': 'C001'})
+    progData = ProgData(rows)
+
+    #still a list for other users of getProgInfo output
+    assert isinstance(progData, list) and len(progData) == 5001
+
+    assert progData.find(rows[4321]['file'])['progid'] == 'U4321'
+    assert progData.find(rows[7]['file'].replace('/20210208/', '/20210208//'))['progid'] == 'U007'
+    assert progData.find('/koadata/stage/HIRES/20210208/s/sdata125/hires1/2021feb08/other.fits') is None
+
+    #different path prefix falls back to substring match
+    assert progData.find('/other/stage/s/sdata125/hires1/2021feb08/extra.fits')['progid'] == 'C001'
@@ -0,0 +1,74 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+"""
+test_instrument.py runs tests on Instrument methods that don't need FITS data.
+Run with the shell command:
+pytest -m instrument test_instrument.py
+"""
+
+class FakeDb:
+    def __init__(self, rows): 
+        self.rows = rows
+        self.queries = []
+    def query(self, database, query, getOne=False, params=None):
+        self.queries.append((query, params))
+        if self.rows is False: return False
+        if getOne: return False
+        return self.rows
+
+class FakeLog:
+    def info(self, msg): pass
+    def warning(self, msg): pass
+
+
+@pytest.mark.instrument
+def test_set_propint_night_cache():
+    pytest.importorskip('matplotlib')
+    import instrument
+    Instrument = instrument.Instrument
+    class Obj: pass
+    obj = Obj()
+    obj.utDate = '2021-02-08'
+    obj.log = FakeLog()
+    obj.extraMeta = {}
+    obj.db = FakeDb([{'semid': '2021A_U123', 'propmin': 24}, {'semid': '2021A_C456', 'propmin': 12}])
+    obj.get_night_propints = lambda: Instrument.get_night_propints(obj)
+    for semid, expected in (('2021A_U123', 24), ('2021A_C456', 12), ('2021A_N999', 18), ('2021A_U123', 24)):
+        obj.get_semid = lambda: semid
+        obj.fitsHeader = {'PROGID': semid.split('_')[1]}
+        Instrument.set_propint(obj, [])
+        assert obj.extraMeta['PROPINT'] == expected
+    assert len(obj.db.queries) == 1
+
+    #failed preload falls back to a query per file
+    obj.db = FakeDb(False)
+    obj.utDate = '2021-02-09'
+    Instrument.set_propint(obj, [])
+    Instrument.set_propint(obj, [])
+    assert obj.extraMeta['PROPINT'] == 18
+    assert len(obj.db.queries) == 3
+
+
+@pytest.mark.instrument
+def test_get_telnr_cache(monkeypatch):
+    pytest.importorskip('matplotlib')
+    import instrument
+    calls = []
+    def fake_api(url, getOne=False):
+        calls.append(url)
+        return {'TelNr': '1'} if 'HIRES' in url else None
+    monkeypatch.setattr(instrument, 'get_api_data', fake_api)
+    monkeypatch.setattr(instrument, 'telnrCache', {})
+    class Obj: pass
+    obj = Obj()
+    obj.telUrl = 'http://tel/?'
+    obj.log = None
+    obj.config = {'NIRC2': {'TELNR': 2}}
+
+    #API once per process, config override, static fallback when API fails
+    for instr, expected in (('HIRES', 1), ('HIRES', 1), ('NIRC2', 2), ('KCWI', 2), ('KCWI', 2)):
+        obj.instr = instr
+        assert instrument.Instrument.get_telnr(obj) == expected
+    assert len(calls) == 2
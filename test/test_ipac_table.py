@@ -0,0 +1,99 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+import numpy as np
+import pandas as pd
+import ipac_table
+"""
+test_ipac_table.py runs tests on the IPAC fixed-width table reader/writer.
+Run with the shell command:
+pytest -m ipac test_ipac_table.py
+"""
+
+COLS = [ipac_table.make_col('KOAID', 'char', 24),
+        ipac_table.make_col('AIRMASS', 'double', 4, 'null'),
+        ipac_table.make_col('FRAMENO', 'integer', 6),
+        ipac_table.make_col('OBJECT', 'char', 10, 'null')]
+ROWS = [['HI.20210208.00001.fits', 1.02, 1, 'M31'],
+        ['HI.20210208.00002.fits', 'null', 2, ''],
+        ['HI.20210208.00003.fits', 1.5, 3, 'flat lamp']]
+
+
+@pytest.mark.ipac
+def test_format_header():
+    cols = [ipac_table.make_col('A', 'char', 4), ipac_table.make_col('LONGNAME', 'double', 2, 'null')]
+    hdr = ipac_table.format_header(cols, comments=['Extended Header Name: X'])
+    assert hdr == ('\\ Extended Header Name: X\n'
+                   '|A   |LONGNAME|\n'
+                   '|char|double  |\n'
+                   '|    |        |\n'
+                   '|    |null    |\n')
+    assert ipac_table.format_row(cols, ['x', 1.5]) == ' x    1.5     '
+
+
+@pytest.mark.ipac
+def test_write_read_roundtrip(tmp_path):
+    filepath = str(tmp_path / 'test.tbl')
+    ipac_table.write_table(filepath, COLS, ROWS, comments=['a comment'])
+    df = ipac_table.read_table(filepath)
+    assert df.columns.tolist() == ['KOAID', 'AIRMASS', 'FRAMENO', 'OBJECT']
+    assert df['KOAID'].tolist() == [r[0] for r in ROWS]
+    assert df['AIRMASS'].iloc[0] == 1.02 and np.isnan(df['AIRMASS'].iloc[1])
+    assert df['FRAMENO'].tolist() == [1, 2, 3]
+    assert df['OBJECT'].iloc[2] == 'flat lamp' and pd.isnull(df['OBJECT'].iloc[1])
+
+
+@pytest.mark.ipac
+def test_read_variable_width_rows(tmp_path):
+    '''rows that are not fixed width fall back to line slicing'''
+    filepath = str(tmp_path / 'test.tbl')
+    ipac_table.write_table(filepath, COLS, ROWS)
+    with open(filepath) as f: text = f.read()
+    with open(filepath, 'w') as f: f.write(text.replace('M31  ', 'M31', 1).rstrip('\n'))
+    df = ipac_table.read_table(filepath)
+    assert df['OBJECT'].tolist()[0] == 'M31'
+    assert df['FRAMENO'].tolist() == [1, 2, 3]
+
+
+@pytest.mark.ipac
+def test_read_fixed_width_uneven_lines():
+    '''two short lines adding up to the row length are not fixed width'''
+    data = b'abcd\nef\nh\n'
+    assert ipac_table.read_fixed_width_bytes(data, [0, 2], 4) is None
+    cols = ipac_table.read_fixed_width_bytes(b'abcd\nefgh\n', [0, 2], 4)
+    assert cols[0].tolist() == [b'ab', b'ef'] and cols[1].tolist() == [b'cd', b'gh']
+
+
+@pytest.mark.ipac
+def test_read_matches_read_fwf(tmp_path):
+    filepath = str(tmp_path / 'test.tbl')
+    ipac_table.write_table(filepath, COLS, ROWS)
+    widths = [c['width'] + 1 for c in COLS]
+    fwf = pd.read_fwf(filepath, widths=widths, skiprows=range(1,4))
+    fwf.columns = fwf.columns.str.replace('|','').str.strip()
+    df = ipac_table.read_table(filepath)
+    pd.testing.assert_frame_equal(df, fwf, check_dtype=False)
+
+
+@pytest.mark.ipac
+def test_read_empty_table(tmp_path):
+    filepath = str(tmp_path / 'test.tbl')
+    ipac_table.write_table(filepath, COLS)
+    df = ipac_table.read_table(filepath)
+    assert len(df) == 0
+    assert df.columns.tolist() == [c['name'] for c in COLS]
+
+
+@pytest.mark.ipac
+def test_format_columns_matches_format_row():
+    cols = [ipac_table.make_col(n, 'char', 16) for n in ('S', 'B', 'F', 'I', 'L', 'V')]
+    columns = [np.array(['a', 'bb', '']),
+               np.array([b'x', b'yy', b'']),
+               np.array([1.5, 0.1, np.nan], dtype=np.float32),
+               np.array([1, -2, 300]),
+               np.array([True, False, True]),
+               np.arange(6.).reshape(3, 2)]
+    rows = [[c[j] for c in columns] for j in range(3)]
+    for r in rows: r[1] = r[1].decode()    #bytes are decoded like FITS string columns
+    assert ipac_table.format_columns(cols, columns) == [ipac_table.format_row(cols, r) for r in rows]
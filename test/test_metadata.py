@@ -150,6 +150,100 @@ def test_compare_md5sum_files():
             filesMismatch.append(f1)
     assert len(filesMismatch) == 0, 'mismatching files with standard: {}'.format(filesMismatch)
 
+def write_meta_file(filepath, cols, rows):
+    '''writes a minimal fixed-width metadata table for compare tests'''
+    widths = [max(len(c), 24) for c in cols]
+    with open(filepath, 'w') as f:
+        for vals in (cols, ['char']*len(cols), ['']*len(cols), ['']*len(cols)):
+            f.write(''.join('|' + v.ljust(w) for v, w in zip(vals, widths)) + '|\n')
+        for row in rows:
+            f.write(''.join(' ' + str(v).ljust(w) for v, w in zip(row, widths)) + '\n')
+
+@pytest.mark.metadata
+def test_compare_meta_files_report(tmp_path):
+    '''compare reports missing rows/cols and smart value diffs'''
+    f0 = str(tmp_path / 'md0.metadata.table')
+    f1 = str(tmp_path / 'md1.metadata.table')
+    write_meta_file(f0, ['KOAID', 'AIRMASS', 'OBJECT', 'DQA_DATE', 'ONLY0'],
+                    [['HI.20210208.00001.fits', '1.02', 'M31',  '2021-01-01', 'x'],
+                     ['HI.20210208.00002.fits', '1.50', 'Flat', '2021-01-01', 'x'],
+                     ['HI.20210208.00003.fits', '1.50', 'Dark', '2021-01-01', 'x']])
+    write_meta_file(f1, ['KOAID', 'AIRMASS', 'OBJECT', 'DQA_DATE'],
+                    [['HI.20210208.00002.fits', '1.5',  'flat', '2022-02-02'],
+                     ['HI.20210208.00001.fits', '1.9',  'M31',  '2022-02-02'],
+                     ['HI.20210208.00004.fits', '1.50', 'Arc',  '2022-02-02']])
+    results = metadata.compare_meta_files([f0, f1])
+    assert len(results) == 1
+    result = results[0]
+    assert result['columns']['onlyInBase'] == ['ONLY0']
+    assert result['columns']['diffCounts'] == {'AIRMASS': 1}
+    assert result['rows']['onlyInBase'] == ['HI.20210208.00003.fits']
+    assert result['rows']['onlyInOther'] == ['HI.20210208.00004.fits']
+    assert result['rows']['compared'] == 2
+    assert result['diffs'] == [{'koaid': 'HI.20210208.00001.fits', 'col': 'AIRMASS', 'val0': '1.02', 'val1': '1.9'}]
+    assert 'Meta compare: MD0 col "ONLY0" not in MD1 col list.' in result['warnings']
+
+@pytest.mark.metadata
+def test_smart_diff_mask_matches_val_smart_diff():
+    '''vectorized compare agrees with the single value compare'''
+    import pandas as pd
+    vals0 = ['1.04', 'abc', None, 'A  B', '3', 'x']
+    vals1 = ['1.0',  'ABC', '',   'a b',  '3.01', 'y']
+    mask = metadata.smart_diff_mask(pd.Series(vals0, dtype=object), pd.Series(vals1, dtype=object), 'PROGTITL')
+    expected = [metadata.val_smart_diff(v0, v1, 'PROGTITL') for v0, v1 in zip(vals0, vals1)]
+    assert mask.tolist() == expected
+
+def write_keyword_defs(filepath):
+    '''writes a minimal keyword definitions file for make_metadata tests'''
+    cols = ['FITSKeyword', 'MetadataDatatype', 'NullsAllowed', 'MetadataWidth', 'MinValue', 'MaxValue',
+            'Source', 'InputFormat', 'ValidateFormat', 'CheckValues', 'DiscreteValues']
+    rows = [['KOAID', 'char', 'N', '24', '', '', 'KOA', 'char', 'N', 'N', ''],
+            ['OBJECT', 'char', 'Y', '16', '', '', 'KOA', 'char', 'N', 'N', ''],
+            ['AIRMASS', 'double', 'Y', '8', '', '', 'KOA', 'double', 'Y', 'N', '']]
+    with open(filepath, 'w') as f:
+        for row in [cols] + rows:
+            f.write('\t'.join(row) + '\n')
+
+@pytest.mark.metadata
+def test_make_metadata_index_reuses_rows(tmp_path):
+    '''only changed files are re-derived when an index file is given'''
+    from astropy.io import fits
+    keyDefsFile = str(tmp_path / 'keywords.txt')
+    write_keyword_defs(keyDefsFile)
+    fitsDir = tmp_path / 'lev0'
+    fitsDir.mkdir()
+    for i, obj in enumerate(['M31', 'flat']):
+        hdr = fits.Header({'KOAID': f'HI.20210208.0000{i}.fits', 'OBJECT': obj, 'AIRMASS': 1.5})
+        fits.PrimaryHDU(header=hdr).writeto(str(fitsDir / f'HI.20210208.0000{i}.fits'))
+    metaOutFile = str(tmp_path / '20210208.metadata.table')
+    indexFile = str(tmp_path / '20210208.metadata.index.json')
+
+    metadata.make_metadata(keyDefsFile, metaOutFile, str(fitsDir), indexFile=indexFile)
+    with open(metaOutFile) as f: full = f.read()
+    assert os.path.isfile(indexFile)
+
+    #unchanged inputs: same output, no rows re-derived
+    calls = []
+    orig = metadata.get_fits_metadata_line
+    def spy(*args):
+        calls.append(args[0])
+        return orig(*args)
+    metadata.get_fits_metadata_line = spy
+    try:
+        metadata.make_metadata(keyDefsFile, metaOutFile, str(fitsDir), indexFile=indexFile)
+        with open(metaOutFile) as f: assert f.read() == full
+        assert calls == []
+
+        #one changed file and one changed extra metadata entry
+        fits.setval(str(fitsDir / 'HI.20210208.00001.fits'), 'OBJECT', value='arc')
+        extra = {'HI.20210208.00000.fits': {'PROGTITL': 'x'}}
+        metadata.make_metadata(keyDefsFile, metaOutFile, str(fitsDir), extraMeta=extra, indexFile=indexFile)
+        assert sorted(os.path.basename(c) for c in calls) == ['HI.20210208.00000.fits', 'HI.20210208.00001.fits']
+    finally:
+        metadata.get_fits_metadata_line = orig
+    df = metadata.load_metadata_file_as_df(metaOutFile)
+    assert df['OBJECT'].tolist() == ['M31', 'arc']
+
 if __name__=='__main__':
     if not os.path.exists(outDir): 
         os.mkdir(outDir)
@@ -0,0 +1,69 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.pardir)
+import tpx_updater
+import common
+"""
+test_tpx_updater.py runs tests on batched koatpx updates (no database needed).
+Run with the shell command:
+pytest -m db test_tpx_updater.py
+"""
+
+class FakeDb:
+    queries = []
+    result = 1
+    num = 0
+    def __init__(self, *args, **kwargs): pass
+    def query(self, database, query, getOne=False, params=None):
+        FakeDb.queries.append((query, params))
+        if FakeDb.result is not False and query.startswith('select'):
+            return {'num': FakeDb.num}
+        return FakeDb.result
+
+
+@pytest.mark.db
+def test_tpx_updater(monkeypatch):
+    monkeypatch.setattr(tpx_updater.db_conn, 'db_conn', FakeDb)
+    FakeDb.queries = []
+    FakeDb.result = 1
+
+    tpx = tpx_updater.TpxUpdater('HIRES', '2021-02-08')
+    assert tpx.flush()
+    assert FakeDb.queries == []
+
+    tpx.set('files', '12')
+    tpx.set('ondisk_stat', 'ERROR')
+    tpx.set('ondisk_stat', 'DONE')
+    tpx.set('pi', 'O"Brien')
+    assert tpx.flush()
+    assert FakeDb.queries == [
+        ('select count(*) as num from koatpx where instr=%s and utdate=%s', ['HIRES', '2021-02-08']),
+        ('insert into koatpx (instr, utdate, `files`, `ondisk_stat`, `pi`) values (%s, %s, %s, %s, %s)',
+         ['HIRES', '2021-02-08', '12', 'DONE', 'O"Brien'])]
+    assert tpx.changes == {}
+
+    #existing entry is updated
+    FakeDb.queries = []
+    FakeDb.num = 1
+    tpx.set('files', '13')
+    tpx.set('pi', 'O"Brien')
+    assert tpx.flush()
+    assert FakeDb.queries[1] == ('update koatpx set `files`=%s, `pi`=%s where instr=%s and utdate=%s',
+                                 ['13', 'O"Brien', 'HIRES', '2021-02-08'])
+
+    #failed flush keeps changes for a retry
+    FakeDb.queries = []
+    FakeDb.result = False
+    tpx.set('arch_stat', 'DONE')
+    assert not tpx.flush()
+    assert len(FakeDb.queries) == 1
+    assert tpx.changes == {'arch_stat': 'DONE'}
+
+    #single column update through common
+    FakeDb.result = 1
+    assert common.update_koatpx('HIRES', '2021-02-08', 'start_time', '20210208 20:00')
+    assert FakeDb.queries[-1][1] == ['20210208 20:00', 'HIRES', '2021-02-08']
+
+    with pytest.raises(AssertionError):
+        tpx.set('arch_stat="x"; drop', 'DONE')
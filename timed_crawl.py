@@ -0,0 +1,145 @@
+"""
+  Directory crawl with a bounded time per directory scan, used by dep_locate and
+  the sdata inventory so a hung NFS automount (ie /s/sdata...) can't stall locate.
+
+  Dirs are scanned by a pool of daemon worker threads.  If a scan of one dir takes
+  longer than 'timeout' seconds it is retried on a fresh worker (a worker stuck in
+  the kernel can't be interrupted, so it is abandoned) up to 'retries' times.  After
+  that, the root dir it belongs to is given up on: its remaining dirs are skipped
+  and the root index is returned in the failed list.  Other roots carry on.
+
+  Tasks are tuples of scanFunc args, the first of which is the dir path.
+
+  Usage:
+    crawler = TimedCrawler(scanFunc, numThreads=8, timeout=120, retries=1, log=log)
+    failed  = crawler.run([(root1,), (root2,)], handleFunc)
+  scanFunc(*task) runs in a worker thread and returns a result.
+  handleFunc(rootIdx, task, result) runs in the calling thread and returns the list
+  of new tasks (ie subdirs) to scan for that root.
+"""
+import queue
+import threading
+import time
+
+
+class TimedCrawler:
+
+    def __init__(self, scanFunc, numThreads=8, timeout=None, retries=0, log=None):
+        '''
+        @param scanFunc: function run by the workers for each task
+        @param numThreads: number of worker threads
+        @param timeout: seconds allowed for one scan (None for no limit)
+        @param retries: times a timed out scan is retried before its root is failed
+        @param log: optional logger
+        '''
+        self.scanFunc   = scanFunc
+        self.numThreads = max(1, numThreads)
+        self.timeout    = timeout
+        self.retries    = retries
+        self.log        = log
+        self.tasks      = queue.Queue()
+        self.results    = queue.Queue()
+        self.lock       = threading.Lock()
+        self.running    = {}
+        self.failed     = set()
+
+
+    def add_worker(self):
+        threading.Thread(target=self.work, daemon=True).start()
+
+
+    def work(self):
+        while True:
+            item = self.tasks.get()
+            if item is None: return
+            taskId, rootIdx, task = item
+            if rootIdx in self.failed: continue
+            with self.lock:
+                self.running[taskId] = time.time()
+            try:
+                result, error = self.scanFunc(*task), None
+            except Exception as e:
+                result, error = None, e
+            with self.lock:
+                #abandoned while we were stuck?  A replacement worker was started, so exit
+                if self.running.pop(taskId, None) is None: return
+                self.results.put((taskId, result, error))
+
+
+    def run(self, roots, handleFunc):
+        '''
+        Crawls from the root tasks.  Returns sorted list of failed root indexes.
+        '''
+        self.failed = set()
+        pending = {}
+        nextId = 0
+        for i in range(self.numThreads): self.add_worker()
+
+        def submit(rootIdx, task, attempt):
+            nonlocal nextId
+            pending[nextId] = (rootIdx, task, attempt)
+            self.tasks.put((nextId, rootIdx, task))
+            nextId += 1
+
+        for rootIdx, task in enumerate(roots):
+            submit(rootIdx, task, 0)
+
+        while pending:
+            try:
+                taskId, result, error = self.results.get(timeout=self.get_wait())
+            except queue.Empty:
+                taskId = None
+            if taskId is not None and taskId in pending:
+                rootIdx, task, attempt = pending.pop(taskId)
+                if rootIdx not in self.failed:
+                    if error:
+                        if self.log: self.log.warning(f'timed_crawl: could not scan {task[0]}: {error}')
+                    else:
+                        for newTask in handleFunc(rootIdx, task, result):
+                            submit(rootIdx, newTask, 0)
+            for taskId in self.get_expired():
+                if taskId not in pending: continue
+                rootIdx, task, attempt = pending.pop(taskId)
+                if attempt < self.retries:
+                    if self.log: self.log.warning(f'timed_crawl: scan of {task[0]} timed out after {self.timeout}s, '
+                                                  f'retrying ({attempt+1}/{self.retries})')
+                    submit(rootIdx, task, attempt + 1)
+                elif rootIdx not in self.failed:
+                    self.failed.add(rootIdx)
+                    self.fail_root(rootIdx, pending)
+                    if self.log: self.log.error(f'timed_crawl: LOCATE TIMEOUT scanning {task[0]} '
+                                                f'({self.retries+1} tries of {self.timeout}s), skipping {roots[rootIdx][0]}')
+
+        #stop idle workers (abandoned ones exit on their own if they ever return)
+        for i in range(self.numThreads): self.tasks.put(None)
+        return sorted(self.failed)
+
+
+    def get_wait(self):
+        '''Seconds to wait for a result before checking for timed out scans.'''
+        if self.timeout is None: return None
+        with self.lock:
+            if not self.running: return self.timeout
+            oldest = min(self.running.values())
+        return min(self.timeout, max(0.01, oldest + self.timeout - time.time()))
+
+
+    def get_expired(self):
+        '''Abandons timed out scans, starting a replacement worker for each.'''
+        if self.timeout is None: return []
+        now = time.time()
+        with self.lock:
+            expired = [taskId for taskId, start in self.running.items() if now - start > self.timeout]
+            for taskId in expired:
+                del self.running[taskId]
+                self.add_worker()
+        return expired
+
+
+    def fail_root(self, rootIdx, pending):
+        '''Drops a failed root's pending tasks, abandoning any that are running.'''
+        for taskId in [t for t, p in pending.items() if p[0] == rootIdx]:
+            del pending[taskId]
+            with self.lock:
+                if self.running.pop(taskId, None) is not None:
+                    self.add_worker()
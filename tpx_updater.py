@@ -0,0 +1,72 @@
+"""
+  Batched updates of a night's koa.koatpx status record.
+
+  Column changes are staged in memory with set() and written with flush() as a
+  parameterized existence check plus one insert or update of all the columns,
+  instead of a select, insert and update query per column.  (No upsert since
+  koatpx is not known to have a unique instr/utdate key.)
+
+  Usage:
+    tpx = TpxUpdater(instr, utDate, log)
+    tpx.set('files', str(num))
+    tpx.set('ondisk_stat', 'DONE')
+    tpx.flush()
+"""
+import re
+import db_conn
+
+
+COLUMN_RE = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+class TpxUpdater:
+
+    def __init__(self, instr, utDate, log=None):
+        '''
+        @param instr: instrument name
+        @param utDate: UT date (yyyy-mm-dd)
+        @param log: optional logger
+        '''
+        self.instr   = instr
+        self.utDate  = utDate
+        self.log     = log
+        self.changes = {}
+
+
+    def set(self, column, value):
+        '''Stages a column change (last value set for a column wins).'''
+        assert COLUMN_RE.match(column), f"ERROR: invalid koatpx column name '{column}'"
+        self.changes[column] = value
+
+
+    def flush(self):
+        '''
+        Writes all staged changes in one query.  Returns True on success (or nothing
+        to write).  On failure the changes stay staged.
+        '''
+        if not self.changes: return True
+
+        columns = list(self.changes.keys())
+        values  = [self.changes[col] for col in columns]
+        if self.log: self.log.info(f'update_koatpx: {self.instr} {self.utDate} {self.changes}')
+
+        db = db_conn.db_conn('config.live.ini', configKey='DATABASE')
+
+        # If entry not in database, create it with the columns, else update it
+        query = 'select count(*) as num from koatpx where instr=%s and utdate=%s'
+        check = db.query('koa', query, getOne=True, params=[self.instr, self.utDate])
+        if check is not False:
+            if int(check['num']) == 0:
+                query = ('insert into koatpx (instr, utdate, ' + ', '.join(f'`{col}`' for col in columns) + ')'
+                         ' values (' + ', '.join(['%s'] * (len(columns) + 2)) + ')')
+                params = [self.instr, self.utDate] + values
+            else:
+                query = ('update koatpx set ' + ', '.join(f'`{col}`=%s' for col in columns) +
+                         ' where instr=%s and utdate=%s')
+                params = values + [self.instr, self.utDate]
+            check = db.query('koa', query, params=params)
+        if check is False:
+            if self.log: self.log.error(f'update_koatpx failed for: {self.instr}, {self.utDate}, {self.changes}')
+            return False
+        self.changes = {}
+        return True
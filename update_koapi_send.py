@@ -16,11 +16,13 @@ def update_koapi_send(utdate, semid, instr=None):
     db = db_conn.db_conn('config.live.ini', configKey='DATABASE')
 
     #Get latest entry (by utdate_beg) matching semid and instr
-    query = f"select * from koapi_send where semid='{semid}' "
-    if instr: query += f" and instr='{instr}' " 
+    query = "select * from koapi_send where semid=%s "
+    params = [semid]
+    if instr: 
+        query += " and instr=%s "
+        params.append(instr)
     query += " order by utdate_beg desc limit 1"
-    rows = db.query('koa', query)
-    print(query, rows)
+    rows = db.query('koa', query, params=params)
 
     #If no entry, then create one
     if (len(rows) == 0):
@@ -37,16 +39,8 @@ def update_koapi_send(utdate, semid, instr=None):
             pass
         else:
             #print("updateKoapiSend: New entry - first for semid")
-            query = "insert into koapi_send set "
-            query += f" semid='{semid}' "
-            query += f", utdate_beg='{utdate}' "
-            query += f", utdate_end='{utdate}' "
-            query += f", send_data=1 "
-            query += f", data_notified=0 "
-            query += f", send_dvd=1 "
-            query += f", dvd_notified=0 "
-            if instr: query += f", instr='{instr}' "
-            result = db.query('koa', query)
+            query, params = get_insert_query(semid, utdate, instr)
+            result = db.query('koa', query, params=params)
 
     # if existing entry see if we need to update (next day DEP only) or add a new one
     else:
@@ -62,10 +56,13 @@ def update_koapi_send(utdate, semid, instr=None):
                 break
             elif (diff_day == 1):
                 #print("updateKoapiSend: Updating entry for semid")
-                query = f"update koapi_send set utdate_end='{utdate}', send_data=1, send_dvd=1 "
-                query += f" where semid='{semid}' and utdate_beg='{row['utdate_beg']}' "
-                if instr: query += f" and instr='{instr}' " 
-                result = db.query('koa', query)
+                query = "update koapi_send set utdate_end=%s, send_data=1, send_dvd=1 "
+                query += " where semid=%s and utdate_beg=%s "
+                params = [utdate, semid, row['utdate_beg']]
+                if instr: 
+                    query += " and instr=%s " 
+                    params.append(instr)
+                result = db.query('koa', query, params=params)
                 break
             else:
                 if (diff_day < 0):
@@ -73,17 +70,27 @@ def update_koapi_send(utdate, semid, instr=None):
                     break
                 else:
                     #print ("updateKoapiSend: New entry for semid")
-                    query = "insert into koapi_send set "
-                    query += f" semid='{semid}' "
-                    query += f", utdate_beg='{utdate}' "
-                    query += f", utdate_end='{utdate}' "
-                    query += f", send_data=1 "
-                    query += f", data_notified=0 "
-                    query += f", send_dvd=1 "
-                    query += f", dvd_notified=0 "
-                    if instr: query += f", instr='{instr}' "
-                    result = db.query('koa', query)
+                    query, params = get_insert_query(semid, utdate, instr)
+                    result = db.query('koa', query, params=params)
                     break
 
     return True
 
+
+def get_insert_query(semid, utdate, instr=None):
+    """
+    Returns (query, params) to insert a new koapi_send record
+    """
+    query = "insert into koapi_send set "
+    query += " semid=%s "
+    query += ", utdate_beg=%s "
+    query += ", utdate_end=%s "
+    query += ", send_data=1 "
+    query += ", data_notified=0 "
+    query += ", send_dvd=1 "
+    query += ", dvd_notified=0 "
+    params = [semid, utdate, utdate]
+    if instr: 
+        query += ", instr=%s "
+        params.append(instr)
+    return query, params